@@ -0,0 +1,532 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""A local stand-in for the PowerVM REST API, used by the benchmarks.
+
+FakePowerVM keeps the REST objects in memory.  It is seeded from the
+pypowervm test data (pvmhttp) files, and can be grown to hundreds of LPARs
+and VIOS mappings.  It supports:
+
+ - Feed and entry reads, with etags (If-None-Match gives a 304).
+ - Creates (PUT), updates (POST, with If-Match) and deletes.
+ - Jobs, which always complete successfully.  PowerOn and PowerOff change
+   the state of the partition.
+ - Quick properties of the partitions (one, or all of them).
+ - Configurable latency, etag conflicts (412) and VIOS busy errors (503).
+ - An event listener, which delivers the changes made through the fake to
+   the subscribed handlers, as the REST event feed would.
+
+FakeSession replaces the pypowervm Session beneath a real Adapter, so the
+driver's Adapter helpers, the wrappers and the transaction retry logic all
+run as they do against a real system.
+"""
+
+import collections
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+
+from lxml import etree
+from pypowervm import adapter as pvm_apt
+from pypowervm import const as pvm_const
+from pypowervm import exceptions as pvm_exc
+from pypowervm.tests.test_utils import pvmhttp
+from pypowervm import traits as pvm_traits
+
+HOST = 'localhost'
+PORT = 12443
+
+# The pvmhttp files the REST objects are seeded from.
+SEED_FILES = ('fake_managedsystem.txt', 'lpar.txt', 'fake_vios_feed2.txt',
+              'fake_volume_group.txt', 'fake_vswitch_feed.txt')
+JOB_REQUEST_FILE = 'job_request_power_off.txt'
+JOB_RESPONSE_FILE = 'job_response_completed_ok.txt'
+BUSY_FILE = 'fake_httperror_service_unavail.txt'
+
+# The quick properties returned by a read of .../quick
+QUICK_PROPS = ('PartitionName', 'PartitionID', 'PartitionState',
+               'CurrentMemory', 'AllocatedVirtualProcessors',
+               'IsManagementPartition', 'ResourceMonitoringControlState')
+
+_ENTRY = ('<entry xmlns="%(atom)s"><id>%(uuid)s</id><title>%(type)s</title>'
+          '<link rel="SELF" href="https://%(host)s:%(port)d%(href)s"/>'
+          '<etag:etag xmlns:etag="%(uom)s">%(etag)s</etag:etag>'
+          '<content type="application/vnd.ibm.powervm.uom+xml; '
+          'type=%(type)s">%(content)s</content></entry>')
+_FEED = ('<feed xmlns="%(atom)s"><id>%(uuid)s</id><title>%(type)s</title>'
+         '%(entries)s</feed>')
+_SCSI_MAP_RE = re.compile(r'<(\w+:)?VirtualSCSIMapping\b.*?'
+                          r'</(\w+:)?VirtualSCSIMapping>', re.S)
+
+
+def _qp_re(prop):
+    return re.compile(r'<(?:\w+:)?%s\b[^>]*>([^<]*)<' % prop)
+
+
+class _Entry(object):
+    """A REST object, held as the XML of its <content>."""
+
+    def __init__(self, schema_type, uuid, content, parent=None):
+        self.schema_type = schema_type
+        self.uuid = uuid.upper()
+        self.content = content
+        # The UUID of the parent object.  None if it can be read under any
+        # parent (ex. the seeded objects).
+        self.parent = parent
+        self.etag = None
+
+    def get_qp(self, prop):
+        match = _qp_re(prop).search(self.content)
+        if match is None:
+            return None
+        value = match.group(1)
+        return int(value) if value.isdigit() else value
+
+    def set_qp(self, prop, value):
+        self.content = _qp_re(prop).sub(
+            lambda m: m.group(0).replace('>%s<' % m.group(1),
+                                         '>%s<' % value), self.content, 1)
+
+
+class FakePowerVM(object):
+    """An in-memory PowerVM REST API."""
+
+    def __init__(self, latency_ms=0, latency_per_kb_ms=0, jitter=0.0,
+                 etag_conflict_rate=0.0, vios_busy_rate=0.0, seed=None):
+        """Creates the fake REST API, seeded with the pvmhttp data.
+
+        :param latency_ms: The latency of each request, in milliseconds.
+        :param latency_per_kb_ms: Extra latency for each KB of the response.
+        :param jitter: Random variation of the latency (0.1 is +/- 10%).
+        :param etag_conflict_rate: The fraction of updates that fail with an
+                                   etag mismatch (412), as if the object was
+                                   changed by someone else.
+        :param vios_busy_rate: The fraction of the VIOS requests that fail
+                               with a 'VIOS busy' (503) error.
+        :param seed: (Optional) Seed of the random injection of errors.
+        """
+        self.latency_ms = latency_ms
+        self.latency_per_kb_ms = latency_per_kb_ms
+        self.jitter = jitter
+        self.etag_conflict_rate = etag_conflict_rate
+        self.vios_busy_rate = vios_busy_rate
+        self._rand = random.Random(seed)
+
+        self._lock = threading.RLock()
+        self._etag_seq = 0
+        self._next_lpar_id = 100
+        # Dictionary of schema type to an OrderedDict of UUID to _Entry
+        self._objects = collections.defaultdict(collections.OrderedDict)
+        self.counts = collections.Counter()
+        # The changes not yet delivered to the event listener: an
+        # OrderedDict of the event URI to its action.  Only recorded once
+        # someone listens.
+        self.record_events = False
+        self._events = collections.OrderedDict()
+
+        for file_name in SEED_FILES:
+            self._seed(file_name)
+        self._job_request = pvmhttp.load_pvm_resp(
+            JOB_REQUEST_FILE).get_response().body
+        self._job_response = pvmhttp.load_pvm_resp(
+            JOB_RESPONSE_FILE).get_response().body
+        self._busy = pvmhttp.load_pvm_resp(BUSY_FILE).get_response().body
+
+    def _seed(self, file_name):
+        resp = pvmhttp.load_pvm_resp(file_name).get_response()
+        entries = resp.feed.entries if resp.feed else [resp.entry]
+        for entry in entries:
+            content = entry.element.toxmlstring()
+            if isinstance(content, bytes):
+                content = content.decode('utf-8')
+            self.add(etree.QName(entry.element.element).localname,
+                     entry.properties['id'], content)
+
+    def _new_etag(self):
+        self._etag_seq += 1
+        return str(self._etag_seq)
+
+    def _event(self, schema_type, obj_uuid, action):
+        """Records a change of a REST object for the event listener."""
+        if not self.record_events:
+            return
+        with self._lock:
+            uri = 'https://%s:%d/rest/api/uom/%s/%s' % (HOST, PORT,
+                                                        schema_type, obj_uuid)
+            # A later change of the same object supersedes the earlier one.
+            self._events.pop(uri, None)
+            self._events[uri] = action
+
+    def pop_events(self):
+        """Returns (and forgets) the changes recorded since the last call.
+
+        :return: OrderedDict of the event URI to the action ('add',
+                 'invalidate' or 'delete'), as the REST event feed reports
+                 them.
+        """
+        with self._lock:
+            events, self._events = self._events, collections.OrderedDict()
+        return events
+
+    @property
+    def host_uuid(self):
+        return next(iter(self._objects['ManagedSystem']))
+
+    def add(self, schema_type, uuid, content, parent=None):
+        """Adds (or replaces) a REST object.
+
+        :return: The new _Entry.
+        """
+        entry = _Entry(schema_type, uuid, content, parent=parent)
+        with self._lock:
+            entry.etag = self._new_etag()
+            self._objects[schema_type][entry.uuid] = entry
+        self._event(schema_type, entry.uuid, 'add')
+        return entry
+
+    def get(self, schema_type, uuid):
+        """Returns the _Entry of a REST object (None if it does not exist)."""
+        return self._objects[schema_type].get(uuid.upper())
+
+    def list(self, schema_type, parent=None):
+        """Returns the _Entry objects of a type (under a parent)."""
+        with self._lock:
+            return [ent for ent in self._objects[schema_type].values()
+                    if parent is None or ent.parent in (None, parent)]
+
+    def add_lpars(self, uuids):
+        """Adds LPARs, cloned from the first seeded LPAR.
+
+        :param uuids: The (PowerVM) UUIDs of the LPARs to add.
+        """
+        template = self.list('LogicalPartition')[0]
+        for lpar_uuid in uuids:
+            lpar_uuid = lpar_uuid.upper()
+            content = template.content.replace(template.uuid, lpar_uuid)
+            entry = self.add('LogicalPartition', lpar_uuid, content)
+            with self._lock:
+                self._next_lpar_id += 1
+                lpar_id = self._next_lpar_id
+            entry.set_qp('PartitionID', lpar_id)
+            entry.set_qp('PartitionName', 'bench-lpar-%d' % lpar_id)
+
+    def add_scsi_mappings(self, count):
+        """Adds vSCSI mappings to each VIOS, cloned from its first mapping.
+
+        :param count: The number of mappings to add to each VIOS.
+        """
+        for vios in self.list('VirtualIOServer'):
+            match = _SCSI_MAP_RE.search(vios.content)
+            if match is None:
+                continue
+            clones = match.group(0) * count
+            with self._lock:
+                vios.content = (vios.content[:match.end()] + clones +
+                                vios.content[match.end():])
+                vios.etag = self._new_etag()
+
+    def _sleep(self, resp_len):
+        delay = self.latency_ms + self.latency_per_kb_ms * resp_len / 1024.0
+        if self.jitter:
+            with self._lock:
+                delay *= 1 + self._rand.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+    def _chance(self, rate):
+        if not rate:
+            return False
+        with self._lock:
+            return self._rand.random() < rate
+
+    @staticmethod
+    def _parse(path):
+        """Splits a request path.
+
+        :return: Tuple of the schema type, the UUID (None for a feed), the
+                 parent UUID, and the suffix type and parameter (ex. 'do' and
+                 'PowerOn', or 'quick' and 'PartitionState').
+        """
+        segs = [seg for seg in path.split('?', 1)[0].split('/') if seg][3:]
+        schema_type = obj_uuid = parent = None
+        idx = 0
+        while idx < len(segs):
+            if segs[idx] in ('do', 'quick'):
+                parm = segs[idx + 1] if idx + 1 < len(segs) else None
+                return schema_type, obj_uuid, parent, segs[idx], parm
+            if obj_uuid is not None:
+                parent = obj_uuid
+            schema_type, obj_uuid = segs[idx], None
+            if idx + 1 < len(segs) and segs[idx + 1] not in ('do', 'quick'):
+                obj_uuid = segs[idx + 1].upper()
+                idx += 1
+            idx += 1
+        return schema_type, obj_uuid, parent, None, None
+
+    def _entry_xml(self, entry, path):
+        return _ENTRY % dict(atom=pvm_const.ATOM_NS, uom=pvm_const.UOM_NS,
+                             uuid=entry.uuid, type=entry.schema_type,
+                             host=HOST, port=PORT, etag=entry.etag,
+                             href=path.split('?', 1)[0],
+                             content=entry.content)
+
+    def _entry_resp(self, entry, path):
+        return 200, {'etag': entry.etag}, self._entry_xml(entry, path)
+
+    def handle(self, method, path, headers, body):
+        """Serves a single request.
+
+        :return: Tuple of the HTTP status, the response headers and the
+                 response body.
+        """
+        with self._lock:
+            self.counts[method] += 1
+        schema_type, obj_uuid, parent, suffix, parm = self._parse(path)
+
+        if schema_type == 'VirtualIOServer' and self._chance(
+                self.vios_busy_rate):
+            with self._lock:
+                self.counts['busy'] += 1
+            return 503, {}, self._busy
+
+        if schema_type == 'jobs':
+            if method == 'DELETE':
+                return 204, {}, ''
+            return 200, {}, self._job_response
+
+        with self._lock:
+            if suffix == 'do':
+                return self._job(method, schema_type, obj_uuid, parm)
+            if suffix == 'quick':
+                return self._quick(schema_type, obj_uuid, parm)
+            if method == 'GET':
+                return self._read(schema_type, obj_uuid, parent, path,
+                                  headers)
+            if method == 'PUT':
+                return self._create(schema_type, parent, path, body)
+            if method == 'POST':
+                return self._update(schema_type, obj_uuid, path, headers,
+                                    body)
+            if method == 'DELETE':
+                if self._objects[schema_type].pop(obj_uuid, None) is None:
+                    return 404, {}, ''
+                self._event(schema_type, obj_uuid, 'delete')
+                return 204, {}, ''
+        return 405, {}, ''
+
+    def _read(self, schema_type, obj_uuid, parent, path, headers):
+        if obj_uuid is not None:
+            entry = self.get(schema_type, obj_uuid)
+            if entry is None:
+                return 404, {}, ''
+            if headers.get('If-None-Match') == entry.etag:
+                return 304, {'etag': entry.etag}, ''
+            return self._entry_resp(entry, path)
+
+        entries = self.list(schema_type, parent=parent)
+        # The feed etag changes with any of its entries (or their number).
+        tags = ','.join(ent.uuid + ent.etag for ent in entries)
+        etag = str(zlib.crc32(tags.encode('utf-8')) & 0xffffffff)
+        if headers.get('If-None-Match') == etag:
+            return 304, {'etag': etag}, ''
+        if not entries:
+            return 204, {'etag': etag}, ''
+        feed_path = path.split('?', 1)[0]
+        body = _FEED % dict(
+            atom=pvm_const.ATOM_NS, uuid=str(uuid.uuid4()), type=schema_type,
+            entries=''.join(self._entry_xml(ent, '%s/%s' % (feed_path,
+                                                            ent.uuid))
+                            for ent in entries))
+        return 200, {'etag': etag}, body
+
+    def _create(self, schema_type, parent, path, body):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        entry = _Entry(schema_type, str(uuid.uuid4()), body, parent=parent)
+        pvm_uuid = entry.get_qp('PartitionUUID')
+        if pvm_uuid:
+            entry.uuid = pvm_uuid.upper()
+        entry.etag = self._new_etag()
+        if schema_type == 'LogicalPartition':
+            self._next_lpar_id += 1
+            if entry.get_qp('PartitionID') is None:
+                entry.content = entry.content.replace(
+                    '</PartitionName>', '</PartitionName><PartitionID>%d'
+                    '</PartitionID>' % self._next_lpar_id, 1)
+        self._objects[schema_type][entry.uuid] = entry
+        self._event(schema_type, entry.uuid, 'add')
+        return self._entry_resp(entry, '%s/%s' % (path.split('?', 1)[0],
+                                                  entry.uuid))
+
+    def _update(self, schema_type, obj_uuid, path, headers, body):
+        entry = self.get(schema_type, obj_uuid)
+        if entry is None:
+            return 404, {}, ''
+        if_match = headers.get('If-Match')
+        if if_match is not None and self._chance(self.etag_conflict_rate):
+            # Someone else changed the object.
+            entry.etag = self._new_etag()
+            self.counts['conflict'] += 1
+        if if_match is not None and if_match != entry.etag:
+            return 412, {}, ''
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        entry.content = body
+        entry.etag = self._new_etag()
+        self._event(schema_type, entry.uuid, 'invalidate')
+        return self._entry_resp(entry, path)
+
+    def _job(self, method, schema_type, obj_uuid, operation):
+        if method == 'GET':
+            return 200, {}, self._job_request
+        entry = self.get(schema_type, obj_uuid)
+        if entry is None:
+            return 404, {}, ''
+        if operation == 'PowerOn':
+            entry.set_qp('PartitionState', 'running')
+            entry.etag = self._new_etag()
+            self._event(schema_type, entry.uuid, 'invalidate')
+        elif operation == 'PowerOff':
+            entry.set_qp('PartitionState', 'not activated')
+            entry.etag = self._new_etag()
+            self._event(schema_type, entry.uuid, 'invalidate')
+        return 200, {}, self._job_response
+
+    def _quick(self, schema_type, obj_uuid, prop):
+        if obj_uuid is None:
+            # The quick properties of every object of the type
+            return 200, {}, json.dumps(
+                [dict({qp: ent.get_qp(qp) for qp in QUICK_PROPS},
+                      PartitionUUID=ent.uuid)
+                 for ent in self.list(schema_type)])
+        entry = self.get(schema_type, obj_uuid)
+        if entry is None:
+            return 404, {}, ''
+        if prop is None:
+            value = {qp: entry.get_qp(qp) for qp in QUICK_PROPS}
+        else:
+            value = entry.get_qp(prop)
+        return 200, {}, json.dumps(value)
+
+
+class FakeEventListener(object):
+    """A pypowervm EventListener that delivers the changes of a FakePowerVM.
+
+    The changes are delivered to the subscribed handlers every interval, on a
+    separate thread, as the real listener polls the REST event feed.
+    """
+
+    def __init__(self, fake_api, interval=0.1):
+        """Creates the listener.  The polling starts with a subscription.
+
+        :param fake_api: The FakePowerVM whose changes are delivered.
+        :param interval: The time (in seconds) between the deliveries.
+        """
+        self.fake_api = fake_api
+        self.interval = interval
+        self.handlers = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, handler):
+        """Subscribes a handler (a pypowervm EventHandler) to the changes."""
+        with self._lock:
+            self.handlers.append(handler)
+            self.fake_api.record_events = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def unsubscribe(self, handler):
+        with self._lock:
+            self.handlers.remove(handler)
+
+    def replay(self):
+        """Delivers the changes recorded so far to the handlers.
+
+        :return: The events delivered (an empty dict if there were none).
+        """
+        events = self.fake_api.pop_events()
+        if events:
+            with self._lock:
+                handlers = list(self.handlers)
+            for handler in handlers:
+                handler.process(dict(events))
+        return events
+
+    def _poll(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.replay()
+            except Exception:
+                # As the real listener, keep going.
+                pass
+
+    def shutdown(self):
+        """Stops the delivery of the changes."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.fake_api.record_events = False
+
+
+class FakeSession(object):
+    """A pypowervm Session that serves the requests from a FakePowerVM."""
+
+    def __init__(self, fake_api):
+        self.fake_api = fake_api
+        self.host = HOST
+        self.port = PORT
+        self.dest = 'https://%s:%d' % (HOST, PORT)
+        self.timeout = 1200
+        self.schema_version = 'V1_0'
+        self.use_file_auth = True
+        self.mc_type = 'PVM'
+        self.traits = pvm_traits.APITraits(self)
+        self._event_listener = None
+
+    def get_event_listener(self):
+        """The (single) FakeEventListener of the FakePowerVM."""
+        if self._event_listener is None:
+            self._event_listener = FakeEventListener(self.fake_api)
+        return self._event_listener
+
+    def request(self, method, path, headers=None, body='', sensitive=False,
+                verify=False, timeout=-1, auditmemento=None, relogin=True,
+                login=False, filehandle=None, chunksize=65536):
+        """Sends a request to the FakePowerVM (see Session.request)."""
+        headers = headers or {}
+        if filehandle is not None and method in ('PUT', 'POST'):
+            # An upload.  Drain the file, as the real Session would.
+            while filehandle.read(chunksize):
+                pass
+        status, resp_headers, resp_body = self.fake_api.handle(
+            method, path, headers, body)
+        self.fake_api._sleep(len(resp_body))
+
+        resp = pvm_apt.Response(method, path, status, str(status),
+                                resp_headers, reqheaders=headers,
+                                reqbody=body, body=resp_body)
+        if status >= 400:
+            raise pvm_exc.HttpError(resp)
+        return resp
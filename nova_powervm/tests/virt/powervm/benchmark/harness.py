@@ -0,0 +1,325 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Benchmarks of the PowerVM driver operations, against the fake REST API.
+
+The driver runs as it does in production (real Adapter, helpers, wrappers,
+taskflow flows and FeedTasks), on top of fake_api.FakeSession.  Only the
+parts that the fake REST API does not simulate are replaced:
+
+ - The host CPU metrics (PCM).
+ - The image download from glance (create_disk_from_image).
+ - The hdisk discovery job of the volume attach (discover_hdisk).
+ - Saving the nova instance (no database).
+
+Each scenario is run at each of the requested concurrencies (and flow
+worker counts), and reports the throughput, the p50/p99 latency and the
+number of REST calls per operation.  Whether the LPAR state cache is kept
+current by the (fake) REST event feed, or revalidated, is reported first.
+
+Examples:
+
+    python -m nova_powervm.tests.virt.powervm.benchmark.harness \\
+        --lpars 500 --mappings 200 --latency-ms 20 --concurrency 1,8,32
+
+    # The spawn time with its steps run serially, then in parallel.
+    python -m nova_powervm.tests.virt.powervm.benchmark.harness \\
+        --scenarios spawn --image-upload-ms 300 --flow-workers 1,4
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import sys
+import threading
+import time
+import uuid
+
+from concurrent import futures
+import mock
+from nova import objects
+from nova.virt import fake
+from oslo_config import cfg
+from pypowervm.tasks import hdisk
+from pypowervm.utils import uuid as pvm_uuid
+
+from nova_powervm.tests.virt import powervm
+from nova_powervm.tests.virt.powervm.benchmark import fake_api
+from nova_powervm.virt.powervm import cache
+from nova_powervm.virt.powervm import driver
+
+CONF = cfg.CONF
+
+SCENARIOS = ('list_instances', 'get_info', 'get_available_resource',
+             'spawn', 'attach_volume', 'destroy')
+
+# The active physical FC port of the VIOS in the seeded data.
+_VIOS_WWPN = '21000024FF649104'
+
+
+def percentile(values, pct):
+    """Returns the (nearest rank) percentile of a list of values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered))), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class Benchmark(object):
+    """Runs the driver scenarios against a FakePowerVM."""
+
+    def __init__(self, fake_powervm, lpars=0, upload_ms=0.0):
+        """Creates the driver, on top of the fake REST API.
+
+        :param fake_powervm: The fake_api.FakePowerVM to run against.
+        :param lpars: The number of (existing) instances to add.
+        :param upload_ms: The time (in milliseconds) the image upload of a
+                          spawn takes.
+        """
+        self.fake_api = fake_powervm
+        self.upload_ms = upload_ms
+        self._patchers = []
+        self._hdisks = itertools.count()
+        self._lock = threading.Lock()
+        # Instances created by the spawn scenario (for destroy)
+        self.spawned = []
+
+        # The existing instances
+        self.instances = [self._instance() for _ in range(lpars)]
+        self.fake_api.add_lpars([pvm_uuid.convert_uuid_to_pvm(inst.uuid)
+                                 for inst in self.instances])
+
+        vg = self.fake_api.list('VolumeGroup')[0]
+        CONF.set_override('volume_group_name', vg.get_qp('GroupName'),
+                          group='powervm')
+        self.drv = self._build_driver()
+
+    @staticmethod
+    def _instance():
+        inst_uuid = str(uuid.uuid4())
+        return objects.Instance(**dict(powervm.TEST_INSTANCE, uuid=inst_uuid,
+                                       display_name='bench-' + inst_uuid))
+
+    def _patch(self, *args, **kwargs):
+        patcher = mock.patch(*args, **kwargs)
+        self._patchers.append(patcher)
+        return patcher.start()
+
+    def _build_driver(self):
+        self.session = fake_api.FakeSession(self.fake_api)
+        self._patch('pypowervm.adapter.Session', return_value=self.session)
+        self._patch('nova_powervm.virt.powervm.host.HostCPUStats')
+        self._patch('nova.objects.Instance.save')
+        self._patch('pypowervm.tasks.hdisk.discover_hdisk',
+                    side_effect=self._discover_hdisk)
+        # The VIOS busy retries sleep 5, 10, 15 seconds.  Scale that down.
+        self._patch('pypowervm.helpers.vios_busy.SLEEP',
+                    side_effect=lambda secs: time.sleep(secs / 100.0))
+        mgmt_vios = self.fake_api.list('VirtualIOServer')[0]
+        self._patch('nova_powervm.virt.powervm.mgmt.get_mgmt_partition',
+                    return_value=mock.Mock(uuid=mgmt_vios.uuid))
+
+        drv = driver.PowerVMDriver(fake.FakeVirtAPI())
+        drv.init_host('benchmark')
+        # The image is not downloaded; only its VDisk is mapped.
+        drv.disk_dvr.create_disk_from_image = self._create_disk
+        return drv
+
+    @property
+    def event_driven(self):
+        """Whether the LPAR state cache is kept current by the events."""
+        return self.drv.lpar_cache.event_driven
+
+    def cleanup(self):
+        self.session.get_event_listener().shutdown()
+        for patcher in reversed(self._patchers):
+            patcher.stop()
+
+    def _discover_hdisk(self, adapter, vios_uuid, itls):
+        num = next(self._hdisks)
+        return (hdisk.LUAStatus.DEVICE_AVAILABLE, 'hdisk%d' % num,
+                '01M0lCTTIxNDUyNEM2MDA1MDc2ODAyODI4NjFEODgwMDAwMDAwMDAwMDA'
+                '%04d' % num)
+
+    def _create_disk(self, context, instance, image_meta, disk_size=None,
+                     image_type=None):
+        if self.upload_ms:
+            time.sleep(self.upload_ms / 1000.0)
+        disk = mock.Mock()
+        disk.name = 'b_%s' % instance.uuid[:8]
+        return disk
+
+    def _next_instance(self, idx):
+        return self.instances[idx % len(self.instances)]
+
+    # The scenarios.  Each runs a single operation.
+    def list_instances(self, idx):
+        self.drv.list_instances()
+
+    def get_info(self, idx):
+        self.drv.get_info(self._next_instance(idx))
+
+    def get_available_resource(self, idx):
+        self.drv.get_available_resource('benchmark')
+
+    def spawn(self, idx):
+        inst = self._instance()
+        self.drv.spawn('context', inst, mock.Mock(), None, None,
+                       network_info=[], flavor=powervm.TEST_FLAVOR)
+        with self._lock:
+            self.spawned.append(inst)
+
+    def destroy(self, idx):
+        with self._lock:
+            inst = self.spawned.pop()
+        self.drv.destroy('context', inst, [])
+
+    def attach_volume(self, idx):
+        conn_info = {'driver_volume_type': 'fibre_channel',
+                     'data': {'volume_id': 'vol-%d' % idx,
+                              'target_lun': idx,
+                              'initiator_target_map': {
+                                  _VIOS_WWPN: ['500507680210E522']}}}
+        self.drv.attach_volume('context', conn_info,
+                               self._next_instance(idx), '/dev/sdb')
+
+    def run(self, scenario, iterations, concurrency, flow_workers=None):
+        """Runs a scenario.
+
+        :param scenario: The name of the scenario (one of SCENARIOS).
+        :param iterations: The number of operations to run.
+        :param concurrency: The number of operations to run at once.
+        :param flow_workers: (Optional) The number of threads that run the
+                             steps of each operation (flow_max_workers).
+                             Defaults to the configured value.
+        :return: Dictionary with the results.
+        """
+        func = getattr(self, scenario)
+        if flow_workers is not None:
+            CONF.set_override('flow_max_workers', flow_workers,
+                              group='powervm')
+        if scenario == 'destroy':
+            # Spawn the instances to destroy first (not timed)
+            for idx in range(iterations - len(self.spawned)):
+                self.spawn(idx)
+        latencies, errors = [], []
+        counts = self.fake_api.counts.copy()
+
+        def timed(idx):
+            start = time.time()
+            try:
+                func(idx)
+            except Exception as e:
+                errors.append(e)
+            latencies.append(time.time() - start)
+
+        start = time.time()
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed, range(iterations)))
+        elapsed = time.time() - start
+
+        calls = sum(self.fake_api.counts[method] - counts[method]
+                    for method in ('GET', 'PUT', 'POST', 'DELETE'))
+        return {'scenario': scenario, 'concurrency': concurrency,
+                'workers': CONF.powervm.flow_max_workers,
+                'ops': iterations, 'errors': len(errors),
+                'ops_per_sec': iterations / elapsed if elapsed else 0.0,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'calls_per_op': float(calls) / iterations,
+                'conflicts': (self.fake_api.counts['conflict'] -
+                              counts['conflict']),
+                'busy': self.fake_api.counts['busy'] - counts['busy'],
+                'first_error': errors[0] if errors else None}
+
+
+def _report(results, event_driven, out=sys.stdout):
+    print('LPAR state cache: %s' % ('event driven' if event_driven else
+                                    'revalidated (events disabled)'),
+          file=out)
+    fmt = ('%-24s %5s %7s %6s %6s %10s %10s %10s %10s %6s %6s')
+    print(fmt % ('scenario', 'conc', 'workers', 'ops', 'errors', 'ops/s',
+                 'p50 ms', 'p99 ms', 'calls/op', '412s', '503s'), file=out)
+    for res in results:
+        print(fmt % (res['scenario'], res['concurrency'], res['workers'],
+                     res['ops'], res['errors'], '%.1f' % res['ops_per_sec'],
+                     '%.1f' % res['p50_ms'], '%.1f' % res['p99_ms'],
+                     '%.1f' % res['calls_per_op'], res['conflicts'],
+                     res['busy']), file=out)
+        if res['first_error'] is not None:
+            print('    first error: %s' % res['first_error'], file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='Comma separated scenarios (default: all).')
+    parser.add_argument('--concurrency', default='1,8',
+                        help='Comma separated concurrencies.')
+    parser.add_argument('--flow-workers', default=None,
+                        help='Comma separated numbers of threads to run the '
+                             'steps of each operation with (default: the '
+                             'flow_max_workers option).')
+    parser.add_argument('--image-upload-ms', type=float, default=0.0,
+                        help='Time the image upload of a spawn takes.')
+    parser.add_argument('--iterations', type=int, default=20,
+                        help='Operations per scenario and concurrency.')
+    parser.add_argument('--lpars', type=int, default=100,
+                        help='Number of existing LPARs.')
+    parser.add_argument('--mappings', type=int, default=0,
+                        help='Extra vSCSI mappings on each VIOS.')
+    parser.add_argument('--latency-ms', type=float, default=10.0,
+                        help='Latency of each REST call.')
+    parser.add_argument('--latency-per-kb-ms', type=float, default=0.05,
+                        help='Extra latency per KB of response.')
+    parser.add_argument('--jitter', type=float, default=0.2,
+                        help='Random latency variation (0.2 = +/- 20%%).')
+    parser.add_argument('--etag-conflict-rate', type=float, default=0.0,
+                        help='Fraction of updates that get a 412.')
+    parser.add_argument('--vios-busy-rate', type=float, default=0.0,
+                        help='Fraction of VIOS requests that get a 503.')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    fake = fake_api.FakePowerVM(
+        latency_ms=args.latency_ms,
+        latency_per_kb_ms=args.latency_per_kb_ms, jitter=args.jitter,
+        etag_conflict_rate=args.etag_conflict_rate,
+        vios_busy_rate=args.vios_busy_rate, seed=args.seed)
+    fake.add_scsi_mappings(args.mappings)
+    bench = Benchmark(fake, lpars=max(args.lpars, 1),
+                      upload_ms=args.image_upload_ms)
+    flow_workers = ([None] if args.flow_workers is None else
+                    [int(workers) for workers in args.flow_workers.split(',')])
+    results = []
+    try:
+        for scenario in args.scenarios.split(','):
+            for concurrency in args.concurrency.split(','):
+                for workers in flow_workers:
+                    # Each run starts with the shared caches cold.
+                    cache.VIOS_FEED_CACHE.invalidate()
+                    results.append(bench.run(scenario, args.iterations,
+                                             int(concurrency),
+                                             flow_workers=workers))
+    finally:
+        bench.cleanup()
+    _report(results, bench.event_driven)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import mock
+
+from nova import test
+from pypowervm import adapter as pvm_apt
+from pypowervm import const as pvm_const
+from pypowervm import exceptions as pvm_exc
+from pypowervm.wrappers import logical_partition as pvm_lpar
+from pypowervm.wrappers import managed_system as pvm_ms
+from pypowervm.wrappers import virtual_io_server as pvm_vios
+
+from nova_powervm.tests.virt.powervm.benchmark import fake_api
+from nova_powervm.tests.virt.powervm.benchmark import harness
+
+LPAR_UUID = '0A1B2C3D-0000-4000-8000-000000000001'
+
+
+class TestFakePowerVM(test.TestCase):
+
+    def setUp(self):
+        super(TestFakePowerVM, self).setUp()
+        self.fake = fake_api.FakePowerVM()
+        self.adpt = pvm_apt.Adapter(fake_api.FakeSession(self.fake))
+        self.host_uuid = self.fake.host_uuid
+
+    def _read_lpars(self, etag=None):
+        return self.adpt.read(pvm_ms.System.schema_type,
+                              root_id=self.host_uuid,
+                              child_type=pvm_lpar.LPAR.schema_type, etag=etag)
+
+    def test_read_feed(self):
+        resp = self._read_lpars()
+        lpars = pvm_lpar.LPAR.wrap(resp)
+        self.assertEqual(len(self.fake.list('LogicalPartition')), len(lpars))
+
+        # Unchanged feed
+        resp2 = self._read_lpars(etag=resp.etag)
+        self.assertEqual(pvm_const.HTTPStatus.NO_CHANGE, resp2.status)
+
+        # Another LPAR changes the feed etag
+        self.fake.add_lpars([LPAR_UUID])
+        resp3 = self._read_lpars(etag=resp.etag)
+        self.assertEqual(len(lpars) + 1, len(pvm_lpar.LPAR.wrap(resp3)))
+        self.assertEqual(3, self.fake.counts['GET'])
+
+    def test_read_entry_and_quick(self):
+        self.fake.add_lpars([LPAR_UUID])
+        lpar = pvm_lpar.LPAR.wrap(self.adpt.read(
+            pvm_lpar.LPAR.schema_type, root_id=LPAR_UUID))
+        self.assertEqual(LPAR_UUID, lpar.uuid.upper())
+        self.assertEqual('not activated', lpar.state)
+        self.assertTrue(lpar.name.startswith('bench-lpar-'))
+
+        resp = self.adpt.read(pvm_lpar.LPAR.schema_type, root_id=LPAR_UUID,
+                              suffix_type='quick', suffix_parm='PartitionID')
+        self.assertEqual(lpar.id, int(resp.body))
+
+        resp = self.adpt.read(pvm_lpar.LPAR.schema_type, suffix_type='quick',
+                              suffix_parm='All')
+        qps = {qp['PartitionUUID']: qp for qp in json.loads(resp.body)}
+        self.assertEqual(len(self.fake.list('LogicalPartition')), len(qps))
+        self.assertEqual(lpar.name, qps[LPAR_UUID]['PartitionName'])
+
+        self.assertRaises(pvm_exc.HttpError, self.adpt.read,
+                          pvm_lpar.LPAR.schema_type, root_id='bogus')
+
+    def test_update(self):
+        vios_w = pvm_vios.VIOS.wrap(self.adpt.read(
+            pvm_ms.System.schema_type, root_id=self.host_uuid,
+            child_type=pvm_vios.VIOS.schema_type))[0]
+        vios_w = vios_w.update()
+        # Once updated, the old wrapper (etag) is stale.
+        vios_w.update()
+        exc = self.assertRaises(pvm_exc.HttpError, vios_w.update)
+        self.assertEqual(pvm_const.HTTPStatus.ETAG_MISMATCH,
+                         exc.response.status)
+
+        # Injected conflicts
+        self.fake.etag_conflict_rate = 1.0
+        vios_w = vios_w.refresh()
+        self.assertRaises(pvm_exc.HttpError, vios_w.update)
+        self.assertEqual(1, self.fake.counts['conflict'])
+
+    def test_vios_busy(self):
+        self.fake.vios_busy_rate = 1.0
+        exc = self.assertRaises(
+            pvm_exc.HttpError, self.adpt.read, pvm_ms.System.schema_type,
+            root_id=self.host_uuid, child_type=pvm_vios.VIOS.schema_type)
+        self.assertEqual(pvm_const.HTTPStatus.SERVICE_UNAVAILABLE,
+                         exc.response.status)
+        self.assertEqual(1, self.fake.counts['busy'])
+
+    def test_scsi_mappings(self):
+        def num_maps():
+            vios_w = pvm_vios.VIOS.wrap(self.adpt.read(
+                pvm_ms.System.schema_type, root_id=self.host_uuid,
+                child_type=pvm_vios.VIOS.schema_type))[0]
+            return len(vios_w.scsi_mappings)
+        before = num_maps()
+        self.fake.add_scsi_mappings(50)
+        self.assertEqual(before + 50, num_maps())
+
+    def test_power_job(self):
+        self.fake.add_lpars([LPAR_UUID])
+        self.fake.handle('PUT', '/rest/api/uom/LogicalPartition/%s/do/'
+                         'PowerOn' % LPAR_UUID, {}, '')
+        self.assertEqual('running', self.fake.get(
+            'LogicalPartition', LPAR_UUID).get_qp('PartitionState'))
+
+    def test_event_listener(self):
+        self.fake.add_lpars([LPAR_UUID])
+        listener = self.adpt.session.get_event_listener()
+        self.assertIs(listener, self.adpt.session.get_event_listener())
+        # Nothing is recorded until a handler subscribes
+        self.assertEqual({}, listener.replay())
+
+        handler = mock.Mock()
+        listener.interval = 60
+        listener.subscribe(handler)
+        self.addCleanup(listener.shutdown)
+        self.fake.handle('PUT', '/rest/api/uom/LogicalPartition/%s/do/'
+                         'PowerOn' % LPAR_UUID, {}, '')
+        self.fake.handle('DELETE', '/rest/api/uom/LogicalPartition/%s' %
+                         LPAR_UUID, {}, '')
+        # The later change of the LPAR supersedes the earlier one
+        uri = 'https://%s:%d/rest/api/uom/LogicalPartition/%s' % (
+            fake_api.HOST, fake_api.PORT, LPAR_UUID)
+        self.assertEqual({uri: 'delete'}, listener.replay())
+        handler.process.assert_called_once_with({uri: 'delete'})
+
+        # Delivered once
+        self.assertEqual({}, listener.replay())
+        listener.unsubscribe(handler)
+        self.fake.add_lpars(['0A1B2C3D-0000-4000-8000-000000000002'])
+        listener.replay()
+        self.assertEqual(1, handler.process.call_count)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, harness.percentile(values, 50))
+        self.assertEqual(99, harness.percentile(values, 99))
+        self.assertEqual(0.0, harness.percentile([], 50))
@@ -15,6 +15,7 @@
 #    under the License.
 
 import mock
+import threading
 
 from nova import test
 
@@ -37,9 +38,102 @@ class TestDiskAdapter(test.TestCase):
         """These are arbitrary capacity numbers."""
         self.assertEqual(2097152, self.st_adpt.capacity)
         self.assertEqual(0, self.st_adpt.capacity_used)
+        self.assertEqual((2097152, 0), self.st_adpt.capacity_info)
 
     def test_get_image_upload(self):
         # Test if there is an ID, that we get a file adapter back
         img_meta = {'id': 'test_id'}
         temp = self.st_adpt._get_image_upload(mock.Mock(), img_meta)
         self.assertIsInstance(temp, disk_dvr.IterableToFileAdapter)
+        self.assertEqual(16, temp.prefetch)
+
+
+class TestIterableToFileAdapter(test.TestCase):
+    """Unit Tests for the IterableToFileAdapter."""
+
+    def _read_all(self, adpt, size):
+        data = []
+        while True:
+            chunk = adpt.read(size)
+            if not chunk:
+                return data
+            data.append(chunk)
+
+    def test_read(self):
+        for prefetch in (0, 2):
+            adpt = disk_dvr.IterableToFileAdapter(
+                [b'abc', b'', b'defgh', b'i'], prefetch=prefetch)
+            # Reads do not span chunks
+            self.assertEqual([b'ab', b'c', b'de', b'fg', b'h', b'i'],
+                             self._read_all(adpt, 2))
+            self.assertEqual(9, adpt.bytes_read)
+            self.assertIsNotNone(adpt.end_time)
+
+        # A whole chunk is returned as is
+        chunk = b'abcdef'
+        adpt = disk_dvr.IterableToFileAdapter([chunk])
+        self.assertIs(chunk, adpt.read(10))
+
+        # Read everything
+        adpt = disk_dvr.IterableToFileAdapter([b'abc', b'def'])
+        self.assertEqual(b'a', adpt.read(1))
+        self.assertEqual(b'bcdef', adpt.read())
+        self.assertEqual(b'', adpt.read())
+
+    def test_readinto(self):
+        adpt = disk_dvr.IterableToFileAdapter([b'abc', b'defgh', b'i'])
+        buf = bytearray(4)
+        # Fills the buffer, across chunks
+        self.assertEqual(4, adpt.readinto(buf))
+        self.assertEqual(b'abcd', buf)
+        self.assertEqual(4, adpt.readinto(buf))
+        self.assertEqual(b'efgh', buf)
+        self.assertEqual(1, adpt.readinto(buf))
+        self.assertEqual(b'i', buf[:1])
+        self.assertEqual(0, adpt.readinto(buf))
+        self.assertEqual(9, adpt.bytes_read)
+
+    def test_prefetch(self):
+        read_ahead = threading.Event()
+
+        def _chunks():
+            yield b'abc'
+            yield b'def'
+            read_ahead.set()
+            raise IOError()
+
+        adpt = disk_dvr.IterableToFileAdapter(_chunks(), prefetch=2)
+        self.assertEqual(b'abc', adpt.read(10))
+        # The iterable was consumed ahead of the reads
+        self.assertTrue(read_ahead.wait(10))
+        self.assertEqual(b'def', adpt.read(10))
+        # Errors of the iterable are raised to the reader, on every read.
+        self.assertRaises(IOError, adpt.read, 10)
+        self.assertRaises(IOError, adpt.read, 10)
+        adpt.close()
+
+    def test_close(self):
+        produced = []
+
+        def _chunks():
+            for idx in range(100):
+                produced.append(idx)
+                yield b'abc'
+
+        # The upload fails - the prefetch stops once the adapter is closed.
+        with disk_dvr.IterableToFileAdapter(_chunks(), prefetch=1) as adpt:
+            self.assertEqual(b'abc', adpt.read(10))
+        adpt._prefetcher.join(10)
+        self.assertFalse(adpt._prefetcher.is_alive())
+        self.assertLess(len(produced), 100)
+        self.assertRaises(ValueError, adpt.read, 10)
+
+    def test_counters(self):
+        adpt = disk_dvr.IterableToFileAdapter([b'a' * 100])
+        self.assertEqual(0, adpt.throughput)
+        self._read_all(adpt, 10)
+        self.assertEqual(100, adpt.bytes_read)
+        self.assertTrue(adpt.end_time >= adpt.start_time)
+        adpt.start_time, adpt.end_time = 10, 12
+        self.assertEqual(2, adpt.elapsed)
+        self.assertEqual(50, adpt.throughput)
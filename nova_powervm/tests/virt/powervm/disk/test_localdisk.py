@@ -14,11 +14,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import fixtures
 import mock
 
 import copy
 from nova import exception as nova_exc
 from nova import test
+from oslo_utils import units
+from pypowervm import const as pvm_const
 from pypowervm.tests import test_fixtures as pvm_fx
 from pypowervm.tests.test_utils import pvmhttp
 from pypowervm.wrappers import storage as pvm_stor
@@ -106,6 +109,19 @@ class TestLocalDisk(test.TestCase):
         self.assertEqual(5120.0, local.capacity)
         self.assertEqual(3072.0, local.capacity_used)
 
+        # Both from one read of the volume group
+        mock_get_vg.reset_mock()
+        self.assertEqual((5120.0, 3072.0), local.capacity_info)
+        mock_get_vg.assert_called_once_with(etag=None)
+
+        # The next read is conditional.  Not changed.
+        mock_vg_wrap.etag = 'etag'
+        mock_get_vg.return_value.status = pvm_const.HTTPStatus.NO_CHANGE
+        mock_vg.wrap.reset_mock()
+        self.assertEqual((5120.0, 3072.0), local.capacity_info)
+        mock_get_vg.assert_called_with(etag='etag')
+        self.assertFalse(mock_vg.wrap.called)
+
     @mock.patch('pypowervm.tasks.scsi_mapper.remove_maps')
     @mock.patch('nova_powervm.virt.powervm.vios.get_active_vioses')
     def test_disconnect_image_disk(self, mock_active_vioses, mock_rm_maps):
@@ -376,6 +392,140 @@ class TestLocalDisk(test.TestCase):
             local.adapter, 'vios_uuid', 'mp_uuid', disk_names=['disk_name'])
 
 
+class TestImageCache(test.TestCase):
+    """Unit Tests for the LocalDisk image cache."""
+
+    def setUp(self):
+        super(TestImageCache, self).setUp()
+        self.apt = self.useFixture(pvm_fx.AdapterFx()).adpt
+        self.flags(instances_path=self.useFixture(fixtures.TempDir()).path)
+        self.flags(localdisk_image_cache=True, group='powervm')
+        self.flags(localdisk_image_cache_min_free_gb=10, group='powervm')
+
+        self._patch('nova_powervm.virt.powervm.disk.localdisk.LocalStorage.'
+                    '_get_vg_uuid').return_value = ('vios_uuid', 'vg_uuid')
+        self.vg_wrap = mock.Mock(available_size='100', virtual_disks=[])
+        self._patch('nova_powervm.virt.powervm.disk.localdisk.LocalStorage.'
+                    '_get_vg_wrap').return_value = self.vg_wrap
+        self._patch('nova_powervm.virt.powervm.disk.driver.DiskAdapter.'
+                    '_get_image_upload')
+        self.mock_upload = self._patch(
+            'pypowervm.tasks.storage.upload_new_vdisk')
+        self.mock_rm = self._patch('pypowervm.tasks.storage.rm_vg_storage')
+
+        self.ld = TestLocalDisk.get_ls(self.apt)
+        self.cache = self.ld.image_cache
+        self.image = {'id': '8a8f3c7e-0a9f-4f31-b7d4-4e3b5e0ba6f0',
+                      'size': 2 * units.Gi}
+
+    def _patch(self, target):
+        patcher = mock.patch(target)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    @staticmethod
+    def _vdisk(name, udid, capacity='1'):
+        vdisk = mock.Mock(udid=udid, capacity=capacity)
+        vdisk.name = name
+        return vdisk
+
+    def test_vdisk_name(self):
+        self.assertEqual('image_8a8f3c7e0',
+                         self.cache.vdisk_name(self.image['id']))
+
+    def test_acquire_miss_then_hit(self):
+        name = self.cache.vdisk_name(self.image['id'])
+        img_vdisk = self._vdisk(name, 'udid1')
+        self.mock_upload.return_value = (img_vdisk, None)
+
+        # Miss - uploaded to the cache
+        self.assertEqual(img_vdisk, self.cache.acquire(None, self.image))
+        self.mock_upload.assert_called_once_with(
+            self.apt, 'vios_uuid', 'vg_uuid', mock.ANY, name, 2 * units.Gi)
+        self.cache.release(img_vdisk)
+
+        # Hit - found in the volume group, not uploaded again.
+        self.vg_wrap.virtual_disks = [img_vdisk]
+        self.assertEqual(img_vdisk, self.cache.acquire(None, self.image))
+        self.assertEqual(1, self.mock_upload.call_count)
+
+        # The index survives a restart
+        self.assertEqual(img_vdisk,
+                         ld.ImageCache(self.ld).acquire(None, self.image))
+        self.assertEqual(1, self.mock_upload.call_count)
+
+    def test_acquire_upload_fails(self):
+        name = self.cache.vdisk_name(self.image['id'])
+        partial = self._vdisk(name, 'udid1')
+        self.vg_wrap.virtual_disks = [partial]
+        self.mock_upload.side_effect = ValueError()
+
+        self.assertRaises(ValueError, self.cache.acquire, None, self.image)
+        # The partial image is removed and not indexed.
+        self.mock_rm.assert_called_once_with(self.vg_wrap, vdisks=[partial])
+        self.assertEqual({}, self.cache._index)
+        self.assertEqual(0, self.cache._in_use[name])
+
+    @mock.patch('time.time')
+    def test_make_room(self, mock_time):
+        old, new, busy = (self._vdisk('image_old', 'u1', '20'),
+                          self._vdisk('image_new', 'u2', '20'),
+                          self._vdisk('image_busy', 'u3', '20'))
+        stale = self._vdisk('image_stale', 'u4', '5')
+        boot = self._vdisk('b_inst', 'u5', '50')
+        self.vg_wrap.virtual_disks = [new, busy, boot, stale, old]
+        self.cache._index = {
+            'image_old': {'image_id': 'a', 'udid': 'u1', 'last_used': 1},
+            'image_new': {'image_id': 'b', 'udid': 'u2', 'last_used': 3},
+            'image_busy': {'image_id': 'c', 'udid': 'u3', 'last_used': 0}}
+        self.cache._in_use['image_busy'] = 1
+
+        # Enough room - nothing is removed.  The disk the index does not
+        # track is left alone.
+        self.cache.make_room(10 * units.Gi)
+        self.assertFalse(self.mock_rm.called)
+
+        # Unless the removal of the orphans is enabled.
+        self.flags(localdisk_image_cache_remove_orphans=True,
+                   group='powervm')
+        self.cache.make_room(10 * units.Gi)
+        self.mock_rm.assert_called_once_with(self.vg_wrap, vdisks=[stale])
+        self.flags(localdisk_image_cache_remove_orphans=False,
+                   group='powervm')
+
+        # Needs 10 GB + 10 GB free, with only 5 available.  Evicts the least
+        # recently used (that is not in use), but never the orphan.
+        self.mock_rm.reset_mock()
+        self.vg_wrap.available_size = '5'
+        self.cache.make_room(10 * units.Gi)
+        self.mock_rm.assert_called_once_with(self.vg_wrap, vdisks=[old])
+        self.assertEqual({'image_new', 'image_busy'}, set(self.cache._index))
+
+    @mock.patch('pypowervm.tasks.storage.crt_vdisk')
+    @mock.patch('nova_powervm.virt.powervm.disk.localdisk.LocalStorage.'
+                '_copy_vdisk')
+    def test_create_disk_from_image(self, mock_copy, mock_crt):
+        img_vdisk = self._vdisk('image_8a8f3c7e0', 'udid1')
+        self.mock_upload.return_value = (img_vdisk, None)
+        inst = mock.Mock(uuid='d5065c2c-ac43-3fa6-af32-ea84a3960291')
+        inst.name = 'Inst Name'
+
+        vdisk = self.ld.create_disk_from_image(None, inst, self.image, 20)
+        mock_crt.assert_called_once_with(self.apt, 'vios_uuid', 'vg_uuid',
+                                         'b_Inst_Nam_d506', 20)
+        mock_copy.assert_called_once_with(img_vdisk, mock_crt.return_value)
+        self.assertEqual(mock_crt.return_value, vdisk)
+        self.assertEqual(0, self.cache._in_use[img_vdisk.name])
+
+        # A failed copy removes the new disk.
+        mock_copy.side_effect = ValueError()
+        self.assertRaises(ValueError, self.ld.create_disk_from_image, None,
+                          inst, self.image, 20)
+        self.mock_rm.assert_called_with(self.vg_wrap,
+                                        vdisks=[mock_crt.return_value])
+        self.assertEqual(0, self.cache._in_use[img_vdisk.name])
+
+
 class TestLocalDiskFindVG(test.TestCase):
     """Test in separate class for the static loading of the VG.
 
@@ -19,9 +19,12 @@ import fixtures
 import mock
 
 import copy
+import time
 from nova import test
 import pypowervm.adapter as pvm_adp
+from pypowervm import const as pvm_const
 import pypowervm.entities as pvm_ent
+from pypowervm import exceptions as pvm_exc
 from pypowervm.tests import test_fixtures as pvm_fx
 from pypowervm.tests.test_utils import pvmhttp
 from pypowervm.wrappers import cluster as pvm_clust
@@ -31,6 +34,7 @@ from pypowervm.wrappers import virtual_io_server as pvm_vios
 from nova_powervm.tests.virt.powervm import fixtures as fx
 from nova_powervm.virt.powervm.disk import ssp
 from nova_powervm.virt.powervm import exception as npvmex
+from nova_powervm.virt.powervm import vios as npvm_vios
 
 
 SSP = 'ssp.txt'
@@ -226,13 +230,53 @@ class TestSSPDiskAdapter(test.TestCase):
         ssp_stor = self._get_ssp_stor()
         self.assertEqual(1, self.apt.read_by_href.call_count)
         self.assertEqual(0, self.mock_ssp_refresh.call_count)
-        # Accessing the @property will trigger refresh
+        # Accessing the @property within the refresh interval is a hit.
         ssp_wrap = ssp_stor._ssp
         self.assertEqual(1, self.apt.read_by_href.call_count)
+        self.assertEqual(0, self.mock_ssp_refresh.call_count)
+        self.assertEqual(ssp_wrap.name, orig_ssp_wrap.name)
+        self.assertEqual(1, ssp_stor.ssp_cache_hits)
+        self.assertEqual(1, ssp_stor.ssp_cache_misses)
+        # Revalidation triggers refresh
+        ssp_wrap = ssp_stor._get_ssp(revalidate=True)
         self.assertEqual(1, self.mock_ssp_refresh.call_count)
         self.assertEqual(ssp_wrap.name, orig_ssp_wrap.name)
 
+    @mock.patch('time.time')
+    def test_ssp_refresh_interval(self, mock_time):
+        self.flags(ssp_refresh_interval=60, group='powervm')
+        mock_time.return_value = 100
+        ssp_stor = self._get_ssp_stor()
+        ssp_wrap = ssp_stor._ssp_wrap
+        self.assertEqual(1, ssp_stor.ssp_cache_misses)
+
+        # Capacity reporting within the interval is served from the cache.
+        mock_time.return_value = 159
+        ssp_stor.capacity
+        ssp_stor.capacity_used
+        self.assertEqual(0, self.mock_ssp_refresh.call_count)
+        self.assertEqual(2, ssp_stor.ssp_cache_hits)
+
+        # Interval expired.  Not modified (304) counts as a hit.
+        mock_time.return_value = 160
+        self.mock_ssp_refresh.return_value = ssp_wrap
+        self.assertEqual(ssp_wrap, ssp_stor._ssp)
+        self.assertEqual(1, self.mock_ssp_refresh.call_count)
+        self.assertEqual(3, ssp_stor.ssp_cache_hits)
+        self.assertEqual(1, ssp_stor.ssp_cache_misses)
+
+        # After the driver updates the SSP, the next access revalidates.
+        new_wrap = mock.Mock()
+        ssp_stor._set_ssp(mock.Mock(refresh=mock.Mock(return_value=new_wrap)))
+        self.assertEqual(new_wrap, ssp_stor._ssp)
+        self.assertEqual(2, ssp_stor.ssp_cache_misses)
+
     def test_vios_uuids(self):
+        # No VIOS load known - picked at random
+        load_mon = npvm_vios.VIOSLoadMonitor()
+        patcher = mock.patch.object(npvm_vios, 'LOAD_MONITOR', load_mon)
+        patcher.start()
+        self.addCleanup(patcher.stop)
         ssp_stor = self._get_ssp_stor()
         vios_uuids = ssp_stor.vios_uuids
         self.assertEqual({'10B06F4B-437D-9C18-CA95-34006424120D',
@@ -248,6 +292,15 @@ class TestSSPDiskAdapter(test.TestCase):
         # guaranteed to work, but the odds of failure should be infinitesimal.
         self.assertEqual(set(vios_uuids), s)
 
+        # The least loaded VIOS is picked
+        load_mon._loads = {
+            '10B06F4B-437D-9C18-CA95-34006424120D':
+                npvm_vios.VIOSLoad(0.8, 0, 0),
+            '6424120D-CA95-437D-9C18-10B06F4B3400':
+                npvm_vios.VIOSLoad(0.2, 0, 0)}
+        self.assertEqual('6424120D-CA95-437D-9C18-10B06F4B3400',
+                         ssp_stor._any_vios_uuid())
+
         # Test VIOSes on other nodes, which won't have uuid or url
         with mock.patch.object(ssp_stor, '_cluster') as mock_clust:
             def mock_node(uuid, uri):
@@ -273,22 +326,34 @@ class TestSSPDiskAdapter(test.TestCase):
         ssp_stor = self._get_ssp_stor()
         self.assertEqual((49.88 - 48.98), ssp_stor.capacity_used)
 
+    def test_capacity_info(self):
+        ssp_stor = self._get_ssp_stor()
+        self.assertEqual((49.88, 49.88 - 48.98), ssp_stor.capacity_info)
+
+    @mock.patch('pypowervm.tasks.storage.rm_ssp_storage')
+    @mock.patch('pypowervm.tasks.storage.crt_lu')
     @mock.patch('pypowervm.tasks.storage.crt_lu_linked_clone')
     @mock.patch('pypowervm.tasks.storage.upload_new_lu')
     @mock.patch('nova_powervm.virt.powervm.disk.driver.IterableToFileAdapter')
     @mock.patch('nova.image.API')
     def test_create_disk_from_new_image(self, mock_img_api, mock_it2fadp,
-                                        mock_upload_lu, mock_crt_lnk_cln):
+                                        mock_upload_lu, mock_crt_lnk_cln,
+                                        mock_crt_lu, mock_rm_lu):
         b1G = 1024 * 1024 * 1024
         b2G = 2 * b1G
         ssp_stor = self._get_ssp_stor()
-        img = dict(name='image-name', id='image-id', size=b2G)
+        img = dict(name='image-name', id='image-id', size=b2G,
+                   checksum='cksum')
+        marker = mock.Mock()
+        ssp_marked = mock.Mock(etag='marked', logical_units=[])
+        mock_crt_lu.return_value = (ssp_marked, marker)
 
         def verify_upload_new_lu(vios_uuid, ssp1, stream, lu_name, f_size):
             self.assertIn(vios_uuid, ssp_stor.vios_uuids)
-            self.assertEqual(ssp_stor._ssp_wrap, ssp1)
-            # 'image' + '_' + s/-/_/g(image['id']), per _get_image_name
-            self.assertEqual('image_image_name', lu_name)
+            self.assertEqual(ssp_marked, ssp1)
+            # 'image' + '_' + sanitize(name) + '_' + checksum, per
+            # _get_image_name
+            self.assertEqual('image_image_name_cksum', lu_name)
             self.assertEqual(b2G, f_size)
             return 'image_lu', None
 
@@ -303,6 +368,14 @@ class TestSSPDiskAdapter(test.TestCase):
         lu = ssp_stor.create_disk_from_image(None, self.instance, img, 1)
         self.assertEqual('new_lu', lu)
 
+        # The upload was claimed with a marker LU, which is then removed.
+        mock_crt_lu.assert_called_once_with(
+            mock.ANY, mock.ANY, 0.001, typ=pvm_stg.LUType.DISK)
+        self.assertTrue(mock_crt_lu.call_args[0][1].startswith(
+            ssp.SSPDiskAdapter._marker_key('image_image_name_cksum') + '_'))
+        mock_rm_lu.assert_called_once_with(mock.ANY, [marker],
+                                           del_unused_images=False)
+
     @mock.patch('pypowervm.tasks.storage.crt_lu_linked_clone')
     @mock.patch('nova_powervm.virt.powervm.disk.driver.IterableToFileAdapter')
     @mock.patch('nova.image.API')
@@ -313,7 +386,7 @@ class TestSSPDiskAdapter(test.TestCase):
         ssp_stor = self._get_ssp_stor()
         img = dict(name='image-name', id='image-id', size=b2G)
         # Mock the 'existing' image LU
-        img_lu = pvm_stg.LU.bld(None, 'image_image_name', 123,
+        img_lu = pvm_stg.LU.bld(None, 'image_image_name_image_id', 123,
                                 typ=pvm_stg.LUType.IMAGE)
         ssp_stor._ssp_wrap.logical_units.append(img_lu)
 
@@ -331,6 +404,142 @@ class TestSSPDiskAdapter(test.TestCase):
         lu = ssp_stor.create_disk_from_image(None, Instance(), img, 1)
         self.assertEqual('new_lu', lu)
 
+    @mock.patch('pypowervm.tasks.storage.crt_lu')
+    def test_get_or_upload_legacy_image_lu(self, mock_crt_lu):
+        ssp_stor = self._get_ssp_stor()
+        img = dict(name='image-name', id='image-id', size=123,
+                   checksum='cksum')
+        # An image LU uploaded by an earlier release, named without the
+        # checksum
+        img_lu = pvm_stg.LU.bld(None, 'image_image_name', 123,
+                                typ=pvm_stg.LUType.IMAGE)
+        ssp_stor._ssp_wrap.logical_units.append(img_lu)
+        self.assertEqual(img_lu,
+                         ssp_stor._get_or_upload_image_lu(None, img))
+        # It is not uploaded again
+        self.assertFalse(mock_crt_lu.called)
+
+    def test_find_image_lu(self):
+        ssp_stor = self._get_ssp_stor()
+        ssp_wrap = mock.Mock(etag='etag1')
+        img_lu = mock.Mock(lu_type=pvm_stg.LUType.IMAGE)
+        img_lu.name = 'image_a'
+        marker = mock.Mock(lu_type=pvm_stg.LUType.DISK)
+        marker.name = ssp_stor._marker_name('image_a', claimed=1234)
+        # Not a marker
+        other = mock.Mock(lu_type=pvm_stg.LUType.DISK)
+        other.name = 'part_of_something'
+        ssp_wrap.logical_units = [img_lu, marker, other]
+
+        self.assertEqual((img_lu, marker),
+                         ssp_stor._find_image_lu(ssp_wrap, 'image_a'))
+        self.assertEqual((None, None),
+                         ssp_stor._find_image_lu(ssp_wrap, 'image_b'))
+
+        # Same etag - answered from the index, without scanning the LUs.
+        ssp_wrap.logical_units = []
+        self.assertEqual((img_lu, marker),
+                         ssp_stor._find_image_lu(ssp_wrap, 'image_a'))
+
+        # New etag - the index is rebuilt.
+        ssp_wrap.etag = 'etag2'
+        self.assertEqual((None, None),
+                         ssp_stor._find_image_lu(ssp_wrap, 'image_a'))
+
+    def test_marker_name(self):
+        name = ssp.SSPDiskAdapter._marker_name('image_a', claimed=1234.5)
+        self.assertEqual(1234, ssp.SSPDiskAdapter._marker_time(name))
+        self.assertIsNone(ssp.SSPDiskAdapter._marker_time('image_a'))
+        # Long image LU names that only differ past the LU name length
+        # limit still get their own marker.
+        long_name = 'image_' + 'x' * 100
+        self.assertNotEqual(
+            ssp.SSPDiskAdapter._marker_key(long_name + '_cksum1'),
+            ssp.SSPDiskAdapter._marker_key(long_name + '_cksum2'))
+        self.assertLessEqual(len(name), pvm_const.MaxLen.FILENAME_DEFAULT)
+
+    @mock.patch('time.sleep')
+    @mock.patch('pypowervm.tasks.storage.crt_lu')
+    @mock.patch('nova_powervm.virt.powervm.disk.ssp.SSPDiskAdapter.'
+                '_find_image_lu')
+    def test_get_or_upload_image_lu_wait(self, mock_find, mock_crt_lu,
+                                         mock_sleep):
+        """Another host is uploading the image."""
+        ssp_stor = self._get_ssp_stor()
+        img = dict(name='image-name', id='image-id', size=123)
+        resp = mock.Mock(status=pvm_const.HTTPStatus.ETAG_MISMATCH)
+        mock_crt_lu.side_effect = pvm_exc.HttpError(resp)
+        # The other host claims the upload first (our marker creation gets an
+        # etag mismatch).  Once its marker is removed, its LU is used.
+        marker = mock.Mock()
+        marker.name = ssp_stor._marker_name('image_image_name_image_id')
+        mock_find.side_effect = [(None, None), (None, marker),
+                                 ('img_lu', marker), ('img_lu', None)]
+        self.assertEqual('img_lu',
+                         ssp_stor._get_or_upload_image_lu(None, img))
+        self.assertEqual(1, mock_crt_lu.call_count)
+        self.assertEqual(2, mock_sleep.call_count)
+
+        # Times out if the upload never finishes (and the marker does not
+        # expire, ex. the clock of the other host is ahead).
+        marker.name = ssp_stor._marker_name('image_image_name_image_id',
+                                            claimed=time.time() + 3600)
+        self.flags(ssp_image_lock_timeout=0, group='powervm')
+        mock_find.side_effect = None
+        mock_find.return_value = (None, marker)
+        self.assertRaises(npvmex.ImageLUUploadTimeout,
+                          ssp_stor._get_or_upload_image_lu, None, img)
+
+    @mock.patch('pypowervm.tasks.storage.rm_ssp_storage')
+    @mock.patch('nova_powervm.virt.powervm.disk.ssp.SSPDiskAdapter.'
+                '_upload_image_lu')
+    @mock.patch('pypowervm.tasks.storage.crt_lu')
+    @mock.patch('nova_powervm.virt.powervm.disk.ssp.SSPDiskAdapter.'
+                '_find_image_lu')
+    def test_get_or_upload_image_lu_expired(self, mock_find, mock_crt_lu,
+                                            mock_upload, mock_rm_lu):
+        """The host that claimed the upload died."""
+        ssp_stor = self._get_ssp_stor()
+        img = dict(name='image-name', id='image-id', size=123)
+        marker = mock.Mock()
+        marker.name = ssp_stor._marker_name('image_image_name_image_id',
+                                            claimed=time.time() - 3600)
+        new_marker = mock.Mock()
+        mock_crt_lu.return_value = ('ssp', new_marker)
+        mock_find.side_effect = [(None, marker), (None, None)]
+        self.flags(ssp_image_lock_timeout=60, group='powervm')
+
+        # The expired marker is removed, and the upload claimed again.
+        self.assertEqual(mock_upload.return_value,
+                         ssp_stor._get_or_upload_image_lu(None, img))
+        mock_rm_lu.assert_called_once_with(mock.ANY, [marker],
+                                           del_unused_images=False)
+        mock_upload.assert_called_once_with(
+            None, img, 'image_image_name_image_id', new_marker)
+
+    @mock.patch('pypowervm.tasks.storage.rm_ssp_storage')
+    @mock.patch('pypowervm.tasks.storage.upload_new_lu')
+    @mock.patch('nova_powervm.virt.powervm.disk.driver.DiskAdapter.'
+                '_get_image_upload')
+    def test_upload_image_lu_fails(self, mock_stream, mock_upload,
+                                   mock_rm_lu):
+        ssp_stor = self._get_ssp_stor()
+        img = dict(name='image-name', id='image-id', size=123)
+        partial = pvm_stg.LU.bld(None, 'image_image_name_image_id', 1,
+                                 typ=pvm_stg.LUType.IMAGE)
+
+        def upload(*args):
+            ssp_stor._ssp_wrap.logical_units.append(partial)
+            raise ValueError()
+        mock_upload.side_effect = upload
+
+        self.assertRaises(ValueError, ssp_stor._upload_image_lu, None, img,
+                          'image_image_name_image_id', 'marker')
+        # Both the partial image LU and the marker are removed.
+        mock_rm_lu.assert_has_calls(
+            [mock.call(mock.ANY, [partial], del_unused_images=False),
+             mock.call(mock.ANY, ['marker'], del_unused_images=False)])
+
     @mock.patch('nova_powervm.virt.powervm.disk.ssp.SSPDiskAdapter.'
                 'vios_uuids')
     @mock.patch('pypowervm.tasks.scsi_mapper.build_vscsi_mapping')
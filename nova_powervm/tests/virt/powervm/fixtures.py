@@ -105,6 +105,12 @@ class PowerVMComputeDriver(fixtures.Fixture):
         # Set up the mock CPU stats (init_host uses it)
         self.useFixture(HostCPUStats())
 
+        # Do not start the background resource gathering
+        looping_call = mock.patch('oslo_service.loopingcall.'
+                                  'FixedIntervalLoopingCall')
+        looping_call.start()
+        self.addCleanup(looping_call.stop)
+
         self.drv = driver.PowerVMDriver(fake.FakeVirtAPI())
         self.drv.adapter = self.useFixture(pvm_fx.AdapterFx()).adpt
         self._init_host()
@@ -112,3 +118,4 @@ class PowerVMComputeDriver(fixtures.Fixture):
 
         disk_adpt = self.useFixture(DiskAdapter())
         self.drv.disk_dvr = disk_adpt.std_disk_adpt
+        self.drv.resource_snapshot.disk_dvr = self.drv.disk_dvr
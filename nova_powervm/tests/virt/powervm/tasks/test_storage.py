@@ -130,3 +130,29 @@ class TestStorage(test.TestCase):
         disk_dvr.disconnect_disk_from_mgmt.assert_called_with('vios_uuid',
                                                               'stg_name')
         mock_rm.assert_called_with('/dev/disk')
+
+    def test_connect_volumes(self):
+        class VolA(mock.MagicMock):
+            pass
+
+        class VolB(mock.MagicMock):
+            pass
+
+        vol_a1, vol_a2, vol_b = VolA(), VolA(), VolB()
+        for vol_drv in (vol_a1, vol_a2, vol_b):
+            vol_drv.connection_info = {'data': {'volume_id': 'vol'}}
+        task = tf_stg.ConnectVolumes([vol_a1, vol_b, vol_a2])
+
+        # The volumes are connected in one batch per connection type.
+        task.execute()
+        vol_a1.connect_volumes.assert_called_once_with([vol_a1, vol_a2])
+        vol_b.connect_volumes.assert_called_once_with([vol_b])
+        self.assertFalse(vol_a2.connect_volumes.called)
+
+        # Each volume is disconnected on revert, even if one fails.
+        vol_a1.disconnect_volume.side_effect = npvmex.VolumeDetachFailed(
+            volume_id='vol', instance_name='inst', reason='Test Case')
+        task.revert(None, None)
+        for vol_drv in (vol_a1, vol_a2, vol_b):
+            vol_drv.reset_stg_ftsk.assert_called_once_with()
+            vol_drv.disconnect_volume.assert_called_once_with()
@@ -0,0 +1,272 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import copy
+
+import mock
+
+from nova.compute import power_state
+from nova import exception
+from nova import test
+from pypowervm import const as pvm_const
+from pypowervm import exceptions as pvm_exc
+from pypowervm.tests import test_fixtures as pvm_fx
+from pypowervm.tests.test_utils import pvmhttp
+from pypowervm.wrappers import virtual_io_server as pvm_vios
+
+from nova_powervm.virt.powervm import cache
+from nova_powervm.virt.powervm import vm
+
+LPAR_HTTPRESP_FILE = "lpar.txt"
+LPAR_UUID = '089FFB20-5D19-4A8C-BB80-13650627D985'
+VIOS_HTTPRESP_FILE = "fake_vios_feed2.txt"
+
+
+class TestLPARStateCache(test.TestCase):
+
+    def setUp(self):
+        super(TestLPARStateCache, self).setUp()
+        self.apt = self.useFixture(pvm_fx.AdapterFx(
+            traits=pvm_fx.LocalPVMTraits)).adpt
+        self.resp = pvmhttp.load_pvm_resp(LPAR_HTTPRESP_FILE,
+                                          adapter=self.apt).response
+        self.resp.status = 200
+        self.resp.etag = 'etag1'
+        self.apt.read.return_value = self.resp
+        # The response to a read of a single LPAR (the first in the feed)
+        self.lpar_resp = copy.copy(self.resp)
+        self.lpar_resp.entry = self.resp.feed.entries[0]
+        self.lpar_resp.feed = None
+        self.lpar_resp.etag = 'lpar_etag1'
+        self.not_found = pvm_exc.HttpError(
+            mock.Mock(status=404, reason='Not Found', body=''))
+
+        self.lpar_cache = cache.LPARStateCache(self.apt, 'host_uuid', ttl=30)
+
+    def test_get_qp(self):
+        # First lookup loads the feed
+        state = self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE)
+        self.assertEqual('not activated', state)
+        self.assertEqual(1, self.apt.read.call_count)
+        self.apt.read.assert_called_with(
+            'ManagedSystem', root_id='host_uuid',
+            child_type='LogicalPartition', etag=None)
+
+        # Subsequent lookups (on any LPAR) are served from the cache.
+        self.assertIsNotNone(self.lpar_cache.get_qp(LPAR_UUID, cache.QP_MEM))
+        self.assertIsNotNone(self.lpar_cache.get_qp(LPAR_UUID.lower(),
+                                                    cache.QP_PROCS))
+        self.assertEqual(1, self.apt.read.call_count)
+
+    def test_get_qp_not_found(self):
+        self.apt.read.side_effect = [self.resp, self.not_found]
+        self.assertRaises(exception.InstanceNotFound, self.lpar_cache.get_qp,
+                          'bogus-uuid', cache.QP_STATE)
+        # Missing LPAR is looked up on its own, not by reading the feed
+        self.assertEqual(2, self.apt.read.call_count)
+        self.apt.read.assert_called_with('LogicalPartition',
+                                         root_id='BOGUS-UUID')
+
+        # Any other error is raised
+        self.apt.read.side_effect = ValueError()
+        self.assertRaises(ValueError, self.lpar_cache.get_qp, 'bogus-uuid',
+                          cache.QP_STATE)
+
+    @mock.patch('time.time')
+    def test_ttl_revalidation(self, mock_time):
+        mock_time.return_value = 100
+        self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE)
+        self.assertEqual(1, self.apt.read.call_count)
+
+        # Within the TTL - no REST call
+        mock_time.return_value = 129
+        self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE)
+        self.assertEqual(1, self.apt.read.call_count)
+
+        # TTL expired.  The feed did not change (304), data is kept.
+        mock_time.return_value = 131
+        not_modified = mock.Mock(status=pvm_const.HTTPStatus.NO_CHANGE)
+        self.apt.read.return_value = not_modified
+        self.assertEqual('not activated',
+                         self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE))
+        self.assertEqual(2, self.apt.read.call_count)
+        self.apt.read.assert_called_with(
+            'ManagedSystem', root_id='host_uuid',
+            child_type='LogicalPartition', etag='etag1')
+
+    def test_invalidate(self):
+        self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE)
+
+        # Only the invalidated LPAR is read again
+        self.apt.read.return_value = self.lpar_resp
+        self.lpar_cache.invalidate(LPAR_UUID.lower())
+        self.assertEqual('not activated',
+                         self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE))
+        self.assertEqual(2, self.apt.read.call_count)
+        self.apt.read.assert_called_with('LogicalPartition',
+                                         root_id=LPAR_UUID)
+        self.assertEqual('lpar_etag1', self.lpar_cache.get_etag(LPAR_UUID))
+        self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE)
+        self.assertEqual(2, self.apt.read.call_count)
+
+        # The feed etag is kept, so revalidation is still conditional.
+        self.apt.read.return_value = mock.Mock(
+            status=pvm_const.HTTPStatus.NO_CHANGE)
+        self.lpar_cache.refresh(force=True)
+        self.apt.read.assert_called_with(
+            'ManagedSystem', root_id='host_uuid',
+            child_type='LogicalPartition', etag='etag1')
+
+        # A deleted LPAR is dropped from the cache
+        self.apt.read.side_effect = self.not_found
+        self.lpar_cache.invalidate(LPAR_UUID)
+        self.assertRaises(exception.InstanceNotFound, self.lpar_cache.get_qp,
+                          LPAR_UUID, cache.QP_STATE)
+        self.assertIsNone(self.lpar_cache.get_etag(LPAR_UUID))
+
+    def test_invalidate_all(self):
+        self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE)
+        self.lpar_cache.invalidate()
+        self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE)
+        self.assertEqual(2, self.apt.read.call_count)
+        self.apt.read.assert_called_with(
+            'ManagedSystem', root_id='host_uuid',
+            child_type='LogicalPartition', etag='etag1')
+
+    def test_instance_info(self):
+        inst_info = vm.InstanceInfo(self.apt, 'inst_name', LPAR_UUID,
+                                    lpar_cache=self.lpar_cache)
+        self.assertEqual(power_state.SHUTDOWN, inst_info.state)
+        self.assertIsNotNone(inst_info.mem_kb)
+        self.assertIsNotNone(inst_info.num_cpu)
+        # All three properties came from a single feed read
+        self.assertEqual(1, self.apt.read.call_count)
+
+    @mock.patch('nova_powervm.virt.powervm.vm.get_vm_qp')
+    def test_instance_info_disabled(self, mock_qp):
+        self.lpar_cache.ttl = 0
+        mock_qp.return_value = 'running'
+        inst_info = vm.InstanceInfo(self.apt, 'inst_name', LPAR_UUID,
+                                    lpar_cache=self.lpar_cache)
+        self.assertEqual(power_state.RUNNING, inst_info.state)
+        mock_qp.assert_called_once_with(self.apt, LPAR_UUID, 'PartitionState')
+        self.assertEqual(0, self.apt.read.call_count)
+
+    def test_refresh_lpar(self):
+        self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE)
+        self.lpar_cache._lpars[LPAR_UUID][cache.QP_STATE] = 'running'
+
+        # The entry is replaced.  The old and new values are returned.
+        self.apt.read.return_value = self.lpar_resp
+        old_qps, new_qps = self.lpar_cache.refresh_lpar(LPAR_UUID.lower())
+        self.apt.read.assert_called_with('LogicalPartition',
+                                         root_id=LPAR_UUID)
+        self.assertEqual('running', old_qps[cache.QP_STATE])
+        self.assertEqual('not activated', new_qps[cache.QP_STATE])
+        self.assertEqual('lpar_etag1', self.lpar_cache.get_etag(LPAR_UUID))
+
+        # An LPAR that no longer exists is removed
+        self.apt.read.side_effect = self.not_found
+        self.assertEqual((new_qps, None),
+                         self.lpar_cache.refresh_lpar(LPAR_UUID))
+        self.assertIsNone(self.lpar_cache.get_etag(LPAR_UUID))
+        self.assertEqual((None, None),
+                         self.lpar_cache.refresh_lpar(LPAR_UUID))
+
+        # Any other error is raised
+        self.apt.read.side_effect = ValueError()
+        self.assertRaises(ValueError, self.lpar_cache.refresh_lpar,
+                          LPAR_UUID)
+
+    def test_event_driven(self):
+        self.lpar_cache.event_driven = True
+        self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE)
+
+        # No revalidation, regardless of the TTL
+        with mock.patch('time.time') as mock_time:
+            mock_time.return_value = 10 ** 10
+            self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE)
+        self.assertEqual(1, self.apt.read.call_count)
+
+        # Once removed, only that LPAR is looked up again.
+        self.lpar_cache.remove(LPAR_UUID)
+        self.assertIsNone(self.lpar_cache.get_etag(LPAR_UUID))
+        self.apt.read.return_value = self.lpar_resp
+        self.lpar_cache.get_qp(LPAR_UUID, cache.QP_STATE)
+        self.assertEqual(2, self.apt.read.call_count)
+        self.apt.read.assert_called_with('LogicalPartition',
+                                         root_id=LPAR_UUID)
+        self.assertEqual('etag1', self.lpar_cache._etag)
+
+
+class TestVIOSFeedCache(test.TestCase):
+
+    def setUp(self):
+        super(TestVIOSFeedCache, self).setUp()
+        self.apt = self.useFixture(pvm_fx.AdapterFx()).adpt
+        self.resp = pvmhttp.load_pvm_resp(VIOS_HTTPRESP_FILE).get_response()
+        self.resp.status = 200
+        self.resp.etag = 'etag1'
+        self.apt.read.return_value = self.resp
+
+        self.feed_cache = cache.VIOSFeedCache()
+
+    def test_get(self):
+        xag = [pvm_vios.VIOS.xags.STORAGE]
+        vioses1 = self.feed_cache.get(self.apt, 'host_uuid', xag=xag)
+        self.apt.read.assert_called_with(
+            'ManagedSystem', root_id='host_uuid',
+            child_type='VirtualIOServer', xag=xag, etag=None)
+        self.assertEqual(1, self.feed_cache.misses)
+
+        # The feed did not change (304).  The cached feed is returned, as
+        # a separate copy.
+        self.apt.read.return_value = mock.Mock(
+            status=pvm_const.HTTPStatus.NO_CHANGE)
+        vioses2 = self.feed_cache.get(self.apt, 'host_uuid', xag=xag)
+        self.apt.read.assert_called_with(
+            'ManagedSystem', root_id='host_uuid',
+            child_type='VirtualIOServer', xag=xag, etag='etag1')
+        self.assertEqual(1, self.feed_cache.hits)
+        self.assertEqual([v.uuid for v in vioses1], [v.uuid for v in vioses2])
+        self.assertIsNot(vioses1[0].entry, vioses2[0].entry)
+        vioses3 = self.feed_cache.get(self.apt, 'host_uuid', xag=xag)
+        self.assertIsNot(vioses2[0].entry, vioses3[0].entry)
+
+    def test_get_by_xag(self):
+        self.feed_cache.get(self.apt, 'host_uuid', xag=['a', 'b'])
+        # Same set of XAGs (in another order) is the same feed
+        self.feed_cache.get(self.apt, 'host_uuid', xag=['b', 'a'])
+        self.assertEqual('etag1', self.apt.read.call_args[1]['etag'])
+        # Others are not
+        self.feed_cache.get(self.apt, 'host_uuid', xag=['a'])
+        self.assertIsNone(self.apt.read.call_args[1]['etag'])
+        self.feed_cache.get(self.apt, 'host2', xag=['a', 'b'])
+        self.assertIsNone(self.apt.read.call_args[1]['etag'])
+
+    def test_invalidate(self):
+        self.feed_cache.get(self.apt, 'host_uuid')
+        self.feed_cache.get(self.apt, 'host2')
+        self.feed_cache.invalidate('host_uuid')
+        self.feed_cache.get(self.apt, 'host_uuid')
+        self.assertIsNone(self.apt.read.call_args[1]['etag'])
+        self.feed_cache.get(self.apt, 'host2')
+        self.assertEqual('etag1', self.apt.read.call_args[1]['etag'])
+
+        self.feed_cache.invalidate()
+        self.feed_cache.get(self.apt, 'host2')
+        self.assertIsNone(self.apt.read.call_args[1]['etag'])
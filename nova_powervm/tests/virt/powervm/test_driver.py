@@ -22,6 +22,7 @@ from oslo_config import cfg
 from oslo_serialization import jsonutils
 
 from nova import block_device as nova_block_device
+from nova.compute import power_state
 from nova import exception as exc
 from nova import objects
 from nova.objects import block_device as bdmobj
@@ -43,7 +44,9 @@ from nova_powervm.tests.virt import powervm
 from nova_powervm.tests.virt.powervm import fixtures as fx
 from nova_powervm.virt.powervm import driver
 from nova_powervm.virt.powervm import exception as p_exc
+from nova_powervm.virt.powervm import host as pvm_host
 from nova_powervm.virt.powervm import live_migration as lpm
+from nova_powervm.virt.powervm import vm
 
 MS_HTTPRESP_FILE = "managedsystem.txt"
 MS_NAME = 'HV4'
@@ -79,6 +82,7 @@ class TestPowerVMDriver(test.TestCase):
         self.wrapper = pvm_ms.System.wrap(entries[0])
 
         self.flags(disk_driver='localdisk', group='powervm')
+        self.flags(spawn_coalesce_window=0, group='powervm')
         self.drv_fix = self.useFixture(fx.PowerVMComputeDriver())
         self.drv = self.drv_fix.drv
         self.apt = self.drv.adapter
@@ -148,6 +152,7 @@ class TestPowerVMDriver(test.TestCase):
         mock_getuuid.return_value = '1234'
         info = self.drv.get_info(inst)
         self.assertEqual(info.id, '1234')
+        self.assertEqual(self.drv.lpar_cache, info._lpar_cache)
 
         # list_instances()
         tgt_mock = 'nova_powervm.virt.powervm.vm.get_lpar_names'
@@ -157,12 +162,68 @@ class TestPowerVMDriver(test.TestCase):
             inst_list = self.drv.list_instances()
             self.assertEqual(fake_lpar_list, inst_list)
 
+        # list_instance_uuids()
+        tgt_mock = 'nova_powervm.virt.powervm.vm.get_lpar_uuids'
+        with mock.patch(tgt_mock) as mock_get_list:
+            mock_get_list.return_value = [
+                '089FFB20-5D19-4A8C-BB80-13650627D985']
+            self.assertEqual(['089ffb20-5d19-4a8c-bb80-13650627d985',
+                              '889ffb20-5d19-4a8c-bb80-13650627d985'],
+                             self.drv.list_instance_uuids())
+
         # instance_exists()
         tgt_mock = 'nova_powervm.virt.powervm.vm.instance_exists'
         with mock.patch(tgt_mock) as mock_inst_exists:
             mock_inst_exists.side_effect = [True, False]
             self.assertTrue(self.drv.instance_exists(mock.Mock()))
             self.assertFalse(self.drv.instance_exists(mock.Mock()))
+            mock_inst_exists.assert_called_with(
+                self.apt, mock.ANY, self.drv.host_uuid,
+                lpar_cache=self.drv.lpar_cache)
+
+    def test_event_subscription(self):
+        # init_host subscribed the handler to the event feed
+        listener = self.apt.session.get_event_listener.return_value
+        listener.subscribe.assert_called_once_with(self.drv.event_handler)
+        self.assertTrue(self.drv.lpar_cache.event_driven)
+
+        self.drv.cleanup_host('FakeHost')
+        listener.unsubscribe.assert_called_once_with(mock.ANY)
+        self.assertIsNone(self.drv.event_handler)
+        self.assertFalse(self.drv.lpar_cache.event_driven)
+
+        # Falls back to the TTL if the listener can not be set up
+        listener.subscribe.side_effect = ValueError()
+        self.drv._subscribe_events()
+        self.assertIsNone(self.drv.event_handler)
+        self.assertFalse(self.drv.lpar_cache.event_driven)
+
+        # Not subscribed if disabled
+        listener.subscribe.reset_mock()
+        self.flags(lpar_state_events=False, group='powervm')
+        self.drv._subscribe_events()
+        self.assertFalse(listener.subscribe.called)
+
+    def test_background_refresh(self):
+        # init_host started the background refreshes; cleanup_host stops them
+        self.drv.host_cpu_stats.start.assert_called_once_with()
+        with mock.patch.object(self.drv.resource_snapshot,
+                               'stop') as mock_snap_stop:
+            self.drv.cleanup_host('FakeHost')
+        self.drv.host_cpu_stats.stop.assert_called_once_with()
+        mock_snap_stop.assert_called_once_with()
+
+    @mock.patch('nova_powervm.virt.powervm.vm.get_pvm_uuid')
+    def test_invalidate_lpar_cache(self, mock_pvmuuid):
+        self.drv.lpar_cache = mock.Mock(event_driven=False)
+        self.drv._invalidate_lpar_cache(mock.sentinel.inst)
+        self.drv.lpar_cache.invalidate.assert_called_once_with(
+            mock_pvmuuid.return_value)
+
+        # The events keep the cache current
+        self.drv.lpar_cache = mock.Mock(event_driven=True)
+        self.drv._invalidate_lpar_cache(mock.sentinel.inst)
+        self.assertFalse(self.drv.lpar_cache.invalidate.called)
 
     @mock.patch('nova_powervm.virt.powervm.tasks.storage.'
                 'CreateAndConnectCfgDrive.execute')
@@ -208,6 +269,106 @@ class TestPowerVMDriver(test.TestCase):
         self.assertFalse(mock_crt_cfg_drv.called)
         self.scrub_stg.assert_called_with([9], self.stg_ftsk, lpars_exist=True)
 
+    @mock.patch('nova_powervm.virt.powervm.vios.FeedTaskCoalescer.run')
+    @mock.patch('nova_powervm.virt.powervm.vios.FeedTaskCoalescer.'
+                'build_feed_task')
+    @mock.patch('nova_powervm.virt.powervm.tasks.storage.CreateDiskForImg'
+                '.execute')
+    @mock.patch('nova_powervm.virt.powervm.driver.PowerVMDriver.'
+                '_is_booted_from_volume')
+    @mock.patch('nova_powervm.virt.powervm.tasks.network.PlugMgmtVif.execute')
+    @mock.patch('nova_powervm.virt.powervm.tasks.network.PlugVifs.execute')
+    @mock.patch('nova.virt.configdrive.required_by')
+    @mock.patch('nova.objects.flavor.Flavor.get_by_id')
+    @mock.patch('pypowervm.tasks.power.power_on')
+    def test_spawn_coalesced(
+        self, mock_pwron, mock_get_flv, mock_cfg_drv, mock_plug_vifs,
+        mock_plug_mgmt_vif, mock_boot_from_vol, mock_crt_disk_img,
+        mock_build_ftsk, mock_run):
+        """Validates spawn runs the storage FeedTask through the coalescer."""
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        inst.system_metadata = {'image_os_distro': 'rhel'}
+        mock_get_flv.return_value = inst.get_flavor()
+        mock_cfg_drv.return_value = False
+        mock_boot_from_vol.return_value = False
+        mock_build_ftsk.return_value = self.stg_ftsk
+        self.drv.stg_coalescer.window = 0.1
+
+        self.drv.spawn('context', inst, mock.Mock(),
+                       'injected_files', 'admin_password')
+
+        xag = [pvm_vios.VIOS.xags.SCSI_MAPPING]
+        mock_build_ftsk.assert_called_once_with(xag=xag)
+        self.assertFalse(self.build_tx_feed.called)
+        mock_run.assert_called_once_with(self.stg_ftsk, xag=xag)
+        self.scrub_stg.assert_called_with([9], self.stg_ftsk, lpars_exist=True)
+        self.assertTrue(mock_pwron.called)
+
+    @mock.patch('nova_powervm.virt.powervm.driver.PowerVMDriver.'
+                '_run_graph_flow')
+    @mock.patch('nova_powervm.virt.powervm.driver.PowerVMDriver.'
+                '_is_booted_from_volume')
+    @mock.patch('nova.virt.configdrive.required_by')
+    @mock.patch('nova.objects.flavor.Flavor.get_by_id')
+    def test_spawn_flow_dependencies(self, mock_get_flv, mock_cfg_drv,
+                                     mock_boot_from_vol, mock_run_flow):
+        """Validates which spawn steps may run in parallel.
+
+        The wall-clock gain is measured by the benchmark harness.
+        """
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        inst.system_metadata = {'image_os_distro': 'rhel'}
+        mock_get_flv.return_value = inst.get_flavor()
+        mock_cfg_drv.return_value = False
+        mock_boot_from_vol.return_value = False
+
+        self.drv.spawn('context', inst, mock.Mock(),
+                       'injected_files', 'admin_password')
+        flow = mock_run_flow.call_args[0][0]
+        tasks = {type(tsk).__name__: tsk for tsk in flow}
+        self.assertEqual(
+            {'Create', 'PlugVifs', 'PlugMgmtVif', 'CreateDiskForImg',
+             'ConnectDisk', 'FeedTask', 'PowerOn'}, set(tasks))
+
+        # The tasks each task depends on, directly or not
+        preds = {tsk: set() for tsk in flow}
+        for _i in range(len(preds)):
+            for src, dst, _meta in flow.iter_links():
+                preds[dst] |= preds[src] | {src}
+
+        def depends(name, *on):
+            return {tasks[dep] for dep in on} <= preds[tasks[name]]
+
+        # The image upload does not wait on the LPAR creation or the network
+        # plumbing, nor do they wait on it.
+        img_task = tasks['CreateDiskForImg']
+        self.assertEqual(set(), preds[img_task])
+        for name in ('Create', 'PlugVifs', 'PlugMgmtVif'):
+            self.assertNotIn(img_task, preds[tasks[name]])
+        # The network plumbing needs the LPAR.
+        self.assertTrue(depends('PlugMgmtVif', 'Create', 'PlugVifs'))
+
+        # The disk is connected to the LPAR, through the storage FeedTask,
+        # before the power on.
+        self.assertTrue(depends('ConnectDisk', 'Create', 'CreateDiskForImg'))
+        self.assertTrue(depends('FeedTask', 'Create', 'ConnectDisk'))
+        self.assertTrue(depends('PowerOn', 'FeedTask', 'PlugVifs',
+                                'PlugMgmtVif'))
+
+    @mock.patch('taskflow.engines.run')
+    def test_run_graph_flow(self, mock_run):
+        self.flags(flow_max_workers=1, group='powervm')
+        self.drv._run_graph_flow('flow')
+        mock_run.assert_called_once_with('flow')
+
+        mock_run.reset_mock()
+        self.flags(flow_max_workers=3, group='powervm')
+        self.drv._run_graph_flow('flow')
+        mock_run.assert_called_once_with('flow', engine='parallel',
+                                         executor=mock.ANY)
+        self.assertIsInstance(mock_run.call_args[1]['executor'],
+                              pvm_tx.ContextThreadPoolExecutor)
+
     @mock.patch('nova_powervm.virt.powervm.tasks.network.PlugMgmtVif.execute')
     @mock.patch('nova_powervm.virt.powervm.tasks.network.PlugVifs.execute')
     @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
@@ -290,8 +451,9 @@ class TestPowerVMDriver(test.TestCase):
         # Power on was called
         self.assertTrue(mock_pwron.called)
 
-        # Check that the connect volume was called
-        self.assertEqual(2, self.vol_drv.connect_volume.call_count)
+        # Check that the volumes were connected in one batch
+        self.vol_drv.connect_volumes.assert_called_once_with(
+            [self.vol_drv, self.vol_drv])
 
         # Make sure the save was invoked
         self.assertEqual(2, mock_save.call_count)
@@ -353,8 +515,9 @@ class TestPowerVMDriver(test.TestCase):
         # Power on was called
         self.assertTrue(mock_pwron.called)
 
-        # Check that the connect volume was called
-        self.assertEqual(2, self.vol_drv.connect_volume.call_count)
+        # Check that the volumes were connected in one batch
+        self.vol_drv.connect_volumes.assert_called_once_with(
+            [self.vol_drv, self.vol_drv])
 
         self.scrub_stg.assert_called_with([9], self.stg_ftsk, lpars_exist=True)
 
@@ -403,8 +566,9 @@ class TestPowerVMDriver(test.TestCase):
         # Power on was called
         self.assertTrue(mock_pwron.called)
 
-        # Check that the connect volume was called
-        self.assertEqual(2, self.vol_drv.connect_volume.call_count)
+        # Check that the volumes were connected in one batch
+        self.vol_drv.connect_volumes.assert_called_once_with(
+            [self.vol_drv, self.vol_drv])
 
         # Make sure the BDM save was invoked twice.
         self.assertEqual(2, mock_save.call_count)
@@ -442,7 +606,7 @@ class TestPowerVMDriver(test.TestCase):
         # Create LPAR was called
         self.crt_lpar.assert_called_with(self.apt, self.drv.host_wrapper,
                                          inst, my_flavor)
-        self.assertEqual(2, self.vol_drv.connect_volume.call_count)
+        self.assertEqual(1, self.vol_drv.connect_volumes.call_count)
 
         # Power on was called
         self.assertTrue(mock_pwron.called)
@@ -502,8 +666,9 @@ class TestPowerVMDriver(test.TestCase):
         # Power on was called
         self.assertTrue(mock_pwron.called)
 
-        # Check that the connect volume was called
-        self.assertEqual(2, self.vol_drv.connect_volume.call_count)
+        # Check that the volumes were connected in one batch
+        self.vol_drv.connect_volumes.assert_called_once_with(
+            [self.vol_drv, self.vol_drv])
 
         # Make sure the BDM save was invoked twice.
         self.assertEqual(2, mock_save.call_count)
@@ -616,7 +781,7 @@ class TestPowerVMDriver(test.TestCase):
 
         # Have the connect fail.  Also fail the disconnect on revert.  Should
         # not block the rollback.
-        self.vol_drv.connect_volume.side_effect = exc.Forbidden()
+        self.vol_drv.connect_volumes.side_effect = exc.Forbidden()
         self.vol_drv.disconnect_volume.side_effect = p_exc.VolumeDetachFailed(
             volume_id='1', instance_name=inst.name, reason='Test Case')
 
@@ -628,7 +793,7 @@ class TestPowerVMDriver(test.TestCase):
         # Create LPAR was called
         self.crt_lpar.assert_called_with(self.apt, self.drv.host_wrapper,
                                          inst, my_flavor)
-        self.assertEqual(1, self.vol_drv.connect_volume.call_count)
+        self.assertEqual(1, self.vol_drv.connect_volumes.call_count)
 
         # Power on should not be called.  Shouldn't get that far in flow.
         self.assertFalse(mock_pwron.called)
@@ -961,10 +1126,98 @@ class TestPowerVMDriver(test.TestCase):
                     'op': 'fake_op'}
         mock_log.info.assert_called_with(entry, msg_dict)
 
+    @mock.patch('nova_powervm.virt.powervm.vm.get_cnas')
+    @mock.patch('nova.virt.configdrive.required_by')
+    @mock.patch('nova_powervm.virt.powervm.driver.PowerVMDriver.get_info')
+    def test_get_instance_diagnostics(self, mock_info, mock_cfg_drv,
+                                      mock_get_cnas):
+        inst = objects.Instance(**powervm.TEST_INSTANCE)
+        mock_get_cnas.return_value = [mock.Mock(slot=2, mac='FA163E5D0C02')]
+        mock_info.return_value = mock.Mock(state=power_state.RUNNING)
+        mock_cfg_drv.return_value = True
+        pvm_uuid = vm.get_pvm_uuid(inst)
+        nic = pvm_host.NicCounters('U8247.22L.2125D4A-V2-C2', 2227, 10000,
+                                   100, 10, 20, 5)
+        counters = pvm_host.LparCounters(1000, 2048, 1024, (nic,))
+        mock_metrics = self.drv.host_cpu_stats.get_lpar_metrics
+        mock_metrics.return_value = {
+            pvm_uuid: {'counters': counters, 'cpu_time_ns': 500}}
+
+        diags = self.drv.get_instance_diagnostics(inst).serialize()
+        mock_metrics.assert_called_once_with(pvm_uuid)
+        self.assertEqual('running', diags['state'])
+        self.assertTrue(diags['config_drive'])
+        self.assertEqual([{'time': 500}], diags['cpu_details'])
+        self.assertEqual({'maximum': 2048, 'used': 1024},
+                         diags['memory_details'])
+        self.assertEqual(1, len(diags['nic_details']))
+        nic_diags = diags['nic_details'][0]
+        self.assertEqual('fa:16:3e:5d:0c:02', nic_diags['mac_address'])
+        self.assertEqual(10000, nic_diags['rx_octets'])
+        self.assertEqual(100, nic_diags['tx_octets'])
+        self.assertEqual(5, nic_diags['rx_drop'])
+
+        # No metrics for the VM
+        mock_metrics.return_value = {}
+        diags = self.drv.get_instance_diagnostics(inst).serialize()
+        self.assertEqual('running', diags['state'])
+        self.assertEqual([], diags['cpu_details'])
+        self.assertEqual([], diags['nic_details'])
+
+    @mock.patch('nova_powervm.virt.powervm.vm.get_cnas')
+    def test_get_all_bw_counters(self, mock_get_cnas):
+        inst1 = objects.Instance(**powervm.TEST_INSTANCE)
+        inst2 = objects.Instance(**dict(
+            powervm.TEST_INSTANCE,
+            uuid='9cb1b2d7-3f23-4a2c-8b5f-4d2e2dcb10f4'))
+        nics = (pvm_host.NicCounters('U8247.22L.2125D4A-V2-C3', 1, 100, 200,
+                                     1, 2, 0),
+                pvm_host.NicCounters('U8247.22L.2125D4A-V2-C4', 2, 300, 400,
+                                     3, 4, 0))
+        self.drv.host_cpu_stats.get_lpar_metrics.return_value = {
+            vm.get_pvm_uuid(inst1): {
+                'counters': pvm_host.LparCounters(0, 0, 0, nics)}}
+        mock_get_cnas.return_value = [mock.Mock(slot=3, mac='FA163E000003'),
+                                      mock.Mock(slot=4, mac='FA163E000004')]
+
+        expected = [{'uuid': inst1.uuid, 'mac_address': 'fa:16:3e:00:00:03',
+                     'bw_in': 100, 'bw_out': 200},
+                    {'uuid': inst1.uuid, 'mac_address': 'fa:16:3e:00:00:04',
+                     'bw_in': 300, 'bw_out': 400}]
+        self.assertEqual(expected,
+                         self.drv.get_all_bw_counters([inst1, inst2]))
+        # One query for all of the instances
+        self.drv.host_cpu_stats.get_lpar_metrics.assert_called_once_with()
+        mock_get_cnas.assert_called_once_with(self.drv.adapter, inst1,
+                                              self.drv.host_uuid)
+
+        # The MAC addresses are cached
+        self.assertEqual(expected,
+                         self.drv.get_all_bw_counters([inst1, inst2]))
+        self.assertEqual(1, mock_get_cnas.call_count)
+
+        # A new adapter reads them again.  One without a MAC is left out.
+        nics += (pvm_host.NicCounters('U8247.22L.2125D4A-V2-C5', 3, 1, 1, 1,
+                                      1, 0),)
+        self.drv.host_cpu_stats.get_lpar_metrics.return_value = {
+            vm.get_pvm_uuid(inst1): {
+                'counters': pvm_host.LparCounters(0, 0, 0, nics)}}
+        self.assertEqual(expected,
+                         self.drv.get_all_bw_counters([inst1, inst2]))
+        self.assertEqual(2, mock_get_cnas.call_count)
+        self.drv.get_all_bw_counters([inst1, inst2])
+        self.assertEqual(2, mock_get_cnas.call_count)
+
+        # The adapters of a deleted VM are forgotten
+        self.drv.get_all_bw_counters([inst2])
+        self.assertEqual({}, self.drv._cna_macs)
+
     def test_host_resources(self):
         # Set the return value of None so we use the cached value in the drv
         self.apt.read.return_value = None
-        self.drv.host_wrapper = self.wrapper
+        self.drv.resource_snapshot.host_wrapper = self.wrapper
+        self.drv.disk_dvr.capacity_info = (100.0, 40.0)
+        self.flags(resource_snapshot_interval=0, group='powervm')
 
         stats = self.drv.get_available_resource('nodename')
         self.assertIsNotNone(stats)
@@ -975,6 +1228,7 @@ class TestPowerVMDriver(test.TestCase):
         for fld in fields:
             value = stats.get(fld, None)
             self.assertIsNotNone(value)
+        self.assertEqual(self.wrapper, self.drv.host_wrapper)
 
     @mock.patch('pypowervm.wrappers.logical_partition.LPAR.can_modify_io')
     @mock.patch('nova_powervm.virt.powervm.vm.crt_secure_rmc_vif')
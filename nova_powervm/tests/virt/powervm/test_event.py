@@ -0,0 +1,121 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+import mock
+
+from nova import test
+from nova.virt import event
+from pypowervm import exceptions as pvm_exc
+
+from nova_powervm.virt.powervm import cache
+from nova_powervm.virt.powervm import event as pvm_event
+
+LPAR_UUID = '089FFB20-5D19-4A8C-BB80-13650627D985'
+LPAR_URI = ('https://9.1.2.3:12443/rest/api/uom/ManagedSystem/'
+            'c5d782c7-44e4-3086-ad15-b16fb039d63b/LogicalPartition/' +
+            LPAR_UUID)
+
+
+class TestPowerVMLPAREventHandler(test.TestCase):
+
+    def setUp(self):
+        super(TestPowerVMLPAREventHandler, self).setUp()
+        self.drv = mock.Mock()
+        self.lpar_cache = mock.Mock()
+        # The LPAR was not in the cache
+        self.lpar_cache.refresh_lpar.return_value = (
+            None, {cache.QP_STATE: 'not activated'})
+        self.handler = pvm_event.PowerVMLPAREventHandler(self.drv,
+                                                         self.lpar_cache)
+
+        get_inst_p = mock.patch('nova_powervm.virt.powervm.vm.get_instance')
+        self.mock_get_inst = get_inst_p.start()
+        self.addCleanup(get_inst_p.stop)
+        self.inst = mock.Mock(uuid='inst_uuid')
+        self.mock_get_inst.return_value = self.inst
+
+    def test_lpar_uuid_from_uri(self):
+        self.assertEqual(LPAR_UUID, pvm_event._lpar_uuid_from_uri(LPAR_URI))
+        self.assertEqual(LPAR_UUID, pvm_event._lpar_uuid_from_uri(
+            LPAR_URI.lower() + '?group=None'))
+        self.assertIsNone(pvm_event._lpar_uuid_from_uri(
+            LPAR_URI + '/ClientNetworkAdapter/'
+            '6445b54b-b9dc-3bc2-b1d3-f8cc22ba95b8'))
+        self.assertIsNone(pvm_event._lpar_uuid_from_uri(
+            'https://9.1.2.3:12443/rest/api/uom/VirtualIOServer/' +
+            LPAR_UUID))
+
+    def test_process_new_state(self):
+        self.handler.process({LPAR_URI: 'invalidate'})
+        self.lpar_cache.refresh_lpar.assert_called_once_with(LPAR_UUID)
+
+        # LPAR was not previously known; its state is reported.
+        self.mock_get_inst.assert_called_once_with(mock.ANY, LPAR_UUID)
+        lc_event = self.drv.emit_event.call_args[0][0]
+        self.assertEqual('inst_uuid', lc_event.get_instance_uuid())
+        self.assertEqual(event.EVENT_LIFECYCLE_STOPPED,
+                         lc_event.get_transition())
+
+    def test_process_state_unchanged(self):
+        self.lpar_cache.refresh_lpar.return_value = (
+            {cache.QP_STATE: 'migrating not active'},
+            {cache.QP_STATE: 'not activated'})
+        self.handler.process({LPAR_URI: 'invalidate'})
+        self.assertEqual(1, self.lpar_cache.refresh_lpar.call_count)
+        self.assertFalse(self.drv.emit_event.called)
+
+    def test_process_state_changed(self):
+        self.lpar_cache.refresh_lpar.return_value = (
+            {cache.QP_STATE: 'running'}, {cache.QP_STATE: 'not activated'})
+        self.handler.process({LPAR_URI: 'invalidate'})
+        self.assertEqual(1, self.drv.emit_event.call_count)
+
+        # Not a nova instance - no event
+        self.drv.emit_event.reset_mock()
+        self.mock_get_inst.return_value = None
+        self.handler.process({LPAR_URI: 'invalidate'})
+        self.assertFalse(self.drv.emit_event.called)
+
+    def test_process_delete(self):
+        self.handler.process({LPAR_URI: 'delete'})
+        self.lpar_cache.remove.assert_called_once_with(LPAR_UUID)
+        self.assertFalse(self.lpar_cache.refresh_lpar.called)
+
+    def test_process_ignored(self):
+        self.handler.process({'general': 'init',
+                              LPAR_URI + '/ClientNetworkAdapter/'
+                              '6445b54b-b9dc-3bc2-b1d3-f8cc22ba95b8': 'add'})
+        self.assertFalse(self.lpar_cache.refresh_lpar.called)
+        self.assertFalse(self.lpar_cache.invalidate.called)
+
+    def test_process_general_invalidate(self):
+        self.handler.process({'general': 'invalidate'})
+        self.lpar_cache.invalidate.assert_called_once_with()
+
+    def test_process_read_error(self):
+        # LPAR removed (by the cache) before it could be read
+        self.lpar_cache.refresh_lpar.return_value = (
+            {cache.QP_STATE: 'running'}, None)
+        self.handler.process({LPAR_URI: 'add'})
+        self.assertFalse(self.lpar_cache.invalidate.called)
+
+        # Any error invalidates the entry
+        self.lpar_cache.refresh_lpar.side_effect = pvm_exc.Error(
+            'Error', response=mock.Mock(status=500))
+        self.handler.process({LPAR_URI: 'add'})
+        self.lpar_cache.invalidate.assert_called_once_with(LPAR_UUID)
+        self.assertFalse(self.drv.emit_event.called)
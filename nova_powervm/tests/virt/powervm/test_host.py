@@ -15,16 +15,19 @@
 #    under the License.
 #
 
+import datetime
 import mock
 
 import logging
 from nova import test
+from pypowervm import const as pvm_const
 import pypowervm.tests.test_fixtures as pvm_fx
 from pypowervm.tests.test_utils import pvmhttp
 import pypowervm.wrappers.managed_system as pvm_ms
 from pypowervm.wrappers.pcm import phyp as pvm_phyp
 
 from nova_powervm.virt.powervm import host as pvm_host
+from nova_powervm.virt.powervm import vios
 
 MS_HTTPRESP_FILE = "managedsystem.txt"
 PCM_FILE = "phyp_pcm_data2.txt"
@@ -98,6 +101,10 @@ class TestHostCPUStats(test.TestCase):
         self.phyp = pvm_phyp.PhypInfo(self.cur_json_resp.body)
         self.prev_phyp = pvm_phyp.PhypInfo(self.prev_json_resp.body)
 
+        patcher = mock.patch.object(vios, 'LOAD_MONITOR')
+        self.mock_load_mon = patcher.start()
+        self.addCleanup(patcher.stop)
+
     def _get_sample(self, lpar_id, sample):
         for lpar in sample.lpars:
             if lpar.id == lpar_id:
@@ -118,6 +125,7 @@ class TestHostCPUStats(test.TestCase):
         self.assertEqual(None, host_stats.cur_data)
 
         # Make the 'prev' the current...for the first pass
+        self.prev_phyp.sample.time_stamp = '2015-05-27T08:17:15+0000'
         host_stats.cur_phyp = self.prev_phyp
         host_stats.prev_phyp = None
         host_stats._update_internal_metric()
@@ -141,6 +149,173 @@ class TestHostCPUStats(test.TestCase):
                   'frequency': 4116}
         self.assertEqual(expect, host_stats.cur_data)
 
+        # The frequency is only read once
+        self.assertEqual(1, mock_cpu_freq.call_count)
+
+        # Each sample feeds the VIOS load, dated by its time stamp
+        self.assertEqual(2, self.mock_load_mon.update.call_count)
+        self.mock_load_mon.update.assert_called_with(
+            datetime.datetime(2015, 5, 27, 8, 17, 45), self.phyp.sample,
+            host_stats.cur_vioses)
+
+        # The same sample, pulled again, does not
+        host_stats._update_internal_metric()
+        self.assertEqual(2, self.mock_load_mon.update.call_count)
+
+    @mock.patch('oslo_service.loopingcall.FixedIntervalLoopingCall')
+    @mock.patch('nova_powervm.virt.powervm.host.HostCPUStats._refresh')
+    @mock.patch('pypowervm.tasks.monitor.util.MetricCache._refresh_if_needed')
+    @mock.patch('pypowervm.tasks.monitor.util.ensure_ltm_monitors')
+    def test_get_host_cpu_stats(self, mock_ensure_ltm, mock_refresh_needed,
+                                mock_refresh, mock_loop):
+        host_stats = pvm_host.HostCPUStats(self.adpt, 'host_uuid')
+        host_stats.cur_data = mock.sentinel.data
+
+        # Refreshed in the background.  Started once.
+        host_stats.start()
+        host_stats.start()
+        mock_loop.assert_called_once_with(host_stats._refresher._run)
+        mock_loop.return_value.start.assert_called_once_with(
+            interval=30, initial_delay=30)
+        self.assertEqual(mock.sentinel.data, host_stats.get_host_cpu_stats())
+        self.assertFalse(mock_refresh.called)
+
+        host_stats.stop()
+        mock_loop.return_value.stop.assert_called_once_with()
+
+        # Refreshed inline, and never in the background
+        self.flags(host_cpu_stats_interval=0, group='powervm')
+        self.assertEqual(mock.sentinel.data, host_stats.get_host_cpu_stats())
+        self.assertEqual(1, mock_refresh.call_count)
+        host_stats.start()
+        self.assertEqual(1, mock_loop.call_count)
+
+    @mock.patch('nova_powervm.virt.powervm.host.time')
+    @mock.patch('pypowervm.tasks.monitor.util.MetricCache._refresh_if_needed')
+    @mock.patch('pypowervm.tasks.monitor.util.ensure_ltm_monitors')
+    def test_refresh(self, mock_ensure_ltm, mock_refresh_needed, mock_time):
+        host_stats = pvm_host.HostCPUStats(self.adpt, 'host_uuid')
+        self.assertIsNone(host_stats.staleness)
+
+        # No new sample
+        host_stats._refresh()
+        self.assertIsNone(host_stats.refresh_duration)
+
+        # New sample
+        def refresh():
+            host_stats.cur_date = datetime.datetime.now()
+        mock_refresh_needed.side_effect = refresh
+        mock_time.time.side_effect = [10.0, 12.5]
+        host_stats._refresh()
+        self.assertEqual(2.5, host_stats.refresh_duration)
+        self.assertLess(host_stats.staleness, 30)
+
+    @mock.patch('nova_powervm.virt.powervm.host.HostCPUStats._refresh')
+    @mock.patch('pypowervm.tasks.monitor.util.MetricCache._refresh_if_needed')
+    @mock.patch('pypowervm.tasks.monitor.util.ensure_ltm_monitors')
+    def test_periodic_refresh(self, mock_ensure_ltm, mock_refresh_needed,
+                              mock_refresh):
+        host_stats = pvm_host.HostCPUStats(self.adpt, 'host_uuid')
+
+        # A failed refresh doesn't end the looping call
+        mock_refresh.side_effect = [ValueError(), None]
+        host_stats._refresher._run()
+        host_stats._refresher._run()
+        self.assertEqual(2, mock_refresh.call_count)
+
+    @mock.patch('nova_powervm.virt.powervm.host.HostCPUStats.'
+                '_update_internal_metric')
+    @mock.patch('pypowervm.tasks.monitor.util.datetime')
+    @mock.patch('pypowervm.tasks.monitor.util.latest_stats')
+    @mock.patch('pypowervm.tasks.monitor.util.ensure_ltm_monitors')
+    def test_periodic_refresh_pulls(self, mock_ensure_ltm, mock_stats,
+                                    mock_dt, mock_update):
+        mock_dt.timedelta = datetime.timedelta
+        start = datetime.datetime(2015, 5, 27, 8, 17, 45)
+
+        # Each pull ends a second after the tick that started it.
+        def pull(adapter, host_uuid, include_vio=True):
+            return (mock_dt.datetime.now.return_value +
+                    datetime.timedelta(seconds=1), self.phyp, None)
+        mock_stats.side_effect = pull
+        mock_dt.datetime.now.return_value = start
+        host_stats = pvm_host.HostCPUStats(self.adpt, 'host_uuid')
+        self.assertEqual(1, mock_stats.call_count)
+
+        # Every tick of the looping call pulls a sample, even though the
+        # previous pull ended less than 30 seconds before.
+        for tick in (1, 2):
+            mock_dt.datetime.now.return_value = (
+                start + datetime.timedelta(seconds=30 * tick))
+            host_stats._refresher._run()
+            self.assertEqual(1 + tick, mock_stats.call_count)
+
+    @mock.patch('nova_powervm.virt.powervm.host.HostCPUStats._get_cpu_freq')
+    @mock.patch('pypowervm.tasks.monitor.util.MetricCache._refresh_if_needed')
+    @mock.patch('pypowervm.tasks.monitor.util.ensure_ltm_monitors')
+    def test_get_lpar_metrics(self, mock_ensure_ltm, mock_refresh,
+                              mock_cpu_freq):
+        self.flags(host_cpu_stats_interval=0, group='powervm')
+        host_stats = pvm_host.HostCPUStats(self.adpt, 'host_uuid')
+        self.assertEqual({}, host_stats.get_lpar_metrics())
+
+        # First sample.  No rates yet.
+        now = datetime.datetime.now()
+        self.prev_phyp.sample.time_stamp = '2015-05-27T08:17:15+0000'
+        host_stats.cur_phyp = self.prev_phyp
+        host_stats.cur_date = now - datetime.timedelta(seconds=45)
+        host_stats._update_internal_metric()
+        metrics = host_stats.get_lpar_metrics()
+        self.assertEqual(5, len(metrics))
+        lpar = metrics['42AD4FD4-DC64-4935-9E29-9B7C6F35AFCC']
+        self.assertIsNone(lpar['rates'])
+        self.assertEqual(254619289721 + 631419282,
+                         lpar['counters'].proc_cycles)
+
+        # The same sample, pulled again, is not a new sample.
+        host_stats.cur_date = now - datetime.timedelta(seconds=20)
+        host_stats._update_internal_metric()
+        self.assertEqual(1, len(host_stats._lpar_history))
+
+        # Second sample.  The rates are over the 30 seconds between the time
+        # stamps of the samples, not the times they were pulled.
+        host_stats.prev_phyp, host_stats.cur_phyp = self.prev_phyp, self.phyp
+        host_stats.cur_date = now
+        host_stats._update_internal_metric()
+
+        # A single LPAR
+        metrics = host_stats.get_lpar_metrics(
+            '42ad4fd4-dc64-4935-9e29-9b7c6f35afcc')
+        self.assertEqual(['42AD4FD4-DC64-4935-9E29-9B7C6F35AFCC'],
+                         list(metrics))
+        lpar = metrics['42AD4FD4-DC64-4935-9E29-9B7C6F35AFCC']
+        self.assertEqual(datetime.datetime(2015, 5, 27, 8, 17, 45),
+                         lpar['date'])
+        self.assertEqual(328986, lpar['cpu_time_ns'])
+        counters = lpar['counters']
+        self.assertEqual(20480, counters.logical_mem)
+        self.assertEqual(20480, counters.backed_physical_mem)
+        self.assertEqual(1, len(counters.nics))
+        nic = counters.nics[0]
+        self.assertEqual('U8247.22L.2125D4A-V2-C2', nic.location)
+        self.assertEqual((10000, 100, 10, 100, 5),
+                         (nic.rx_bytes, nic.tx_bytes, nic.rx_packets,
+                          nic.tx_packets, nic.dropped_packets))
+        self.assertAlmostEqual(10010000000 / (8.0629725893315e+14 * 30),
+                               lpar['rates']['proc_units'])
+        self.assertEqual(0, lpar['rates']['rx_bytes_per_sec'])
+        self.assertEqual(0, lpar['rates']['tx_bytes_per_sec'])
+
+        # Not in the sample
+        self.assertEqual({}, host_stats.get_lpar_metrics('other'))
+
+        # Only the last samples are kept
+        for i in range(pvm_host.LPAR_SAMPLE_HISTORY):
+            self.phyp.sample.time_stamp = '2015-05-27T08:%02d:00+0000' % i
+            host_stats._update_internal_metric()
+        self.assertEqual(pvm_host.LPAR_SAMPLE_HISTORY,
+                         len(host_stats._lpar_history))
+
     @mock.patch('nova_powervm.virt.powervm.host.HostCPUStats.'
                 '_get_total_cycles')
     @mock.patch('nova_powervm.virt.powervm.host.HostCPUStats._get_cpu_freq')
@@ -242,26 +417,40 @@ class TestHostCPUStats(test.TestCase):
 
     @mock.patch('pypowervm.tasks.monitor.util.MetricCache._refresh_if_needed')
     @mock.patch('pypowervm.tasks.monitor.util.ensure_ltm_monitors')
-    def test_find_prev_sample(self, mock_ensure_ltm, mock_refresh):
+    def test_index_samples(self, mock_ensure_ltm, mock_refresh):
         host_stats = pvm_host.HostCPUStats(self.adpt, 'host_uuid')
+        index = host_stats._index_samples(self.prev_phyp.sample.lpars)
+        self.assertEqual(len(self.prev_phyp.sample.lpars), len(index))
 
         # Sample 6 in the current shouldn't match the previous.  It has the
         # same LPAR ID, but a different name.  This is considered different
         new_elem = self._get_sample(6, self.phyp.sample)
-        prev = host_stats._find_prev_sample(new_elem,
-                                            self.prev_phyp.sample.lpars)
-        self.assertIsNone(prev)
+        self.assertIsNone(index.get((new_elem.id, new_elem.name)))
 
         # Lpar 4 should be in the old one.  Match that up.
         new_elem = self._get_sample(4, self.phyp.sample)
-        prev = host_stats._find_prev_sample(new_elem,
-                                            self.prev_phyp.sample.lpars)
+        prev = index.get((new_elem.id, new_elem.name))
         self.assertIsNotNone(prev)
         self.assertEqual(500000, prev.processor.entitled_proc_cycles)
 
-        # Test that we get None back if there are no previous samples
-        prev = host_stats._find_prev_sample(new_elem, None)
-        self.assertIsNone(prev)
+    @mock.patch('pypowervm.tasks.monitor.util.MetricCache._refresh_if_needed')
+    @mock.patch('pypowervm.tasks.monitor.util.ensure_ltm_monitors')
+    def test_delta_proc_cycles_many(self, mock_ensure_ltm, mock_refresh):
+        host_stats = pvm_host.HostCPUStats(self.adpt, 'host_uuid')
+
+        def sample(lpar_id, cycles):
+            proc = mock.Mock(util_cap_proc_cycles=cycles,
+                             util_uncap_proc_cycles=cycles)
+            lpar = mock.Mock(id=lpar_id, processor=proc)
+            # The name can't be set through the Mock constructor.
+            lpar.name = 'lpar%d' % lpar_id
+            return lpar
+
+        # 1000 VMs.  The first 100 are deleted and 100 new ones are created
+        # between the samples.  The rest each used 2 more cycles.
+        prev = [sample(i, 10) for i in range(1000)]
+        cur = [sample(i, 11) for i in range(100, 1100)]
+        self.assertEqual(1800, host_stats._delta_proc_cycles(cur, prev))
 
     @mock.patch('pypowervm.tasks.monitor.util.MetricCache._refresh_if_needed')
     @mock.patch('pypowervm.tasks.monitor.util.ensure_ltm_monitors')
@@ -272,3 +461,88 @@ class TestHostCPUStats(test.TestCase):
         # Make sure we get the full system cycles.
         max_cycles = host_stats._get_total_cycles()
         self.assertEqual(1.6125945178663e+16, max_cycles)
+
+
+class TestResourceSnapshot(test.TestCase):
+
+    def setUp(self):
+        super(TestResourceSnapshot, self).setUp()
+        self.adpt = self.useFixture(pvm_fx.AdapterFx()).adpt
+        ms_http = pvmhttp.load_pvm_resp(MS_HTTPRESP_FILE)
+        self.wrapper = pvm_ms.System.wrap(ms_http.response.feed.findentries(
+            pvm_ms._SYSTEM_NAME, MS_NAME)[0])
+        self.disk_dvr = mock.Mock(capacity_info=(100.0, 40.0))
+        self.cpu_stats = mock.Mock(staleness=5)
+        self.snap = pvm_host.ResourceSnapshot(
+            self.adpt, self.wrapper, self.disk_dvr,
+            host_cpu_stats=self.cpu_stats)
+
+        # Not changed
+        self.adpt.read.return_value = mock.Mock(
+            status=pvm_const.HTTPStatus.NO_CHANGE)
+
+    @mock.patch('oslo_service.loopingcall.FixedIntervalLoopingCall')
+    def test_get(self, mock_loop):
+        self.assertEqual({'host': None, 'disk': None, 'cpu': 5},
+                         self.snap.freshness())
+        data = self.snap.get()
+        self.assertEqual(100.0, data['local_gb'])
+        self.assertEqual(40.0, data['local_gb_used'])
+        self.assertEqual(500, data['vcpus'])
+        self.adpt.read.assert_called_once_with(
+            'ManagedSystem', root_id=self.wrapper.uuid,
+            etag=self.wrapper.etag)
+        self.assertEqual(self.wrapper, self.snap.host_wrapper)
+        self.assertLess(self.snap.freshness()['host'], 30)
+
+        # The next calls return the snapshot.  Started once.
+        self.snap.start()
+        self.snap.start()
+        self.assertIs(data, self.snap.get())
+        self.assertIs(data, self.snap.get())
+        self.assertEqual(1, self.adpt.read.call_count)
+        mock_loop.assert_called_once_with(self.snap._refresher._run)
+        mock_loop.return_value.start.assert_called_once_with(
+            interval=60, initial_delay=60)
+        self.snap.stop()
+        mock_loop.return_value.stop.assert_called_once_with()
+
+        # Gathered on every call
+        self.flags(resource_snapshot_interval=0, group='powervm')
+        self.assertIsNot(data, self.snap.get())
+        self.assertEqual(2, self.adpt.read.call_count)
+
+    def test_refresh(self):
+        self.snap.refresh()
+
+        # The host changed
+        new_wrap = mock.Mock()
+        with mock.patch('pypowervm.wrappers.managed_system.System.wrap',
+                        return_value=new_wrap), mock.patch(
+                'nova_powervm.virt.powervm.host.build_host_resource_from_ms',
+                return_value={}):
+            self.adpt.read.return_value = mock.Mock(status=200)
+
+            # The storage can't be read.  The previous values are kept.
+            type(self.disk_dvr).capacity_info = mock.PropertyMock(
+                side_effect=ValueError())
+            self.snap.refresh()
+        self.assertEqual(new_wrap, self.snap.host_wrapper)
+        self.assertEqual({'local_gb': 100.0, 'local_gb_used': 40.0},
+                         self.snap.data)
+
+    def test_refresh_first_fails(self):
+        type(self.disk_dvr).capacity_info = mock.PropertyMock(
+            side_effect=ValueError())
+        self.assertRaises(ValueError, self.snap.get)
+        self.assertIsNone(self.snap.data)
+
+    @mock.patch('nova_powervm.virt.powervm.host.ResourceSnapshot.refresh')
+    def test_periodic_refresh(self, mock_refresh):
+        snap = pvm_host.ResourceSnapshot(self.adpt, self.wrapper,
+                                         self.disk_dvr)
+        # A failed gather doesn't end the looping call
+        mock_refresh.side_effect = [ValueError(), None]
+        snap._refresher._run()
+        snap._refresher._run()
+        self.assertEqual(2, mock_refresh.call_count)
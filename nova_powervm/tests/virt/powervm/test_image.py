@@ -14,32 +14,178 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import eventlet
+import fixtures
 import mock
+import os
 import six
+import struct
+import zlib
 
 from nova import test
+from oslo_utils import units
 
 from nova_powervm.virt.powervm import image
 
-if six.PY2:
-    _BUILTIN = '__builtin__'
-else:
-    _BUILTIN = 'builtins'
-
 
 class TestImage(test.TestCase):
 
-    @mock.patch('nova.utils.temporary_chown')
-    @mock.patch(_BUILTIN + '.open')
-    @mock.patch('nova.image.api.API')
-    def test_stream_blockdev_to_glance(self, mock_api, mock_open, mock_chown):
-        mock_open.return_value.__enter__.return_value = 'mock_stream'
-        image.stream_blockdev_to_glance('context', mock_api, 'image_id',
-                                        'metadata', '/dev/disk')
-        mock_chown.assert_called_with('/dev/disk')
-        mock_open.assert_called_with('/dev/disk', 'rb')
-        mock_api.update.assert_called_with('context', 'image_id', 'metadata',
-                                           'mock_stream')
+    def setUp(self):
+        super(TestImage, self).setUp()
+        self.flags(snapshot_read_chunk_mb=1, group='powervm')
+        # A 3 MB "device", with data only in the first and last 64 KB
+        self.devpath = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                    'disk')
+        with open(self.devpath, 'wb') as dev:
+            dev.write(b'a' * units.Ki)
+            dev.truncate(3 * units.Mi)
+            dev.seek(-units.Ki, os.SEEK_END)
+            dev.write(b'z' * units.Ki)
+        with open(self.devpath, 'rb') as dev:
+            self.dev_data = dev.read()
+
+    def _stream(self, disk_format):
+        """Streams the device, returning the uploaded bytes."""
+        uploaded = []
+
+        def _update(context, image_id, metadata, stream):
+            while True:
+                data = stream.read(100 * units.Ki)
+                if not data:
+                    break
+                uploaded.append(data)
+        mock_api = mock.Mock()
+        mock_api.update.side_effect = _update
+        with mock.patch('nova.utils.temporary_chown') as mock_chown:
+            image.stream_blockdev_to_glance(
+                'context', mock_api, 'image_id', {'disk_format': disk_format},
+                self.devpath)
+        mock_chown.assert_called_once_with(self.devpath)
+        mock_api.update.assert_called_once_with(
+            'context', 'image_id', {'disk_format': disk_format}, mock.ANY)
+        return b''.join(uploaded)
+
+    def test_stream_blockdev_to_glance(self):
+        self.assertEqual(self.dev_data, self._stream('raw'))
+
+    def test_stream_blockdev_to_glance_qcow2(self):
+        img = self._stream('qcow2')
+        header = image._QCOW2_HEADER.unpack(img[:image._QCOW2_HEADER.size])
+        self.assertEqual(image._QCOW2_MAGIC, header[0])
+        self.assertEqual(3 * units.Mi, header[5])
+        # Header, L1 table, refcount table and block, one L2 table and the
+        # two clusters with data.  The zero clusters were not uploaded.
+        self.assertEqual(7 * image._QCOW2_CLUSTER_SIZE, len(img))
+        self.assertEqual(self.dev_data[:image._QCOW2_CLUSTER_SIZE],
+                         img[5 * image._QCOW2_CLUSTER_SIZE:
+                             6 * image._QCOW2_CLUSTER_SIZE])
+        self.assertEqual(self.dev_data[-image._QCOW2_CLUSTER_SIZE:],
+                         img[-image._QCOW2_CLUSTER_SIZE:])
+
+    @mock.patch('eventlet.tpool.execute')
+    def test_stream_blockdev_to_glance_compressed(self, mock_tpool):
+        # The compression runs on an OS thread
+        mock_tpool.side_effect = lambda func, *args: func(*args)
+        self.flags(snapshot_compression=True,
+                   snapshot_spool_dir=self.useFixture(
+                       fixtures.TempDir()).path, group='powervm')
+        img = self._stream('qcow2')
+        self.assertTrue(mock_tpool.called)
+        self.assertEqual(image._compress_clusters,
+                         mock_tpool.call_args[0][0])
+        csize = image._QCOW2_CLUSTER_SIZE
+        l2_off = 4 * csize
+        # The two clusters with data, compressed and packed after the L2
+        # table
+        l2 = struct.unpack('>%dQ' % image._QCOW2_L2_ENTRIES,
+                           img[l2_off:l2_off + csize])
+        entries = [(idx, entry) for idx, entry in enumerate(l2) if entry]
+        self.assertEqual([0, 47], [idx for idx, _entry in entries])
+        for idx, entry in entries:
+            self.assertTrue(entry & image._QCOW2_OFLAG_COMPRESSED)
+            coff = entry & ((1 << image._QCOW2_CSIZE_SHIFT) - 1)
+            decomp = zlib.decompressobj(image._QCOW2_WBITS)
+            self.assertEqual(self.dev_data[idx * csize:(idx + 1) * csize],
+                             decomp.decompress(img[coff:]))
+        # Header, tables and one cluster holding both compressed clusters
+        self.assertEqual(6 * csize, len(img))
+
+    @mock.patch('eventlet.tpool.execute')
+    def test_stream_blockdev_to_glance_compressed_parallel(self, mock_tpool):
+        # The two chunks with data are compressed at once
+        events = []
+
+        def _execute(func, offset, data, clusters):
+            events.append(('start', offset))
+            eventlet.sleep(0)
+            events.append(('end', offset))
+            return func(offset, data, clusters)
+        mock_tpool.side_effect = _execute
+        self.flags(snapshot_compression=True, snapshot_read_ahead=2,
+                   snapshot_spool_dir=self.useFixture(
+                       fixtures.TempDir()).path, group='powervm')
+        img = self._stream('qcow2')
+        self.assertEqual([('start', 0), ('start', 2 * units.Mi),
+                          ('end', 0), ('end', 2 * units.Mi)], events)
+        # The compressed clusters are still spooled in order
+        csize = image._QCOW2_CLUSTER_SIZE
+        l2 = struct.unpack('>%dQ' % image._QCOW2_L2_ENTRIES,
+                           img[4 * csize:5 * csize])
+        offsets = [entry & ((1 << image._QCOW2_CSIZE_SHIFT) - 1)
+                   for entry in l2 if entry]
+        self.assertEqual(sorted(offsets), offsets)
+        self.assertEqual(6 * csize, len(img))
+
+    def test_qcow2_metadata_compressed(self):
+        csize = image._QCOW2_CLUSTER_SIZE
+        header, tables = image._qcow2_metadata(
+            3 * csize, [0, 1, 2], compressed_sizes=[40000, 40000, 1000])
+        _l1, _rtable, rblock, l2 = tables
+        # The second compressed cluster spans the two data clusters
+        self.assertEqual([1] * 5 + [2, 2, 0],
+                         list(struct.unpack('>8H', rblock[:16])))
+        data_off = 5 * csize
+        shift = image._QCOW2_CSIZE_SHIFT
+        compressed = image._QCOW2_OFLAG_COMPRESSED
+        self.assertEqual(
+            [data_off | (78 << shift) | compressed,
+             (data_off + 40000) | (78 << shift) | compressed,
+             (data_off + 80000) | (2 << shift) | compressed],
+            list(struct.unpack('>3Q', l2[:24])))
+
+    def test_qcow2_metadata(self):
+        csize = image._QCOW2_CLUSTER_SIZE
+        header, tables = image._qcow2_metadata(3 * csize, [0, 2])
+        (_magic, _ver, _bfo, _bfs, _bits, size, _crypt, l1_size, l1_off,
+         rt_off, rt_clusters, _nsnap, _soff) = image._QCOW2_HEADER.unpack(
+            header[:image._QCOW2_HEADER.size])
+        self.assertEqual(3 * csize, size)
+        self.assertEqual((1, csize, 2 * csize, 1),
+                         (l1_size, l1_off, rt_off, rt_clusters))
+        # L1, refcount table, refcount block and one L2 table
+        self.assertEqual(4, len(tables))
+        l1, rtable, rblock, l2 = tables
+        copied = image._QCOW2_OFLAG_COPIED
+        self.assertEqual((4 * csize) | copied,
+                         struct.unpack('>Q', l1[:8])[0])
+        self.assertEqual(3 * csize, struct.unpack('>Q', rtable[:8])[0])
+        # Seven clusters in the image, each referenced once
+        self.assertEqual([1] * 7 + [0],
+                         list(struct.unpack('>8H', rblock[:16])))
+        self.assertEqual([(5 * csize) | copied, 0, (6 * csize) | copied],
+                         list(struct.unpack('>3Q', l2[:24])))
+
+    def test_read_ahead(self):
+        fileobj = six.BytesIO(b'0123456789')
+        reader = image._ReadAhead(fileobj, image._extents(2, 9, 4), 1)
+        self.assertEqual([(2, b'23'), (4, b'4567'), (8, b'89\0')],
+                         list(reader))
+
+        # Read errors are raised to the consumer
+        fileobj = mock.Mock()
+        fileobj.read.side_effect = IOError()
+        reader = image._ReadAhead(fileobj, [(0, 4)], 1)
+        self.assertRaises(IOError, list, reader)
 
     @mock.patch('nova.image.api.API')
     def test_snapshot_metadata(self, mock_api):
@@ -61,3 +207,9 @@ class TestImage(test.TestCase):
                 'owner_id': 'project_id',
             }
         }, ret)
+
+        # Compressed snapshots are qcow2
+        self.flags(snapshot_compression=True, group='powervm')
+        ret = image.snapshot_metadata('context', mock_api, 'image_id',
+                                      mock_instance)
+        self.assertEqual('qcow2', ret['disk_format'])
@@ -14,7 +14,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import fixtures
 import mock
+import os
+import threading
 
 from nova import test
 from pypowervm.tests import test_fixtures as pvm_fx
@@ -24,6 +27,7 @@ from pypowervm.wrappers import virtual_io_server as pvm_vios
 
 from nova_powervm.virt.powervm import exception as npvmex
 from nova_powervm.virt.powervm import media as m
+from nova_powervm.virt.powervm import vios
 
 VOL_GRP_DATA = 'fake_volume_group2.txt'
 VOL_GRP_NOVG_DATA = 'fake_volume_group_no_vg.txt'
@@ -60,6 +64,8 @@ class TestConfigDrivePowerVM(test.TestCase):
         m.ConfigDrivePowerVM._cur_vios_uuid = None
         m.ConfigDrivePowerVM._cur_vios_name = None
         m.ConfigDrivePowerVM._cur_vg_uuid = None
+        m.ConfigDrivePowerVM._cur_generation = 0
+        m._reaper = None
 
     @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
                 '_validate_vopt_vg')
@@ -112,6 +118,63 @@ class TestConfigDrivePowerVM(test.TestCase):
         self.assertTrue(mock_attach.called)
         mock_attach.assert_called_with(mock.ANY, 'fake_lpar', mock.ANY, None)
 
+    @mock.patch('pypowervm.tasks.storage.upload_vopt')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_validate_vopt_vg')
+    @mock.patch('nova.api.metadata.base.InstanceMetadata')
+    @mock.patch('nova.virt.configdrive.ConfigDriveBuilder.make_drive')
+    @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
+                '_attach_vopt')
+    def test_crt_cfg_drv_vopt_in_memory(self, mock_attach, mock_mkdrv,
+                                        mock_meta, mock_validate, mock_upld):
+        tmpfs = self.useFixture(fixtures.TempDir()).path
+        self.flags(cfg_drive_in_memory=True, cfg_drive_tmpfs_path=tmpfs,
+                   group='powervm')
+        built = []
+
+        def make_drive(iso_path):
+            built.append(iso_path)
+            with open(iso_path, 'wb') as iso:
+                iso.write(b'iso data')
+        mock_mkdrv.side_effect = make_drive
+
+        def upload_vopt(adapter, vios_uuid, stream, file_name, file_size):
+            self.assertEqual(b'iso data', stream.read())
+            self.assertEqual('cfg_fake_instance.iso', file_name)
+            self.assertEqual(8, file_size)
+            return 'vopt', None
+        mock_upld.side_effect = upload_vopt
+
+        mock_instance = mock.MagicMock()
+        mock_instance.name = 'fake-instance'
+        cfg_dr_builder = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        cfg_dr_builder.create_cfg_drv_vopt(mock_instance, mock.MagicMock(),
+                                           mock.MagicMock(), 'fake_lpar')
+
+        # Built on the tmpfs, and cleaned up after reading it in.
+        self.assertEqual(1, len(built))
+        self.assertTrue(built[0].startswith(tmpfs))
+        self.assertEqual([], os.listdir(tmpfs))
+        self.assertEqual(1, mock_upld.call_count)
+        mock_attach.assert_called_with(mock_instance, 'fake_lpar', 'vopt',
+                                       None)
+
+    def test_build_slot(self):
+        m._build_semaphore = None
+        self.addCleanup(setattr, m, '_build_semaphore', None)
+        self.flags(cfg_drive_build_workers=0, group='powervm')
+        self.assertIsNone(m._build_slot())
+
+        self.flags(cfg_drive_build_workers=2, group='powervm')
+        slot = m._build_slot()
+        self.assertIs(slot, m._build_slot())
+        # Two builds at a time
+        self.assertTrue(slot.acquire(False))
+        self.assertTrue(slot.acquire(False))
+        self.assertFalse(slot.acquire(False))
+        slot.release()
+        slot.release()
+
     @mock.patch('pypowervm.tasks.scsi_mapper.add_map')
     @mock.patch('pypowervm.tasks.scsi_mapper.build_vscsi_mapping')
     @mock.patch('nova_powervm.virt.powervm.media.ConfigDrivePowerVM.'
@@ -192,6 +255,68 @@ class TestConfigDrivePowerVM(test.TestCase):
         self.assertEqual('1e46bbfd-73b6-3c2a-aeab-a1d3f065e92f',
                          cfg_dr_builder.vg_uuid)
 
+    @mock.patch.object(vios, 'LOAD_MONITOR')
+    def test_validate_opt_vg_least_loaded(self, mock_load_mon):
+        mock_load_mon.least_loaded.side_effect = lambda uuids: uuids[-1]
+        self.apt.read.side_effect = [self.vio_feed, self.vol_grp_resp]
+        self.apt.update_by_path.return_value = (
+            self.vol_grp_resp.feed.entries[0])
+        m.ConfigDrivePowerVM(self.apt, 'fake_host')
+
+        # Picked among the VIOSes with the media VG
+        self.assertEqual(1, mock_load_mon.least_loaded.call_count)
+        uuids = mock_load_mon.least_loaded.call_args[0][0]
+        self.assertEqual(uuids[-1], m.ConfigDrivePowerVM._cur_vios_uuid)
+
+    def test_validate_opt_vg_cached(self):
+        self.apt.read.side_effect = [self.vio_feed, self.vol_grp_resp]
+        self.apt.update_by_path.return_value = (
+            self.vol_grp_resp.feed.entries[0])
+        m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        self.assertEqual(2, self.apt.read.call_count)
+
+        # Subsequent builders use the cached repository, without REST calls
+        cfg_dr_builder = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        self.assertEqual(2, self.apt.read.call_count)
+        self.assertEqual('1e46bbfd-73b6-3c2a-aeab-a1d3f065e92f',
+                         cfg_dr_builder.vg_uuid)
+        self.assertEqual(1, cfg_dr_builder.repo_generation)
+
+        # Another thread already revalidated the repository - nothing to do.
+        cfg_dr_builder._validate_vopt_vg(generation=0)
+        self.assertEqual(2, self.apt.read.call_count)
+
+    def test_revalidate_on_failure(self):
+        # A (stale) cached repository
+        m.ConfigDrivePowerVM._cur_vios_uuid = 'old_vios'
+        m.ConfigDrivePowerVM._cur_vg_uuid = 'old_vg'
+        cfg_dr_builder = m.ConfigDrivePowerVM(self.apt, 'fake_host')
+        self.assertEqual(0, self.apt.read.call_count)
+
+        # The operation fails.  The old VG is gone, so the repository is
+        # rediscovered and the operation retried.
+        used = []
+
+        def operation():
+            used.append(cfg_dr_builder.vg_uuid)
+            if len(used) == 1:
+                raise ValueError()
+            return 'result'
+        self.apt.read.side_effect = [ValueError(), self.vio_feed,
+                                     self.vol_grp_resp]
+        self.apt.update_by_path.return_value = (
+            self.vol_grp_resp.feed.entries[0])
+        self.assertEqual('result',
+                         cfg_dr_builder._revalidate_on_failure(operation))
+        self.assertEqual(['old_vg', '1e46bbfd-73b6-3c2a-aeab-a1d3f065e92f'],
+                         used)
+
+        # The operation fails, but the repository is still there.  Raised.
+        self.apt.read.side_effect = None
+        self.apt.read.return_value = self.vol_grp_resp
+        self.assertRaises(ValueError, cfg_dr_builder._revalidate_on_failure,
+                          mock.Mock(side_effect=ValueError()))
+
     def test_validate_opt_vg_fail(self):
         self.apt.read.side_effect = [self.vio_feed_no_vg,
                                      self.vol_grp_novg_resp]
@@ -205,6 +330,8 @@ class TestConfigDrivePowerVM(test.TestCase):
                 '_validate_vopt_vg')
     def test_dlt_vopt(self, mock_vop_valid, mock_vm_id, mock_remove_map,
                       rm_vg_stor):
+        # Remove the media right away
+        self.flags(vopt_cleanup_interval=0, group='powervm')
         feed = [pvm_vios.VIOS.wrap(self.vio_to_vg)]
         ft_fx = pvm_fx.FeedTaskFx(feed)
         self.useFixture(ft_fx)
@@ -242,3 +369,120 @@ class TestConfigDrivePowerVM(test.TestCase):
 
         self.assertTrue(ft_fx.patchers['update'].mock.called)
         self.assertTrue(rm_vg_stor.called)
+
+
+class TestVOptReaper(test.TestCase):
+    """Unit Tests for the VOptReaper class."""
+
+    def setUp(self):
+        super(TestVOptReaper, self).setUp()
+        self.apt = self.useFixture(pvm_fx.AdapterFx()).adpt
+        self.reaper = m.VOptReaper(self.apt)
+
+        def _media(name):
+            media = mock.Mock(media_name=name)
+            media.name = name
+            return media
+        self.media = [_media(name) for name in (
+            'cfg_a.iso', 'cfg_b.iso', 'cfg_c.iso', 'other.iso')]
+        self.vg_w = mock.Mock()
+        self.vg_w.vmedia_repos = [mock.Mock(optical_media=self.media)]
+        vg_wrap = mock.patch('pypowervm.wrappers.storage.VG.wrap')
+        vg_wrap.start().return_value = self.vg_w
+        self.addCleanup(vg_wrap.stop)
+
+        rm_stg = mock.patch('pypowervm.tasks.storage.rm_vg_storage')
+        self.mock_rm_stg = rm_stg.start()
+        self.addCleanup(rm_stg.stop)
+
+    @mock.patch('threading.Thread')
+    def test_queue(self, mock_thread):
+        # Media of several destroys is removed with one VG update
+        self.reaper.queue('vios_uuid', 'vg_uuid', ['cfg_a.iso'])
+        self.reaper.queue('vios_uuid', 'vg_uuid', ['cfg_b.iso'])
+        self.reaper.queue('vios_uuid', 'vg_uuid', [])
+        # The background thread was started once
+        self.assertEqual(1, mock_thread.return_value.start.call_count)
+        self.assertEqual(0, self.apt.read.call_count)
+
+        # Nothing to do for other media
+        self.reaper.ensure_removed('cfg_c.iso')
+        self.assertEqual(0, self.apt.read.call_count)
+
+        # Media with the same name is about to be created - removed now.
+        self.reaper.ensure_removed('cfg_a.iso')
+        self.apt.read.assert_called_once_with(
+            'VirtualIOServer', root_id='vios_uuid',
+            child_type='VolumeGroup', child_id='vg_uuid')
+        self.mock_rm_stg.assert_called_once_with(
+            self.vg_w, vopts=self.media[:2])
+
+        # Nothing left to do
+        self.reaper.flush()
+        self.assertEqual(1, self.apt.read.call_count)
+
+    def test_ensure_removed_in_flight(self):
+        # A flush is removing the media when media with the same name is
+        # about to be created.
+        self.reaper._thread = mock.Mock()
+        self.reaper.queue('vios_uuid', 'vg_uuid', ['cfg_a.iso'])
+        waiter = threading.Thread(target=self.reaper.ensure_removed,
+                                  args=('cfg_a.iso',))
+
+        def read(*args, **kwargs):
+            waiter.start()
+            # Other media is not held up by the flush.
+            self.reaper.ensure_removed('cfg_c.iso')
+            # The creation waits for the flush to finish.
+            waiter.join(0.5)
+            self.assertTrue(waiter.is_alive())
+            return mock.Mock()
+        self.apt.read.side_effect = read
+        self.reaper.flush()
+        waiter.join(10)
+        self.assertFalse(waiter.is_alive())
+        self.mock_rm_stg.assert_called_once_with(
+            self.vg_w, vopts=[self.media[0]])
+
+    def test_queue_sync(self):
+        self.flags(vopt_cleanup_interval=0, group='powervm')
+        self.reaper.queue('vios_uuid', 'vg_uuid', ['cfg_c.iso'])
+        self.mock_rm_stg.assert_called_once_with(
+            self.vg_w, vopts=[self.media[2]])
+
+    def test_flush_failure(self):
+        self.flags(vopt_cleanup_interval=0, group='powervm')
+        self.apt.read.side_effect = ValueError()
+        self.assertRaises(ValueError, self.reaper.queue, 'vios_uuid',
+                          'vg_uuid', ['cfg_c.iso'])
+        # Retried on the next flush
+        self.apt.read.side_effect = None
+        self.reaper.flush()
+        self.mock_rm_stg.assert_called_once_with(
+            self.vg_w, vopts=[self.media[2]])
+
+    @mock.patch('time.time')
+    @mock.patch('pypowervm.wrappers.virtual_io_server.VIOS.wrap')
+    def test_sweep(self, mock_vios_wrap, mock_time):
+        m.ConfigDrivePowerVM._cur_vios_uuid = 'vios_uuid'
+        m.ConfigDrivePowerVM._cur_vg_uuid = 'vg_uuid'
+        self.addCleanup(setattr, m.ConfigDrivePowerVM, '_cur_vios_uuid',
+                        None)
+        self.addCleanup(setattr, m.ConfigDrivePowerVM, '_cur_vg_uuid', None)
+
+        # cfg_b.iso is mapped
+        mapped = mock.Mock(spec=pvm_stor.VOptMedia, media_name='cfg_b.iso')
+        mock_vios_wrap.return_value.scsi_mappings = [
+            mock.Mock(backing_storage=mapped),
+            mock.Mock(backing_storage=None)]
+
+        # The first sweep just notes the unmapped config drive media
+        mock_time.return_value = 1000
+        self.reaper.flush(sweep=True)
+        self.assertEqual(0, self.mock_rm_stg.call_count)
+
+        # Unmapped for long enough
+        mock_time.return_value = 1000 + m._SWEEP_GRACE
+        self.reaper.flush(sweep=True)
+        self.mock_rm_stg.assert_called_once_with(
+            self.vg_w, vopts=[self.media[0], self.media[2]])
@@ -14,7 +14,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import fixtures
 import mock
+import os
 
 from nova import exception
 from nova import test
@@ -39,6 +41,13 @@ class TestMgmt(test.TestCase):
 
         self.resp = lpar_http.response
 
+        # Device discovery polls, rather than using inotify, by default.
+        self.get_libc = mgmt._get_libc
+        libc_patcher = mock.patch('nova_powervm.virt.powervm.mgmt._get_libc')
+        self.mock_libc = libc_patcher.start()
+        self.mock_libc.return_value = None
+        self.addCleanup(libc_patcher.stop)
+
     def test_get_mgmt_partition(self):
         self.apt.read.return_value = self.resp
         mp_wrap = mgmt.get_mgmt_partition(self.apt)
@@ -142,3 +151,65 @@ class TestMgmt(test.TestCase):
         self.assertEqual(1, mock_exec.call_count)
         # sleep was called many times
         self.assertTrue(mock_sleep.call_count)
+
+    @mock.patch('time.sleep')
+    @mock.patch('nova_powervm.virt.powervm.mgmt._DirWatch')
+    @mock.patch('glob.glob')
+    @mock.patch('nova.utils.execute')
+    @mock.patch('os.path.realpath')
+    def test_discover_vscsi_disk_watch(self, mock_realpath, mock_exec,
+                                       mock_glob, mock_watch, mock_sleep):
+        """The device link appears while watching /dev/disk/by-id."""
+        udid = ('275b5d5f88fa5611e48be9000098be9400'
+                '13fb2aa55a2d7b8d150cb1b7b6bc04d6')
+        mapping = mock.Mock()
+        mapping.client_adapter.slot_number = 5
+        mapping.backing_storage.udid = udid
+        watch = mock_watch.return_value.__enter__.return_value
+        watch.active = True
+        mock_glob.side_effect = [['scanpath'], [], [], ['devlink']]
+        mgmt.discover_vscsi_disk(mapping)
+        mock_watch.assert_called_once_with(
+            '/dev/disk/by-id', mgmt._IN_CREATE | mgmt._IN_MOVED_TO)
+        # Waited on the watch (not slept) between the three checks
+        self.assertEqual(2, watch.wait.call_count)
+        self.assertTrue(all(call[0][0] <= mgmt._WATCH_INTERVAL
+                            for call in watch.wait.call_args_list))
+        self.assertEqual(0, mock_sleep.call_count)
+        mock_realpath.assert_called_once_with('devlink')
+
+    def test_dir_watch(self):
+        """A real inotify watch on a temporary directory."""
+        self.mock_libc.side_effect = self.get_libc
+        tmpdir = self.useFixture(fixtures.TempDir()).path
+        with mgmt._DirWatch(tmpdir, mgmt._IN_CREATE) as watch:
+            if not watch.active:
+                self.skipTest('inotify is not available')
+            open(os.path.join(tmpdir, 'sda'), 'w').close()
+            # Returns (well before the timeout) on the event
+            watch.wait(30)
+        self.assertFalse(watch.active)
+
+    def test_dir_watch_fallback(self):
+        """Without inotify, waiting simply sleeps."""
+        with mock.patch('time.sleep') as mock_sleep:
+            with mgmt._DirWatch('/dev', mgmt._IN_DELETE) as watch:
+                self.assertFalse(watch.active)
+                watch.wait(0.25)
+        mock_sleep.assert_called_once_with(0.25)
+
+    @mock.patch('nova.utils.execute')
+    def test_write_sysfs(self, mock_exec):
+        # Writable file - written directly
+        fpath = os.path.join(self.useFixture(fixtures.TempDir()).path, 'scan')
+        open(fpath, 'w').close()
+        mgmt._write_sysfs(fpath, '- - -')
+        with open(fpath) as sysfs_file:
+            self.assertEqual('- - -', sysfs_file.read())
+        self.assertEqual(0, mock_exec.call_count)
+
+        # Otherwise, as root
+        with mock.patch('os.access', return_value=False):
+            mgmt._write_sysfs(fpath, '1')
+        mock_exec.assert_called_once_with('tee', '-a', fpath,
+                                          process_input='1', run_as_root=True)
@@ -0,0 +1,157 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+
+import mock
+from nova import test
+from oslo_context import context as ctx
+from taskflow.patterns import graph_flow as tf_gf
+from taskflow import task as tf_tsk
+
+from nova_powervm.virt.powervm import driver
+from nova_powervm.virt.powervm import rest_stats
+
+LPAR_PATH = ('/rest/api/uom/ManagedSystem/c5d782c7-44e4-3086-ad15-'
+             'b16fb039d63b/LogicalPartition/089FFB20-5D19-4A8C-BB80-'
+             '13650627D985?group=None')
+
+
+class TestRESTStats(test.TestCase):
+
+    def setUp(self):
+        super(TestRESTStats, self).setUp()
+        self.stats = rest_stats.RESTStats(recent_ops=2)
+        patcher = mock.patch.object(rest_stats, 'STATS', self.stats)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_uri_pattern(self):
+        self.assertEqual('/rest/api/uom/ManagedSystem/{uuid}/'
+                         'LogicalPartition/{uuid}',
+                         rest_stats.uri_pattern(LPAR_PATH))
+        self.assertEqual('/rest/api/uom/Cluster/{uuid}/do/{id}',
+                         rest_stats.uri_pattern(
+                             '/rest/api/uom/Cluster/'
+                             '089ffb20-5d19-4a8c-bb80-13650627d985/do/12'))
+
+    @mock.patch('time.time')
+    def test_stats_helper(self, mock_time):
+        resp = mock.Mock(body='x' * 10)
+        func = mock.Mock(return_value=resp)
+        helper = rest_stats.stats_helper(func)
+
+        # 30 ms call
+        mock_time.side_effect = [100.0, 100.03]
+        self.assertEqual(resp, helper('GET', LPAR_PATH, body='abc'))
+        func.assert_called_once_with('GET', LPAR_PATH, body='abc')
+
+        # Failed, 40 s call
+        err = ValueError()
+        err.response = None
+        func.side_effect = err
+        mock_time.side_effect = [200.0, 240.0]
+        self.assertRaises(ValueError, helper, 'GET', LPAR_PATH)
+
+        calls = rest_stats.STATS.dump()['calls']
+        self.assertEqual(1, len(calls))
+        call = calls[0]
+        self.assertEqual(rest_stats.UNTRACKED, call['operation'])
+        self.assertEqual('GET', call['method'])
+        self.assertEqual(2, call['count'])
+        self.assertEqual(1, call['errors'])
+        self.assertEqual(3, call['req_bytes'])
+        self.assertEqual(10, call['resp_bytes'])
+        self.assertAlmostEqual(40000, call['max_ms'], places=0)
+        # One in the 50 ms bucket, one beyond the last bucket.
+        self.assertEqual(1, call['histogram'][2])
+        self.assertEqual(1, call['histogram'][-1])
+        self.assertEqual(2, sum(call['histogram']))
+
+    def test_tracked(self):
+        helper = rest_stats.stats_helper(mock.Mock(return_value=None))
+
+        class Driver(object):
+            @rest_stats.tracked
+            def spawn(self, context, instance, image_meta):
+                helper('GET', LPAR_PATH)
+                # Nested operations are counted in the outer one
+                self.power_on(context, instance)
+
+            @rest_stats.tracked
+            def power_on(self, context, instance):
+                helper('PUT', LPAR_PATH)
+
+        inst = mock.Mock(uuid='inst_uuid')
+        Driver().spawn('ctx', inst, image_meta={})
+        Driver().power_on('ctx', instance=inst)
+        Driver().power_on('ctx', inst)
+
+        dump = rest_stats.STATS.dump()
+        self.assertEqual({'spawn': {'runs': 1, 'calls_per_run': 2.0},
+                          'power_on': {'runs': 2, 'calls_per_run': 1.0}},
+                         dump['operations'])
+        self.assertEqual(
+            [('power_on', 'PUT'), ('spawn', 'GET'), ('spawn', 'PUT')],
+            [(call['operation'], call['method']) for call in dump['calls']])
+        # Only the most recent runs are kept
+        self.assertEqual(['power_on', 'power_on'],
+                         [run['operation'] for run in dump['recent']])
+        self.assertEqual('inst_uuid', dump['recent'][0]['instance'])
+
+        # Outside of any operation
+        helper('GET', LPAR_PATH)
+        self.assertEqual(rest_stats.UNTRACKED,
+                         rest_stats.STATS.dump()['calls'][-1]['operation'])
+
+        rest_stats.STATS.reset()
+        self.assertEqual([], rest_stats.STATS.dump()['calls'])
+
+    def test_tracked_parallel_flow(self):
+        # The calls of the flow tasks are made on the executor threads
+        self.flags(flow_max_workers=4, group='powervm')
+        context = ctx.RequestContext(overwrite=True)
+        self.addCleanup(setattr, ctx._request_store, 'context', None)
+        helper = rest_stats.stats_helper(mock.Mock(return_value=None))
+        threads = set()
+
+        def call():
+            threads.add(threading.current_thread().ident)
+            helper('GET', LPAR_PATH)
+
+        flow = tf_gf.Flow('flow')
+        for idx in range(4):
+            flow.add(tf_tsk.FunctorTask(call, name='call%d' % idx))
+
+        class Driver(object):
+            @rest_stats.tracked
+            def spawn(self, context, instance):
+                driver.PowerVMDriver._run_graph_flow(flow)
+
+        Driver().spawn(context, mock.Mock(uuid='inst_uuid'))
+        self.assertNotIn(threading.current_thread().ident, threads)
+
+        dump = rest_stats.STATS.dump()
+        self.assertEqual({'spawn': {'runs': 1, 'calls_per_run': 4.0}},
+                         dump['operations'])
+        self.assertEqual([('spawn', 'GET')],
+                         [(call['operation'], call['method'])
+                          for call in dump['calls']])
+
+        # Once done, the context no longer tags the calls.
+        helper('GET', LPAR_PATH)
+        self.assertEqual(rest_stats.UNTRACKED,
+                         rest_stats.STATS.dump()['calls'][-1]['operation'])
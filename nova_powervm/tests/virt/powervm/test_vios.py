@@ -14,15 +14,20 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+import threading
 
-from nova import test
+import mock
 
+from nova import test
 from pypowervm.tests import test_fixtures as pvm_fx
 from pypowervm.tests.test_utils import pvmhttp
 from pypowervm.wrappers import base_partition as pvm_bp
 from pypowervm.wrappers import managed_system as pvm_ms
 from pypowervm.wrappers import virtual_io_server as pvm_vios
+from taskflow import task as tf_task
 
+from nova_powervm.virt.powervm import cache
 from nova_powervm.virt.powervm import vios
 
 VIOS_FEED = 'fake_vios_feed2.txt'
@@ -33,6 +38,10 @@ class TestVios(test.TestCase):
     def setUp(self):
         super(TestVios, self).setUp()
         self.adpt = self.useFixture(pvm_fx.AdapterFx()).adpt
+        patcher = mock.patch.object(cache, 'VIOS_FEED_CACHE',
+                                    cache.VIOSFeedCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
         def resp(file_name):
             return pvmhttp.load_pvm_resp(file_name).get_response()
@@ -49,6 +58,15 @@ class TestVios(test.TestCase):
         self.adpt.read.assert_called_with(pvm_ms.System.schema_type,
                                           root_id='host_uuid',
                                           child_type=pvm_vios.VIOS.schema_type,
+                                          xag=None, etag=None)
+
+    def test_get_active_vioses_no_cache(self):
+        self.flags(vios_feed_cache=False, group='powervm')
+        self.adpt.read.return_value = self.vios_feed_resp
+        self.assertEqual(1, len(vios.get_active_vioses(self.adpt, 'host')))
+        self.adpt.read.assert_called_with(pvm_ms.System.schema_type,
+                                          root_id='host',
+                                          child_type=pvm_vios.VIOS.schema_type,
                                           xag=None)
 
     def test_get_physical_wwpns(self):
@@ -56,3 +74,236 @@ class TestVios(test.TestCase):
         expected = set(['21000024FF649104'])
         result = set(vios.get_physical_wwpns(self.adpt, 'fake_uuid'))
         self.assertSetEqual(expected, result)
+
+
+class TestVIOSLoadMonitor(test.TestCase):
+
+    def setUp(self):
+        super(TestVIOSLoadMonitor, self).setUp()
+        self.monitor = vios.VIOSLoadMonitor()
+        self.date = datetime.datetime(2015, 5, 27, 8, 17, 45)
+
+    @staticmethod
+    def _phyp_sample(*vioses):
+        """A PhypSample with (id, uuid, used, entitled cycles) VIOSes."""
+        samples = []
+        for lpar_id, uuid, used, entitled in vioses:
+            proc = mock.Mock(util_cap_proc_cycles=used,
+                             util_uncap_proc_cycles=0,
+                             entitled_proc_cycles=entitled)
+            samples.append(mock.Mock(id=lpar_id, uuid=uuid, processor=proc))
+        return mock.Mock(vioses=samples)
+
+    @staticmethod
+    def _vios_info(lpar_id, fc_bytes, net_bytes):
+        fc = mock.Mock(read_bytes=fc_bytes, write_bytes=0)
+        phys = mock.Mock(type='physical', received_bytes=net_bytes,
+                         sent_bytes=0)
+        # The traffic of the trunk adapter is not counted.
+        virt = mock.Mock(type='virtual', received_bytes=net_bytes,
+                         sent_bytes=net_bytes)
+        sample = mock.Mock(id=lpar_id, storage=mock.Mock(fc_adpts=[fc]),
+                           network=mock.Mock(adpts=[phys, virt]))
+        return mock.Mock(sample=sample)
+
+    def test_update(self):
+        # Nothing known before the second sample
+        self.monitor.update(self.date, self._phyp_sample(
+            (1, 'vios1', 100, 1000), (2, 'vios2', 100, 1000)),
+            [self._vios_info(1, 1000, 500)])
+        self.assertIsNone(self.monitor.load('vios1'))
+
+        self.monitor.update(
+            self.date + datetime.timedelta(seconds=30),
+            self._phyp_sample((1, 'vios1', 600, 2000),
+                              (2, 'vios2', 200, 2000)),
+            [self._vios_info(1, 31000, 3500)])
+        self.assertEqual(vios.VIOSLoad(0.5, 1000.0, 100.0),
+                         self.monitor.load('VIOS1'))
+        # No VIOS metrics for the second VIOS
+        self.assertEqual(vios.VIOSLoad(0.1, 0.0, 0.0),
+                         self.monitor.load('vios2'))
+
+        # A VIOS that went away is dropped
+        self.monitor.update(self.date + datetime.timedelta(seconds=60),
+                            self._phyp_sample((1, 'vios1', 700, 3000)))
+        self.assertIsNone(self.monitor.load('vios2'))
+        self.assertEqual(0.1, self.monitor.load('vios1').cpu_util)
+
+    def test_least_loaded(self):
+        # No loads known - at random
+        with mock.patch('random.choice') as mock_choice:
+            self.assertEqual(mock_choice.return_value,
+                             self.monitor.least_loaded(['a', 'b']))
+            mock_choice.assert_called_once_with(['a', 'b'])
+
+        self.monitor._loads = {'A': vios.VIOSLoad(0.52, 5000.0, 0.0),
+                               'B': vios.VIOSLoad(0.48, 10.0, 0.0),
+                               'C': vios.VIOSLoad(0.9, 0.0, 0.0)}
+        # Same CPU utilization step - the I/O decides
+        self.assertEqual('b', self.monitor.least_loaded(['a', 'b', 'c']))
+        # The VIOSes without a known load rank last
+        self.assertEqual('c', self.monitor.least_loaded(['c', 'd']))
+
+        # Tied VIOSes are picked at random
+        self.monitor._loads['D'] = vios.VIOSLoad(0.5, 10.0, 0.0)
+        with mock.patch('random.choice') as mock_choice:
+            self.assertEqual(mock_choice.return_value,
+                             self.monitor.least_loaded(['a', 'b', 'd']))
+            mock_choice.assert_called_once_with(['b', 'd'])
+
+
+class TestFeedTaskCoalescer(test.TestCase):
+
+    def setUp(self):
+        super(TestFeedTaskCoalescer, self).setUp()
+        self.adpt = self.useFixture(pvm_fx.AdapterFx()).adpt
+        patcher = mock.patch.object(cache, 'VIOS_FEED_CACHE',
+                                    cache.VIOSFeedCache())
+        self.feed_cache = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.adpt.read.return_value = pvmhttp.load_pvm_resp(
+            VIOS_FEED).get_response()
+        self.coalescer = vios.FeedTaskCoalescer(self.adpt, 'host_uuid',
+                                                window=0.5)
+
+        def subtask(vios_w):
+            return False
+        self.subtask = subtask
+
+    def _ftsk(self, name='ftsk'):
+        ftsk = self.coalescer.build_feed_task(name=name)
+        ftsk.add_functor_subtask(self.subtask)
+        return ftsk
+
+    @mock.patch('time.time')
+    def test_build_feed_task(self, mock_time):
+        mock_time.return_value = 100
+        ftsk1 = self.coalescer.build_feed_task(name='one')
+        ftsk2 = self.coalescer.build_feed_task(name='two')
+        self.assertEqual(1, self.adpt.read.call_count)
+        self.assertEqual('two', ftsk2.name)
+        # Each FeedTask has its own copy of the wrappers
+        self.assertEqual([w.uuid for w in ftsk1.feed],
+                         [w.uuid for w in ftsk2.feed])
+        self.assertIsNot(ftsk1.feed[0].entry, ftsk2.feed[0].entry)
+        self.assertEqual(2, len(self.coalescer._unjoined))
+
+        # A different set of XAGs is read separately
+        self.coalescer.build_feed_task(xag=[pvm_vios.VIOS.xags.FC_MAPPING])
+        self.assertEqual(2, self.adpt.read.call_count)
+
+        # Once the window passed, the feed is read again
+        mock_time.return_value = 101
+        self.coalescer.build_feed_task()
+        self.assertEqual(3, self.adpt.read.call_count)
+
+    def test_run_alone(self):
+        ftsk = mock.Mock()
+        batches = []
+
+        def new_batch(real=vios._CoalescedBatch):
+            batches.append(real())
+            return batches[-1]
+        with mock.patch.object(vios, '_CoalescedBatch',
+                               side_effect=new_batch):
+            self.coalescer.run(ftsk)
+        # No other operation is on its way, so there is no window to wait.
+        self.assertTrue(batches[0].full.is_set())
+        ftsk.execute.assert_called_once_with()
+        self.assertIsNone(self.coalescer._pending)
+
+        ftsk.execute.side_effect = ValueError()
+        self.assertRaises(ValueError, self.coalescer.run, ftsk)
+
+    @mock.patch('pypowervm.utils.transaction.FeedTask.execute')
+    def test_run_coalesced(self, mock_exec):
+        # Long enough not to expire; the window closes once both joined.
+        self.coalescer.window = 30
+        ftsk1, ftsk2 = self._ftsk('one'), self._ftsk('two')
+        self.adpt.read.reset_mock()
+
+        # A second spawn arrives while the first is waiting.
+        other = threading.Thread(target=self.coalescer.run, args=(ftsk2,),
+                                 kwargs={'xag': [
+                                     pvm_vios.VIOS.xags.FC_MAPPING]})
+        other.start()
+        self.coalescer.run(ftsk1)
+        other.join()
+
+        # One read of the feed (with the XAGs of both) and one execute.
+        self.assertEqual(1, self.adpt.read.call_count)
+        xag = self.adpt.read.call_args[1]['xag']
+        self.assertIn(pvm_vios.VIOS.xags.FC_MAPPING, xag)
+        self.assertIn(pvm_vios.VIOS.xags.SCSI_MAPPING, xag)
+        self.assertEqual(1, mock_exec.call_count)
+        self.assertEqual(0, len(self.coalescer._unjoined))
+
+    @mock.patch('pypowervm.utils.transaction.FeedTask.execute')
+    def test_flush_failure(self, mock_exec):
+        ftsk1, ftsk2 = self._ftsk('one'), self._ftsk('two')
+        batch = vios._CoalescedBatch()
+        batch.members = [(ftsk1, []), (ftsk2, [])]
+
+        # The combined update fails; each is run on its own and only the
+        # second one fails.
+        error = ValueError()
+        mock_exec.side_effect = [Exception(), None, error]
+        with mock.patch.object(self.feed_cache, 'invalidate') as mock_inv:
+            self.coalescer._flush(batch)
+        self.assertEqual(3, mock_exec.call_count)
+        self.assertEqual({id(ftsk2): error}, batch.errors)
+        # Each failure dropped the cached VIOS feed of the host
+        mock_inv.assert_has_calls([mock.call('host_uuid')] * 2)
+
+    def test_merge_feed_task(self):
+        tgt = self._ftsk('tgt')
+        src = self._ftsk('src')
+        self.assertTrue(vios._merge_feed_task(tgt, src))
+        for wtsk in tgt.wrapper_tasks.values():
+            self.assertEqual(2, len(wtsk.subtasks))
+
+        # Conflicting 'provides' name
+        tgt.add_functor_subtask(self.subtask, provides='prov')
+        src = self._ftsk('src')
+        src.add_functor_subtask(self.subtask, provides='prov')
+        self.assertFalse(vios._merge_feed_task(tgt, src))
+        for wtsk in tgt.wrapper_tasks.values():
+            self.assertEqual(3, len(wtsk.subtasks))
+
+        # Not built by the coalescer
+        src = vios.build_tx_feed_task(self.adpt, 'host_uuid', name='src')
+        src.add_functor_subtask(self.subtask)
+        self.assertFalse(vios._merge_feed_task(tgt, src))
+
+        # VIOS not in the target feed
+        src = vios._CoalescedFeedTask('src', [mock.Mock(spec=pvm_vios.VIOS,
+                                                        uuid='other')])
+        src.add_functor_subtask(self.subtask)
+        self.assertFalse(vios._merge_feed_task(tgt, src))
+
+    @mock.patch('pypowervm.utils.transaction.FeedTask.execute')
+    def test_flush_post_execs(self, mock_exec):
+        rets = {'uuid': {'wrapper': mock.sentinel.wrapper}}
+        mock_exec.return_value = {'wrapper_task_rets': rets}
+        post_exec = mock.Mock()
+
+        def post(wrapper_task_rets):
+            post_exec(wrapper_task_rets)
+
+        def fail(wrapper_task_rets):
+            raise ValueError()
+        ftsk1, ftsk2 = self._ftsk('one'), self._ftsk('two')
+        ftsk1.add_post_execute(tf_task.FunctorTask(post))
+        ftsk2.add_post_execute(tf_task.FunctorTask(fail))
+        self.assertEqual(1, len(ftsk1.post_execs))
+        batch = vios._CoalescedBatch()
+        batch.members = [(ftsk1, []), (ftsk2, [])]
+
+        # The post-execute tasks ran after the combined update, with its
+        # results.  Only the failing one is reported.
+        self.coalescer._flush(batch)
+        self.assertEqual(1, mock_exec.call_count)
+        post_exec.assert_called_once_with(rets)
+        self.assertEqual([id(ftsk2)], list(batch.errors))
+        self.assertIsInstance(batch.errors[id(ftsk2)], ValueError)
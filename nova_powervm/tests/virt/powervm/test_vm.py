@@ -15,6 +15,7 @@
 #    under the License.
 #
 
+import json
 import logging
 
 import mock
@@ -252,6 +253,26 @@ class TestVM(test.TestCase):
         self.assertEqual(lpar_list[0], 'z3-9-5-126-208-000001f0')
         self.assertEqual(len(lpar_list), 20)
 
+    def test_get_lpar_names_quick(self):
+        qps = [{'PartitionName': 'lpar1', 'PartitionUUID': 'UUID1',
+                'IsManagementPartition': False},
+               {'PartitionName': 'mgmt', 'PartitionUUID': 'UUID2',
+                'IsManagementPartition': 'true'},
+               {'PartitionName': 'lpar3', 'UUID': 'UUID3'}]
+        self.apt.read.return_value = mock.Mock(body=json.dumps(qps))
+        self.assertEqual(['lpar1', 'lpar3'], vm.get_lpar_names(self.apt))
+        self.assertEqual(['UUID1', 'UUID3'], vm.get_lpar_uuids(self.apt))
+        self.apt.read.assert_called_with('LogicalPartition',
+                                         suffix_type='quick',
+                                         suffix_parm='All')
+
+        # Falls back to the LPAR feed if the quick properties can't be read
+        exc = pvm_exc.HttpError(mock.Mock(status=404, reason='Not Found',
+                                          body=''))
+        self.apt.read.side_effect = [exc, self.resp]
+        lpar_uuids = vm.get_lpar_uuids(self.apt)
+        self.assertEqual(len(self.resp.feed.entries) - 1, len(lpar_uuids))
+
     @mock.patch('pypowervm.tasks.vterm.close_vterm')
     def test_dlt_lpar(self, mock_vterm):
         """Performs a delete LPAR test."""
@@ -367,6 +388,36 @@ class TestVM(test.TestCase):
         mock_getvmqp.side_effect = exception.InstanceNotFound(instance_id=123)
         self.assertFalse(vm.instance_exists(*mock_parms))
 
+        # Use the LPAR state cache
+        lpar_cache = mock.Mock(enabled=True)
+        mock_getvmqp.reset_mock()
+        self.assertTrue(vm.instance_exists(*mock_parms,
+                                           lpar_cache=lpar_cache))
+        lpar_cache.get_qp.assert_called_once_with(mock_getuuid.return_value,
+                                                  'PartitionID')
+        lpar_cache.get_qp.side_effect = exception.InstanceNotFound(
+            instance_id=123)
+        self.assertFalse(vm.instance_exists(*mock_parms,
+                                            lpar_cache=lpar_cache))
+        self.assertFalse(mock_getvmqp.called)
+
+    @mock.patch('nova.objects.Instance.get_by_uuid')
+    def test_get_instance(self, mock_get):
+        mock_get.return_value = 'inst'
+        self.assertEqual('inst', vm.get_instance('ctx', '089FFB20-5D19'))
+        mock_get.assert_called_once_with('ctx', '089ffb20-5d19')
+
+        # Not found with the high bit off, try with it on.
+        mock_get.reset_mock()
+        mock_get.side_effect = [exception.InstanceNotFound(instance_id='x'),
+                                'inst']
+        self.assertEqual('inst', vm.get_instance('ctx', '089FFB20-5D19'))
+        mock_get.assert_called_with('ctx', '889ffb20-5d19')
+
+        # Not a nova instance
+        mock_get.side_effect = exception.InstanceNotFound(instance_id='x')
+        self.assertIsNone(vm.get_instance('ctx', '089FFB20-5D19'))
+
     def test_get_vm_qp(self):
         def adapter_read(root_type, root_id=None, suffix_type=None,
                          suffix_parm=None, helpers=None):
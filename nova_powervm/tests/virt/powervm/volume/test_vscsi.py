@@ -14,7 +14,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
 import mock
+import threading
 
 from oslo_config import cfg
 
@@ -436,3 +438,61 @@ class TestVSCSIAdapterMultiVIOS(BaseVSCSITest):
         self.assertEqual(2, mock_add_map.call_count)
         self.assertEqual(2, self.ft_fx.patchers['update'].mock.call_count)
         self.assertEqual(2, mock_build_map.call_count)
+
+    @mock.patch('nova_powervm.virt.powervm.volume.vscsi.VscsiVolumeAdapter.'
+                '_discover_volume_on_vios')
+    def test_discover_volumes(self, mock_discover):
+        """Discovery results are aggregated; failures and timeouts skipped."""
+        self.flags(vscsi_discovery_timeout=0, group='powervm')
+        vios1, vios2 = self.feed
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def discover(vios_w, volume_id):
+            if vios_w is vios2:
+                # Hangs until the test is over
+                release.wait()
+            return hdisk.LUAStatus.DEVICE_AVAILABLE, 'devname', 'udid'
+        mock_discover.side_effect = discover
+
+        results = list(self.vol_drv._discover_volumes([self.vol_drv],
+                                                      self.feed))
+        self.assertEqual([(self.vol_drv, vios1,
+                           hdisk.LUAStatus.DEVICE_AVAILABLE, 'devname',
+                           'udid')], results)
+
+        # A failed discovery is skipped.
+        self.flags(vscsi_discovery_timeout=900, group='powervm')
+        mock_discover.side_effect = [
+            ValueError(), (hdisk.LUAStatus.DEVICE_AVAILABLE, 'devname',
+                           'udid')]
+        results = list(self.vol_drv._discover_volumes([self.vol_drv],
+                                                      self.feed))
+        self.assertEqual(1, len(results))
+
+    @mock.patch('pypowervm.tasks.scsi_mapper.add_map')
+    @mock.patch('pypowervm.tasks.scsi_mapper.build_vscsi_mapping')
+    @mock.patch('pypowervm.tasks.hdisk.discover_hdisk')
+    @mock.patch('nova_powervm.virt.powervm.vm.get_instance_wrapper')
+    def test_connect_volumes(self, mock_inst_wrap, mock_discover_hdisk,
+                             mock_build_map, mock_add_map):
+        """Several volumes share one VIOS feed and one VIOS update."""
+        mock_inst_wrap.return_value.can_modify_io.return_value = (True, None)
+        mock_discover_hdisk.return_value = (
+            hdisk.LUAStatus.DEVICE_AVAILABLE, 'devname', 'udid')
+        mock_build_map.return_value = 'fake_map'
+
+        vol_drv2 = copy.copy(self.vol_drv)
+        vol_drv2.connection_info = copy.deepcopy(self.vol_drv.connection_info)
+        vol_drv2.connection_info['data']['volume_id'] = 'id2'
+        vol_drv2.reset_stg_ftsk()
+
+        self.vol_drv.connect_volumes([self.vol_drv, vol_drv2])
+
+        # One VIOS feed read; each volume is discovered on each VIOS.
+        self.assertEqual(1, self.ft_fx.patchers['get'].mock.call_count)
+        self.assertEqual(4, mock_discover_hdisk.call_count)
+        # Both volumes mapped on both VIOSes, in one update per VIOS.
+        self.assertEqual(4, mock_add_map.call_count)
+        self.assertEqual(2, self.ft_fx.patchers['update'].mock.call_count)
+        self.assertEqual('udid', vol_drv2._get_udid())
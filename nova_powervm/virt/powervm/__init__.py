@@ -37,14 +37,53 @@ pvm_opts = [
                help='The size of the media repository (in GB) for the '
                     'metadata for config drive.  Only used if the media '
                     'repository needs to be created.'),
+    cfg.IntOpt('vopt_cleanup_interval',
+               default=30,
+               help='The number of seconds between the background removals '
+                    'of the config drive media of destroyed VMs.  The media '
+                    'of several destroys is removed with a single update of '
+                    'the media repository.  Config drive media that is not '
+                    'mapped to any VM (ex. left behind by a failure) is also '
+                    'removed.  A value of 0 removes the media during the '
+                    'destroy instead.'),
     cfg.StrOpt('image_meta_local_path',
                default='/tmp/cfgdrv/',
                help='The location where the config drive ISO files should be '
                     'built.'),
+    cfg.BoolOpt('cfg_drive_in_memory',
+                default=False,
+                help='If True, the config drive ISO is built in a temporary '
+                     'directory under cfg_drive_tmpfs_path (rather than in '
+                     'image_meta_local_path), read into memory and uploaded '
+                     'from there.  Avoids disk I/O on the management '
+                     'partition when many instances are spawned at once.'),
+    cfg.StrOpt('cfg_drive_tmpfs_path',
+               default='/dev/shm',
+               help='A (tmpfs) directory in which config drive ISOs are '
+                    'built if cfg_drive_in_memory is True.  If it does not '
+                    'exist, the system temporary directory is used.'),
+    cfg.IntOpt('cfg_drive_build_workers',
+               default=8,
+               help='The maximum number of config drive ISOs that are built '
+                    '(each by its own mkisofs process) at once.  A value of '
+                    '0 does not limit the builds.'),
     cfg.StrOpt('disk_driver',
                default='localdisk',
                help='The disk driver to use for PowerVM disks. '
-               'Valid options are: localdisk, ssp')
+               'Valid options are: localdisk, ssp'),
+    cfg.FloatOpt('spawn_coalesce_window',
+                 default=0.25,
+                 help='The number of seconds to collect the Virtual I/O '
+                      'Server storage mapping updates of concurrent spawns, '
+                      'so that they are sent as a single update per Virtual '
+                      'I/O Server.  A value of 0 disables coalescing and '
+                      'each spawn updates the Virtual I/O Servers itself.'),
+    cfg.IntOpt('flow_max_workers',
+               default=4,
+               help='The maximum number of steps of a spawn or destroy that '
+                    'may run in parallel (ex. the image upload alongside the '
+                    'network plumbing).  A value of 1 runs the steps one at '
+                    'a time.')
 ]
 
 
@@ -0,0 +1,315 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Host-wide caches of PowerVM REST data used by the compute driver."""
+
+import copy
+import threading
+import time
+
+from nova import exception
+from oslo_concurrency import lockutils
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from pypowervm import const as pvm_const
+from pypowervm import exceptions as pvm_exc
+from pypowervm.wrappers import logical_partition as pvm_lpar
+from pypowervm.wrappers import managed_system as pvm_ms
+from pypowervm.wrappers import virtual_io_server as pvm_vios
+
+cache_opts = [
+    cfg.IntOpt('lpar_state_cache_ttl',
+               default=10,
+               help='The number of seconds that the LPAR state cache (used '
+                    'to answer get_info calls) may be used before it is '
+                    'revalidated against the REST API.  Revalidation uses '
+                    'the etag of the LPAR feed, so it is cheap if nothing '
+                    'changed.  A value of 0 disables the cache and every '
+                    'get_info call queries the REST API directly.'),
+    cfg.BoolOpt('lpar_state_events',
+                default=True,
+                help='If True (and the LPAR state cache is enabled), the '
+                     'cache is kept current from the PowerVM REST event '
+                     'feed instead of being revalidated every '
+                     'lpar_state_cache_ttl seconds.  State changes are also '
+                     'reported to nova as lifecycle events.'),
+    cfg.BoolOpt('vios_feed_cache',
+                default=True,
+                help='If True, the Virtual I/O Server feeds read for storage '
+                     'operations are cached.  Each read is then a conditional '
+                     'GET, and the (large) feed is only downloaded again if '
+                     'it changed.')
+]
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+CONF.register_opts(cache_opts, group='powervm')
+
+# Quick property names that the cache can answer.  These match the names used
+# by the LogicalPartition 'quick' properties in the REST API.
+QP_STATE = 'PartitionState'
+QP_ID = 'PartitionID'
+QP_NAME = 'PartitionName'
+QP_MEM = 'CurrentMemory'
+QP_PROCS = 'AllocatedVirtualProcessors'
+
+
+def _lpar_qps(lpar_w):
+    """Builds the quick property dictionary from an LPAR wrapper.
+
+    :param lpar_w: The pypowervm LPAR wrapper.
+    :return: Dictionary of quick property name to value.
+    """
+    proc_cfg = lpar_w.proc_config
+    if proc_cfg.has_dedicated:
+        procs = proc_cfg.dedicated_proc_cfg.desired
+    else:
+        procs = proc_cfg.shared_proc_cfg.desired_virtual
+    return {QP_STATE: lpar_w.state, QP_ID: lpar_w.id, QP_NAME: lpar_w.name,
+            QP_MEM: lpar_w.mem_config.current, QP_PROCS: procs}
+
+
+class LPARStateCache(object):
+    """A cache of the state of every LPAR on the host.
+
+    The compute manager's power state sync calls get_info for every instance
+    on the host.  Each call would otherwise cost one REST call per attribute.
+    This cache is filled from a single read of the LPAR feed, and is shared
+    across all of the get_info calls.
+
+    Once the TTL expires, the next lookup revalidates the whole feed with a
+    conditional GET (using the feed etag).  If nothing changed, the API
+    returns a 304 and the existing data is kept.
+
+    Changes to a single LPAR (made by the driver itself, or reported by an
+    event) only refresh that LPAR's entry.  The feed etag is kept, so the
+    next revalidation of the feed is still a conditional GET.
+
+    If an event handler keeps the cache current (see event.py), the cache is
+    flagged as event_driven.  The TTL then no longer applies; the feed is only
+    read again when it is explicitly invalidated.
+    """
+
+    def __init__(self, adapter, host_uuid, ttl=None):
+        """Creates the LPAR state cache.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The UUID of the host whose LPARs are cached.
+        :param ttl: (Optional) The number of seconds before the cache data
+                    is revalidated.  Defaults to the lpar_state_cache_ttl
+                    configuration option.
+        """
+        self.adapter = adapter
+        self.host_uuid = host_uuid
+        self.ttl = CONF.powervm.lpar_state_cache_ttl if ttl is None else ttl
+
+        # Set when the REST event feed is used to keep the cache current.
+        self.event_driven = False
+
+        # Dictionary of LPAR UUID to the quick property dictionary
+        self._lpars = {}
+        # Dictionary of LPAR UUID to the etag of its LPAR entry
+        self._lpar_etags = {}
+        # UUIDs of the LPARs whose entries must be read again before use
+        self._stale = set()
+        self._etag = None
+        self._refreshed = None
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def _is_stale(self):
+        if self._refreshed is None:
+            return True
+        if self.event_driven:
+            return False
+        return time.time() - self._refreshed >= self.ttl
+
+    @lockutils.synchronized('pvm_lpar_state_cache')
+    def refresh(self, force=False):
+        """Revalidates the cache against the REST API if needed.
+
+        :param force: If True, the feed is revalidated even if the TTL has not
+                      yet expired.
+        """
+        if not (force or self._is_stale()):
+            return
+
+        resp = self.adapter.read(pvm_ms.System.schema_type,
+                                 root_id=self.host_uuid,
+                                 child_type=pvm_lpar.LPAR.schema_type,
+                                 etag=self._etag)
+        self._refreshed = time.time()
+        if resp.status == pvm_const.HTTPStatus.NO_CHANGE:
+            LOG.debug('LPAR feed unchanged (etag %s).', self._etag)
+            return
+
+        lpars, etags = {}, {}
+        for lpar_w in pvm_lpar.LPAR.wrap(resp):
+            lpars[lpar_w.uuid.upper()] = _lpar_qps(lpar_w)
+            etags[lpar_w.uuid.upper()] = lpar_w.etag
+        self._lpars, self._lpar_etags = lpars, etags
+        self._stale.clear()
+        self._etag = resp.etag
+        LOG.debug('LPAR state cache loaded %d LPARs.', len(lpars))
+
+    @lockutils.synchronized('pvm_lpar_state_cache')
+    def invalidate(self, lpar_uuid=None):
+        """Forces the next lookup to revalidate against the REST API.
+
+        Should be invoked after the driver itself changes an LPAR (power
+        on/off, create, delete) so that the change is seen immediately.
+
+        :param lpar_uuid: (Optional) The UUID of the LPAR that changed.  Only
+                          that LPAR is read again on its next lookup.  If not
+                          specified, the whole feed is revalidated.
+        """
+        if lpar_uuid is None:
+            self._refreshed = None
+        else:
+            self._stale.add(lpar_uuid.upper())
+
+    @lockutils.synchronized('pvm_lpar_state_cache')
+    def remove(self, lpar_uuid):
+        """Removes a single LPAR from the cache.
+
+        :param lpar_uuid: The (PowerVM) UUID of the LPAR.
+        """
+        self._remove(lpar_uuid.upper())
+
+    @lockutils.synchronized('pvm_lpar_state_cache')
+    def refresh_lpar(self, lpar_uuid):
+        """Reads a single LPAR and updates its cached data.
+
+        If the LPAR no longer exists, it is removed from the cache.
+
+        :param lpar_uuid: The (PowerVM) UUID of the LPAR.
+        :return: The quick property dictionary of the LPAR prior to the
+                 refresh.  None if the LPAR was not in the cache.
+        :return: The quick property dictionary of the LPAR.  None if the LPAR
+                 no longer exists.
+        """
+        lpar_uuid = lpar_uuid.upper()
+        old_qps = self._lpars.get(lpar_uuid)
+        try:
+            resp = self.adapter.read(pvm_lpar.LPAR.schema_type,
+                                     root_id=lpar_uuid)
+        except pvm_exc.Error as e:
+            if e.response is not None and e.response.status == 404:
+                self._remove(lpar_uuid)
+                return old_qps, None
+            raise
+        self._update(pvm_lpar.LPAR.wrap(resp))
+        return old_qps, self._lpars.get(lpar_uuid)
+
+    def _update(self, lpar_w):
+        # Callers must hold the pvm_lpar_state_cache lock.
+        lpar_uuid = lpar_w.uuid.upper()
+        self._lpars[lpar_uuid] = _lpar_qps(lpar_w)
+        self._lpar_etags[lpar_uuid] = lpar_w.etag
+        self._stale.discard(lpar_uuid)
+
+    def _remove(self, lpar_uuid):
+        # Callers must hold the pvm_lpar_state_cache lock.
+        self._lpars.pop(lpar_uuid, None)
+        self._lpar_etags.pop(lpar_uuid, None)
+        self._stale.discard(lpar_uuid)
+
+    def get_etag(self, lpar_uuid):
+        """Returns the etag of the cached LPAR entry (or None)."""
+        return self._lpar_etags.get(lpar_uuid.upper())
+
+    def get_qp(self, lpar_uuid, qprop):
+        """Returns a quick property of an LPAR from the cache.
+
+        :param lpar_uuid: The (PowerVM) UUID of the LPAR.
+        :param qprop: The quick property name.  One of the QP_* constants.
+        :return: The value of the quick property.
+        :raise InstanceNotFound: If the LPAR does not exist on the host.
+        """
+        lpar_uuid = lpar_uuid.upper()
+        self.refresh()
+        qps = self._lpars.get(lpar_uuid)
+        if qps is None or lpar_uuid in self._stale:
+            # Changed, or could be a newly created LPAR.  Read just that LPAR
+            # before deciding that it does not exist.
+            qps = self.refresh_lpar(lpar_uuid)[1]
+            if qps is None:
+                raise exception.InstanceNotFound(instance_id=lpar_uuid)
+        return qps[qprop]
+
+
+class VIOSFeedCache(object):
+    """A cache of the Virtual I/O Server feeds of the hosts.
+
+    The VIOS feed (with the storage extended attribute groups) is the largest
+    payload the driver reads, and nearly every storage operation reads it.
+    The feed is cached for each host and set of extended attribute groups.
+    Each read sends the etag of the cached feed, so that the feed is only
+    downloaded again if it changed (otherwise the API returns a 304).
+
+    Every caller gets its own copy of the wrappers, as the FeedTasks modify
+    them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Dictionary of (host UUID, frozenset(xag)) to the feed Response
+        self._feeds = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, adapter, host_uuid, xag=None):
+        """Returns the VIOS wrappers of a host.
+
+        :param adapter: The pypowervm adapter for the query.
+        :param host_uuid: The host server's UUID.
+        :param xag: Optional list of extended attributes to use.
+        :return: List of VIOS wrappers (all of them, active or not).
+        """
+        key = (host_uuid, frozenset(xag or []))
+        with self._lock:
+            cached = self._feeds.get(key)
+        resp = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
+                            child_type=pvm_vios.VIOS.schema_type, xag=xag,
+                            etag=None if cached is None else cached.etag)
+        if cached is not None and (
+                resp.status == pvm_const.HTTPStatus.NO_CHANGE):
+            with self._lock:
+                self.hits += 1
+            return pvm_vios.VIOS.wrap(copy.deepcopy(cached))
+
+        with self._lock:
+            self.misses += 1
+            self._feeds[key] = copy.deepcopy(resp)
+        return pvm_vios.VIOS.wrap(resp)
+
+    def invalidate(self, host_uuid=None):
+        """Drops the cached feeds, so that the next reads are full reads.
+
+        :param host_uuid: (Optional) The host whose feeds are dropped.
+                          Defaults to all hosts.
+        """
+        with self._lock:
+            for key in list(self._feeds):
+                if host_uuid is None or key[0] == host_uuid:
+                    del self._feeds[key]
+
+
+# The VIOS feed cache, shared by the whole process.
+VIOS_FEED_CACHE = VIOSFeedCache()
@@ -16,12 +16,16 @@
 #    under the License.
 
 import abc
+import threading
+import time
 
+from oslo_config import cfg
 import oslo_log.log as logging
 from oslo_utils import units
 import six
+from six.moves import queue
 
-from nova.i18n import _LW
+from nova.i18n import _LI, _LW
 from nova import image
 import pypowervm.const as pvm_const
 import pypowervm.tasks.scsi_mapper as tsk_map
@@ -31,7 +35,18 @@ import pypowervm.wrappers.virtual_io_server as pvm_vios
 from nova_powervm.virt.powervm import exception as npvmex
 from nova_powervm.virt.powervm import vm
 
+disk_opts = [
+    cfg.IntOpt('image_prefetch_chunks',
+               default=16,
+               help='The number of chunks of a glance image that may be '
+                    'downloaded ahead of its upload to the PowerVM storage, '
+                    'so that the download and the upload overlap.  A value '
+                    'of 0 disables the prefetch.')
+]
+
 LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+CONF.register_opts(disk_opts, group='powervm')
 
 
 class DiskType(object):
@@ -46,23 +61,191 @@ class IterableToFileAdapter(object):
     As Glance client returns an iterable, but PowerVM requires a file,
     this is the adapter between the two.
 
-    Taken from xenapi/image/apis.py
+    The current chunk is consumed through a memoryview, so a read copies only
+    the data it returns.  If prefetch is set, a separate thread iterates up
+    to that many chunks ahead of the reads, so that the producer (ex. the
+    glance download) and the consumer (ex. the upload to the VIOS) overlap.
+
+    The adapter is a context manager.  Closing it stops the prefetch, so it
+    must be closed once the upload is done, or has failed.
+
+    Originally taken from xenapi/image/apis.py
     """
 
-    def __init__(self, iterable):
-        self.iterator = iterable.__iter__()
-        self.remaining_data = ''
+    _DONE = object()
 
-    def read(self, size):
-        chunk = self.remaining_data
+    def __init__(self, iterable, prefetch=0, name=None):
+        """Creates the adapter.
+
+        :param iterable: The iterable of chunks (byte strings) of data.
+        :param prefetch: (Optional) The maximum number of chunks to iterate
+                         ahead of the reads, on a separate thread.  If 0,
+                         the iterable is consumed by the reads.
+        :param name: (Optional) A name for the data, for logging.
+        """
+        self.iterator = iter(iterable)
+        self.name = name
+        self.prefetch = prefetch
+        # The unread part of the current chunk
+        self._view = memoryview(b'')
+        self._queue = None
+        self._prefetcher = None
+        self._stop = threading.Event()
+        self._eof = False
+        # The error of the prefetch (raised again by every read).
+        self._error = None
+
+        # Counters
+        self.bytes_read = 0
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def elapsed(self):
+        """Seconds from the first read to the end of the data (or now)."""
+        if self.start_time is None:
+            return 0
+        return (self.end_time or time.time()) - self.start_time
+
+    @property
+    def throughput(self):
+        """Bytes read per second."""
+        elapsed = self.elapsed
+        return self.bytes_read / elapsed if elapsed else 0
+
+    def _prefetch(self):
+        def _put(item):
+            # Give up if the adapter was closed.
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        # The reads wait on the queue, so it always ends with the end of the
+        # data or the error (unless the adapter is closed).
+        last = self._DONE
         try:
-            while not chunk:
-                chunk = next(self.iterator)
-        except StopIteration:
-            return ''
-        return_value = chunk[0:size]
-        self.remaining_data = chunk[size:]
-        return return_value
+            for chunk in self.iterator:
+                if not _put(chunk):
+                    return
+        except Exception as e:
+            last = e
+        _put(last)
+
+    def _get_prefetched(self):
+        """Returns the next item queued by the prefetch thread."""
+        while True:
+            if self._stop.is_set():
+                raise ValueError('Read of a closed %s.' %
+                                 self.__class__.__name__)
+            try:
+                return self._queue.get(timeout=1)
+            except queue.Empty:
+                pass
+
+    def _next_chunk(self):
+        """Returns the next (non-empty) chunk of data, or None at the end."""
+        if self._error is not None:
+            raise self._error
+        if self._eof:
+            return None
+        if self.start_time is None:
+            self.start_time = time.time()
+            if self.prefetch > 0:
+                self._queue = queue.Queue(maxsize=self.prefetch)
+                self._prefetcher = threading.Thread(target=self._prefetch)
+                self._prefetcher.daemon = True
+                self._prefetcher.start()
+        while True:
+            if self._queue is None:
+                chunk = next(self.iterator, self._DONE)
+            else:
+                chunk = self._get_prefetched()
+                if isinstance(chunk, Exception):
+                    self._error = chunk
+                    raise chunk
+            if chunk is self._DONE:
+                self._end()
+                return None
+            if chunk:
+                return chunk
+
+    def _end(self):
+        self._eof = True
+        self.end_time = time.time()
+        LOG.info(_LI("Read %(bytes)d bytes of %(name)s in %(secs).1f seconds "
+                     "(%(rate).1f MB/s)."),
+                 {'bytes': self.bytes_read, 'name': self.name or 'stream',
+                  'secs': self.elapsed, 'rate': self.throughput / units.Mi})
+
+    def readinto(self, buf):
+        """Reads data into a pre-allocated, writable bytes-like object.
+
+        :param buf: The buffer to fill.
+        :return: The number of bytes read into the buffer.  0 at the end of
+                 the data.
+        """
+        target = memoryview(buf)
+        filled = 0
+        while filled < len(target):
+            if not self._view:
+                chunk = self._next_chunk()
+                if chunk is None:
+                    break
+                self._view = memoryview(chunk)
+            count = min(len(target) - filled, len(self._view))
+            target[filled:filled + count] = self._view[:count]
+            self._view = self._view[count:]
+            filled += count
+        self.bytes_read += filled
+        return filled
+
+    def read(self, size=-1):
+        """Reads up to size bytes.
+
+        As with a pipe, fewer bytes than requested may be returned before the
+        end of the data.
+
+        :param size: The maximum number of bytes to return.  If negative, all
+                     of the remaining data is returned.
+        :return: The data.  An empty string at the end of the data.
+        """
+        if size is None or size < 0:
+            data = [self._view.tobytes()]
+            self.bytes_read += len(self._view)
+            self._view = memoryview(b'')
+            chunk = self._next_chunk()
+            while chunk is not None:
+                data.append(chunk)
+                self.bytes_read += len(chunk)
+                chunk = self._next_chunk()
+            return b''.join(data)
+
+        if not self._view:
+            chunk = self._next_chunk()
+            if chunk is None:
+                return b''
+            if len(chunk) <= size:
+                # The whole chunk - no copy needed.
+                self.bytes_read += len(chunk)
+                return chunk
+            self._view = memoryview(chunk)
+        data = self._view[:size].tobytes()
+        self._view = self._view[size:]
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        """Stops the prefetch (if any)."""
+        self._stop.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 @six.add_metaclass(abc.ABCMeta)
@@ -198,19 +381,33 @@ class DiskAdapter(object):
         """
         return 0
 
+    @property
+    def capacity_info(self):
+        """The capacity of the storage, and the part of it that is used.
+
+        Drivers that read both from the same REST object should override
+        this, so that both come from a single read.
+
+        :return: Tuple of the capacity and the used capacity, in gigabytes.
+        """
+        return self.capacity, self.capacity_used
+
     def _get_image_upload(self, context, image_meta):
         """Returns the stream that can be sent to pypowervm.
 
         The pypowervm API requires a File be sent up for the image.  This
         method will get the appropriate file adapter (IterableToFileAdapter)
-        built for the invoker.
+        built for the invoker.  The caller must close it (ex. use it as a
+        context manager), so that the prefetch stops if the upload fails.
 
         :param context: User context
         :param image_meta: The image metadata.
         :return: The stream to send to pypowervm.
         """
         chunks = self.image_api.download(context, image_meta['id'])
-        return IterableToFileAdapter(chunks)
+        return IterableToFileAdapter(
+            chunks, prefetch=CONF.powervm.image_prefetch_chunks,
+            name='image %s' % image_meta['id'])
 
     @staticmethod
     def _get_disk_name(disk_type, instance, short=False):
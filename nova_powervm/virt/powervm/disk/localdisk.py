@@ -15,20 +15,33 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import math
+import os
+import time
+
+from oslo_concurrency import lockutils
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from oslo_utils import excutils
+from oslo_utils import units
 
 from nova import exception as nova_exc
-from nova.i18n import _LI, _LE
+from nova.i18n import _LI, _LE, _LW
+from nova import utils
+from pypowervm import const as pvm_const
 from pypowervm import exceptions as pvm_exc
 from pypowervm.tasks import scsi_mapper as tsk_map
 from pypowervm.tasks import storage as tsk_stg
+from pypowervm import util as pvm_util
 from pypowervm.wrappers import managed_system as pvm_ms
 from pypowervm.wrappers import storage as pvm_stg
 from pypowervm.wrappers import virtual_io_server as pvm_vios
 
 from nova_powervm.virt.powervm.disk import driver as disk_dvr
 from nova_powervm.virt.powervm import exception as npvmex
+from nova_powervm.virt.powervm import mgmt
 from nova_powervm.virt.powervm import vios
 from nova_powervm.virt.powervm import vm
 
@@ -48,13 +61,37 @@ localdisk_opts = [
                     'one that matches the volume_group_vios_name.  This is '
                     'only needed if the system has multiple Virtual I/O '
                     'Servers with a non-rootvg volume group whose name is '
-                    'duplicated.')
+                    'duplicated.'),
+    cfg.BoolOpt('localdisk_image_cache',
+                default=False,
+                help='If True, a copy of each Glance image is kept as a '
+                     'virtual disk in the volume group.  Boot disks are then '
+                     'copied from that virtual disk on the host, rather than '
+                     'downloaded from Glance for every deploy.'),
+    cfg.IntOpt('localdisk_image_cache_min_free_gb',
+               default=10,
+               help='The amount of free space (in GB) to keep in the volume '
+                    'group when the localdisk image cache is enabled.  The '
+                    'least recently used cached images are removed as '
+                    'needed to keep this much space free.'),
+    cfg.BoolOpt('localdisk_image_cache_remove_orphans',
+                default=False,
+                help='If True, the image_* virtual disks of the volume group '
+                     'that the localdisk image cache of this host does not '
+                     'track are removed when room is needed.  Otherwise they '
+                     'are only logged.  Only enable this if the volume group '
+                     'is not shared with other hosts or tools that create '
+                     'disks with that prefix.')
 ]
 
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 CONF.register_opts(localdisk_opts, group='powervm')
+CONF.import_opt('instances_path', 'nova.compute.manager')
+
+# The prefix of the names of the cached image virtual disks.
+IMAGE_CACHE_PREFIX = 'image_'
 
 
 class LocalStorage(disk_dvr.DiskAdapter):
@@ -67,6 +104,13 @@ class LocalStorage(disk_dvr.DiskAdapter):
         LOG.info(_LI("Local Storage driver initialized: volume group: '%s'"),
                  self.vg_name)
 
+        self.image_cache = (ImageCache(self)
+                            if CONF.powervm.localdisk_image_cache else None)
+
+        # The volume group read for the capacity_info, revalidated with its
+        # etag.  Only used for the capacity (never updated).
+        self._capacity_vg = None
+
     @property
     def vios_uuids(self):
         """List the UUIDs of the Virtual I/O Servers hosting the storage.
@@ -107,6 +151,20 @@ class LocalStorage(disk_dvr.DiskAdapter):
         # Subtract available from capacity
         return float(vg_wrap.capacity) - float(vg_wrap.available_size)
 
+    @property
+    def capacity_info(self):
+        """The capacity and used capacity of the storage, in gigabytes.
+
+        Both come from a single read of the volume group, which is a
+        conditional read (with the etag of the previous one).
+        """
+        vg_wrap = self._capacity_vg
+        resp = self._get_vg(etag=None if vg_wrap is None else vg_wrap.etag)
+        if vg_wrap is None or resp.status != pvm_const.HTTPStatus.NO_CHANGE:
+            vg_wrap = self._capacity_vg = pvm_stg.VG.wrap(resp)
+        capacity = float(vg_wrap.capacity)
+        return capacity, capacity - float(vg_wrap.available_size)
+
     def delete_disks(self, context, instance, storage_elems):
         """Removes the specified disks.
 
@@ -201,24 +259,130 @@ class LocalStorage(disk_dvr.DiskAdapter):
         """
         LOG.info(_LI('Create disk.'))
 
-        # Transfer the image
-        stream = self._get_image_upload(context, image)
+        # Copy the disk from the image cache, if possible.
+        if self.image_cache is not None:
+            vdisk = self._create_disk_from_cache(context, instance, image,
+                                                 disk_size, image_type)
+            if vdisk is not None:
+                return vdisk
+
         vol_name = self._get_disk_name(image_type, instance, short=True)
 
         # Disk size to API is in bytes.  Input from method is in Gb
         disk_bytes = self._disk_gb_to_bytes(disk_size, floor=image['size'])
 
-        # This method will create a new disk at our specified size.  It will
-        # then put the image in the disk.  If the disk is bigger, user can
-        # resize the disk, create a new partition, etc...
+        # Transfer the image.  This method will create a new disk at our
+        # specified size.  It will then put the image in the disk.  If the
+        # disk is bigger, user can resize the disk, create a new partition,
+        # etc...
         # If the image is bigger than disk, API should make the disk big
         # enough to support the image (up to 1 Gb boundary).
-        vdisk, f_wrap = tsk_stg.upload_new_vdisk(
-            self.adapter, self._vios_uuid, self.vg_uuid, stream, vol_name,
-            image['size'], d_size=disk_bytes)
+        with self._get_image_upload(context, image) as stream:
+            vdisk, f_wrap = tsk_stg.upload_new_vdisk(
+                self.adapter, self._vios_uuid, self.vg_uuid, stream,
+                vol_name, image['size'], d_size=disk_bytes)
+
+        return vdisk
+
+    def _create_disk_from_cache(self, context, instance, image, disk_size,
+                                image_type):
+        """Creates a disk as a copy of the cached image virtual disk.
+
+        :param context: nova context used to retrieve image from glance
+        :param instance: instance to create the disk for.
+        :param image: image dict used to locate the image in glance
+        :param disk_size: The size of the disk to create in GB.
+        :param image_type: the image type. See disk constants above.
+        :return: The VDisk that was created.  None if the image can not be
+                 cached (the caller should upload it directly).
+        """
+        img_vdisk = self.image_cache.acquire(context, image)
+        if img_vdisk is None:
+            return None
 
+        vol_name = self._get_disk_name(image_type, instance, short=True)
+        disk_bytes = self._disk_gb_to_bytes(disk_size, floor=image['size'])
+        try:
+            self.image_cache.make_room(disk_bytes)
+            # Size to the next GB, the same as upload_new_vdisk does.
+            vdisk = tsk_stg.crt_vdisk(
+                self.adapter, self._vios_uuid, self.vg_uuid, vol_name,
+                math.ceil(pvm_util.convert_bytes_to_gb(disk_bytes)))
+            try:
+                self._copy_vdisk(img_vdisk, vdisk)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    tsk_stg.rm_vg_storage(self._get_vg_wrap(),
+                                          vdisks=[vdisk])
+        finally:
+            self.image_cache.release(img_vdisk)
         return vdisk
 
+    def _copy_vdisk(self, src_vdisk, tgt_vdisk):
+        """Copies the contents of one virtual disk to another.
+
+        Both disks are mapped to the management partition and copied there,
+        so the data does not leave the host.
+
+        :param src_vdisk: The VDisk to copy from.  This is a cached image, and
+                          is mapped through the image cache (which shares
+                          the mapping between concurrent copies).
+        :param tgt_vdisk: The VDisk to copy to.
+        """
+        src_path = self.image_cache.map_to_mgmt(src_vdisk)
+        try:
+            tgt_path = self._map_vdisk_to_mgmt(tgt_vdisk)
+            try:
+                LOG.info(_LI('Copying cached image disk %(src)s to disk '
+                             '%(tgt)s.'),
+                         {'src': src_vdisk.name, 'tgt': tgt_vdisk.name})
+                utils.execute('dd', 'if=%s' % src_path, 'of=%s' % tgt_path,
+                              'bs=4M', 'iflag=direct', 'oflag=direct',
+                              run_as_root=True)
+            finally:
+                self._unmap_vdisk_from_mgmt(tgt_vdisk, tgt_path)
+        finally:
+            self.image_cache.unmap_from_mgmt(src_vdisk)
+
+    def _map_vdisk_to_mgmt(self, vdisk):
+        """Maps a virtual disk to the management partition and discovers it.
+
+        :param vdisk: The VDisk to map.
+        :return: The path of the disk's block device on the management
+                 partition.
+        """
+        vios_w = tsk_map.add_vscsi_mapping(self.host_uuid, self._vios_uuid,
+                                           self.mp_uuid, vdisk)
+        try:
+            mappings = tsk_map.find_maps(vios_w.scsi_mappings,
+                                         client_lpar_id=self.mp_uuid,
+                                         stg_elem=vdisk)
+            if not mappings:
+                raise npvmex.NewMgmtMappingNotFoundException(
+                    stg_name=vdisk.name, vios_name=vios_w.name)
+            return mgmt.discover_vscsi_disk(mappings[0])
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self.disconnect_disk_from_mgmt(self._vios_uuid, vdisk.name)
+
+    def _unmap_vdisk_from_mgmt(self, vdisk, dev_path):
+        """Removes a virtual disk from the management partition.
+
+        Failures are logged, not raised; a leftover mapping to the management
+        partition is harmless.
+
+        :param vdisk: The VDisk to unmap.
+        :param dev_path: The path of the disk's block device on the management
+                         partition.
+        """
+        try:
+            mgmt.remove_block_dev(dev_path)
+            self.disconnect_disk_from_mgmt(self._vios_uuid, vdisk.name)
+        except Exception as e:
+            LOG.warn(_LW('Unable to remove disk %(disk)s from the management '
+                         'partition: %(err)s'),
+                     {'disk': vdisk.name, 'err': e})
+
     def connect_disk(self, context, instance, disk_info, stg_ftsk=None):
         """Connects the disk image to the Virtual Machine.
 
@@ -330,11 +494,228 @@ class LocalStorage(disk_dvr.DiskAdapter):
 
         raise npvmex.VGNotFound(vg_name=name)
 
-    def _get_vg(self):
+    def _get_vg(self, etag=None):
         vg_rsp = self.adapter.read(
             pvm_vios.VIOS.schema_type, root_id=self._vios_uuid,
-            child_type=pvm_stg.VG.schema_type, child_id=self.vg_uuid)
+            child_type=pvm_stg.VG.schema_type, child_id=self.vg_uuid,
+            etag=etag)
         return vg_rsp
 
     def _get_vg_wrap(self):
         return pvm_stg.VG.wrap(self._get_vg())
+
+
+class ImageCache(object):
+    """A cache of Glance images as virtual disks in the volume group.
+
+    Each cached image is a virtual disk named IMAGE_CACHE_PREFIX followed by
+    (the start of) the image ID.  The index of the cached images (image ID,
+    UDID and the time last used) is saved in the instances_path, so the cache
+    survives a restart of the compute service.  A virtual disk with the cache
+    prefix that is not in the index (ex. an upload that did not complete) is
+    only logged when room is made, unless
+    localdisk_image_cache_remove_orphans is set.  In that case, it is removed
+    first.
+
+    When space is needed in the volume group, the least recently used cached
+    images are removed first.  Images that are in use by a copy are never
+    removed.
+    """
+
+    def __init__(self, disk_dvr):
+        """Creates the image cache.
+
+        :param disk_dvr: The LocalStorage disk driver.
+        """
+        self.disk_dvr = disk_dvr
+        self._index_path = os.path.join(CONF.instances_path,
+                                        'pvm_localdisk_image_cache.json')
+        # Dictionary of VDisk name to the dictionary of image_id, udid and
+        # last_used.
+        self._index = self._load_index()
+        # The number of users of each cached VDisk (by name)
+        self._in_use = collections.Counter()
+        # Dictionary of VDisk name to its path on the management partition
+        self._mgmt_paths = {}
+        self._mgmt_users = collections.Counter()
+
+    @staticmethod
+    def vdisk_name(image_id):
+        """The name of the cached VDisk for an image."""
+        return pvm_util.sanitize_file_name_for_api(
+            image_id.replace('-', ''), prefix=IMAGE_CACHE_PREFIX,
+            max_len=pvm_const.MaxLen.VDISK_NAME)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path) as index_file:
+                return jsonutils.load(index_file)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_index(self):
+        tmp_path = self._index_path + '.tmp'
+        with open(tmp_path, 'w') as index_file:
+            jsonutils.dump(self._index, index_file)
+        os.rename(tmp_path, self._index_path)
+
+    def acquire(self, context, image):
+        """Returns the cached VDisk for an image, uploading it if needed.
+
+        The VDisk will not be removed from the cache until release is called.
+
+        :param context: nova context used to retrieve image from glance
+        :param image: image dict used to locate the image in glance
+        :return: The cached VDisk.  None if the image can not be cached.
+        """
+        name = self.vdisk_name(image['id'])
+        with lockutils.lock('pvm_image_cache_%s' % name):
+            entry = self._index.get(name)
+            if entry is not None and entry['image_id'] != image['id']:
+                # A different image has the same (truncated) name.
+                LOG.info(_LI('Image %(image)s can not be cached; another '
+                             'image is cached as %(name)s.'),
+                         {'image': image['id'], 'name': name})
+                return None
+
+            self._in_use[name] += 1
+            try:
+                vdisk = self._find_vdisk(name, entry)
+                if vdisk is None:
+                    LOG.info(_LI('Image %s is not cached.  Uploading it.'),
+                             image['id'])
+                    self.make_room(image['size'])
+                    vdisk = self._upload(context, image, name)
+                else:
+                    LOG.info(_LI('Using cached image %(image)s (%(name)s).'),
+                             {'image': image['id'], 'name': name})
+                self._touch(name)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    self._in_use[name] -= 1
+        return vdisk
+
+    def release(self, vdisk):
+        """Indicates a VDisk returned by acquire is no longer being used."""
+        self._in_use[vdisk.name] -= 1
+
+    @lockutils.synchronized('pvm_image_cache')
+    def _touch(self, name):
+        self._index[name]['last_used'] = time.time()
+        self._save_index()
+
+    def _find_vdisk(self, name, entry):
+        """Returns the cached VDisk, if it (still) exists in the VG."""
+        if entry is None:
+            return None
+        for vdisk in self.disk_dvr._get_vg_wrap().virtual_disks:
+            if vdisk.name == name and vdisk.udid == entry['udid']:
+                return vdisk
+        self._drop(name)
+        return None
+
+    @lockutils.synchronized('pvm_image_cache')
+    def _drop(self, name):
+        if self._index.pop(name, None) is not None:
+            self._save_index()
+
+    def _upload(self, context, image, name):
+        """Uploads an image from Glance in to a new cached VDisk."""
+        try:
+            with self.disk_dvr._get_image_upload(context, image) as stream:
+                vdisk, f_wrap = tsk_stg.upload_new_vdisk(
+                    self.disk_dvr.adapter, self.disk_dvr._vios_uuid,
+                    self.disk_dvr.vg_uuid, stream, name, image['size'])
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                # Do not leave a partial image behind.
+                vg_wrap = self.disk_dvr._get_vg_wrap()
+                partial = [vd for vd in vg_wrap.virtual_disks
+                           if vd.name == name]
+                if partial:
+                    tsk_stg.rm_vg_storage(vg_wrap, vdisks=partial)
+
+        with lockutils.lock('pvm_image_cache'):
+            self._index[name] = {'image_id': image['id'], 'udid': vdisk.udid,
+                                 'last_used': time.time()}
+            self._save_index()
+        return vdisk
+
+    @lockutils.synchronized('pvm_image_cache')
+    def make_room(self, size):
+        """Removes cached images to make room for a new disk.
+
+        The least recently used images in the index are removed, until the
+        new disk fits with localdisk_image_cache_min_free_gb to spare.
+
+        Virtual disks with the cache prefix that the index does not track
+        (ex. created by something else, or indexed by a lost index file) are
+        only logged, unless localdisk_image_cache_remove_orphans is set.  In
+        that case, they are removed first.
+
+        :param size: The size (in bytes) of the disk to make room for.
+        """
+        vg_wrap = self.disk_dvr._get_vg_wrap()
+        free_gb = float(vg_wrap.available_size)
+        need_gb = (float(size) / units.Gi +
+                   CONF.powervm.localdisk_image_cache_min_free_gb)
+
+        def _tracked(vdisk):
+            entry = self._index.get(vdisk.name)
+            return entry is not None and entry['udid'] == vdisk.udid
+        cached, orphans = [], []
+        for vdisk in vg_wrap.virtual_disks:
+            if (not vdisk.name.startswith(IMAGE_CACHE_PREFIX) or
+                    self._in_use[vdisk.name]):
+                continue
+            (cached if _tracked(vdisk) else orphans).append(vdisk)
+        cached.sort(key=lambda vd: self._index[vd.name]['last_used'])
+
+        remove = []
+        if orphans:
+            if CONF.powervm.localdisk_image_cache_remove_orphans:
+                remove.extend(orphans)
+                free_gb += sum(float(vd.capacity) for vd in orphans)
+            else:
+                LOG.warn(_LW('Virtual disks %s are not tracked by the image '
+                             'cache and are left in the volume group.'),
+                         ', '.join(vd.name for vd in orphans))
+        for vdisk in cached:
+            if free_gb >= need_gb:
+                break
+            remove.append(vdisk)
+            free_gb += float(vdisk.capacity)
+        if not remove:
+            return
+
+        LOG.info(_LI('Removing cached images %s from the volume group.'),
+                 ', '.join(vd.name for vd in remove))
+        tsk_stg.rm_vg_storage(vg_wrap, vdisks=remove)
+        for vdisk in remove:
+            self._index.pop(vdisk.name, None)
+        self._save_index()
+
+    def map_to_mgmt(self, vdisk):
+        """Maps a cached VDisk to the management partition.
+
+        The mapping is shared by concurrent copies of the same image.  Each
+        call must be matched by a call to unmap_from_mgmt.
+
+        :param vdisk: The cached VDisk.
+        :return: The path of the disk's block device on the management
+                 partition.
+        """
+        with lockutils.lock('pvm_image_cache_%s' % vdisk.name):
+            if not self._mgmt_users[vdisk.name]:
+                self._mgmt_paths[vdisk.name] = (
+                    self.disk_dvr._map_vdisk_to_mgmt(vdisk))
+            self._mgmt_users[vdisk.name] += 1
+            return self._mgmt_paths[vdisk.name]
+
+    def unmap_from_mgmt(self, vdisk):
+        """Releases the management partition mapping of a cached VDisk."""
+        with lockutils.lock('pvm_image_cache_%s' % vdisk.name):
+            self._mgmt_users[vdisk.name] -= 1
+            if not self._mgmt_users[vdisk.name]:
+                self.disk_dvr._unmap_vdisk_from_mgmt(
+                    vdisk, self._mgmt_paths.pop(vdisk.name))
@@ -14,16 +14,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import random
+import hashlib
+import time
 
+from oslo_concurrency import lockutils
 from oslo_config import cfg
 import oslo_log.log as logging
+from oslo_utils import excutils
 
-from nova.i18n import _LI, _LE
+from nova.i18n import _LI, _LE, _LW
 from nova_powervm.virt.powervm.disk import driver as disk_drv
 from nova_powervm.virt.powervm import vios
 from nova_powervm.virt.powervm import vm
 
+from pypowervm import const as pvm_const
+from pypowervm import exceptions as pvm_exc
 from pypowervm.tasks import scsi_mapper as tsk_map
 from pypowervm.tasks import storage as tsk_stg
 import pypowervm.util as pvm_u
@@ -39,7 +44,23 @@ ssp_opts = [
                help='Cluster hosting the Shared Storage Pool to use for '
                     'storage operations.  If none specified, the host is '
                     'queried; if a single Cluster is found, it is used. '
-                    'Not used unless disk_driver option is set to ssp.')
+                    'Not used unless disk_driver option is set to ssp.'),
+    cfg.IntOpt('ssp_image_lock_timeout',
+               default=1800,
+               help='The number of seconds to wait for another host in the '
+                    'cluster to finish uploading an image to the Shared '
+                    'Storage Pool.  An upload that was claimed longer ago '
+                    'than this is considered abandoned (ex. its host died), '
+                    'and is taken over by the next host that needs the '
+                    'image.  Must be longer than the slowest image upload.'),
+    cfg.IntOpt('ssp_refresh_interval',
+               default=120,
+               help='The number of seconds that the cached Shared Storage '
+                    'Pool data may be used for capacity reporting before it '
+                    'is revalidated against the REST API.  Revalidation uses '
+                    'the etag of the SSP, so it only transfers the SSP when '
+                    'it changed.  Storage operations always revalidate.  A '
+                    'value of 0 revalidates on every access.')
 ]
 
 
@@ -47,6 +68,13 @@ LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 CONF.register_opts(ssp_opts, group='powervm')
 
+# Prefix of the marker LU created while an image LU is being uploaded.  The
+# full name is the prefix, a hash of the image LU name and the time (seconds
+# since the epoch) the upload was claimed: part_<sha1>_<time>
+MARKER_PREFIX = 'part_'
+# Seconds between checks for an image LU being uploaded by another host.
+_IMAGE_WAIT_INTERVAL = 5
+
 
 class SSPDiskAdapter(disk_drv.DiskAdapter):
     """Provides a disk adapter for Shared Storage Pools.
@@ -69,6 +97,19 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
         self._cluster = self._fetch_cluster(CONF.powervm.cluster_name)
         self.clust_name = self._cluster.name
 
+        # The cached SSP wrapper, and when it was last revalidated
+        self._ssp_wrap = None
+        self._ssp_refreshed = None
+        # Number of SSP accesses served without / with transferring the SSP
+        self.ssp_cache_hits = 0
+        self.ssp_cache_misses = 0
+
+        # Index of the image LUs (and upload markers) by name.  Rebuilt only
+        # when the etag of the SSP changes.
+        self._image_lus = {}
+        self._image_markers = {}
+        self._image_lu_etag = None
+
         # _ssp @property method will fetch and cache the SSP.
         self.ssp_name = self._ssp.name
 
@@ -87,6 +128,16 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
         ssp = self._ssp
         return float(ssp.capacity) - float(ssp.free_space)
 
+    @property
+    def capacity_info(self):
+        """The capacity and used capacity of the storage, in gigabytes.
+
+        Both come from the same (cached or revalidated) SSP.
+        """
+        ssp = self._ssp
+        capacity = float(ssp.capacity)
+        return capacity, capacity - float(ssp.free_space)
+
     def disconnect_image_disk(self, context, instance, stg_ftsk=None,
                               disk_type=None):
         """Disconnects the storage adapters from the image disk.
@@ -173,7 +224,8 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
                               ElementWrappers) that are to be deleted.  Derived
                               from the return value from disconnect_image_disk.
         """
-        tsk_stg.rm_ssp_storage(self._ssp, storage_elems)
+        self._set_ssp(tsk_stg.rm_ssp_storage(self._get_ssp(revalidate=True),
+                                             storage_elems))
 
     def create_disk_from_image(self, context, instance, img_meta, disk_size_gb,
                                image_type=disk_drv.DiskType.BOOT):
@@ -211,10 +263,91 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
         LOG.info(_LI('SSP: Disk name is %s'), boot_lu_name)
 
         ssp, boot_lu = tsk_stg.crt_lu_linked_clone(
-            self._ssp, self._cluster, image_lu, boot_lu_name, disk_size_gb)
+            self._get_ssp(revalidate=True), self._cluster, image_lu,
+            boot_lu_name, disk_size_gb)
+        self._set_ssp(ssp)
 
         return boot_lu
 
+    @staticmethod
+    def _get_image_name(image_meta):
+        """Generate the name of the image LU for an image.
+
+        The name ends with the image checksum (or, if the image has none, its
+        ID), so that an image LU is only reused for the same image content.
+        The image LUs uploaded before are named without it.  See
+        _get_legacy_image_name.
+        """
+        return pvm_u.sanitize_file_name_for_api(
+            image_meta['name'], prefix=disk_drv.DiskType.IMAGE + '_',
+            suffix='_' + (image_meta.get('checksum') or image_meta['id']))
+
+    @staticmethod
+    def _get_legacy_image_name(image_meta):
+        """The name of the image LU for an image, as earlier releases made it.
+
+        The image LUs named this way are still used, so that they are not
+        uploaded again (and the existing ones left orphaned) on upgrade.
+        """
+        return disk_drv.DiskAdapter._get_image_name(image_meta)
+
+    def _find_image_lu(self, ssp, luname):
+        """Look up an image LU (and its upload marker) in the SSP.
+
+        The SSP is only scanned when its etag has changed since the last
+        lookup.  Otherwise, the answer comes from the index.
+
+        :param ssp: The current SSP wrapper.
+        :param luname: The name of the image LU.
+        :return: The image LU wrapper, or None if it does not exist.
+        :return: The marker LU wrapper if the image LU is being uploaded, or
+                 None.
+        """
+        if ssp.etag is None or ssp.etag != self._image_lu_etag:
+            image_lus, markers = {}, {}
+            for lu in ssp.logical_units:
+                if lu.lu_type == pvm_stg.LUType.IMAGE:
+                    image_lus[lu.name] = lu
+                elif self._marker_time(lu.name) is not None:
+                    markers[lu.name.rpartition('_')[0]] = lu
+            self._image_lus, self._image_markers = image_lus, markers
+            self._image_lu_etag = ssp.etag
+        return (self._image_lus.get(luname),
+                self._image_markers.get(self._marker_key(luname)))
+
+    @staticmethod
+    def _marker_key(luname):
+        """The marker LU name of an image LU, without the claim time.
+
+        The image LU name is hashed: truncating a long name could cut off its
+        checksum, and with it what tells two images apart.
+        """
+        return MARKER_PREFIX + hashlib.sha1(luname.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _marker_name(cls, luname, claimed=None):
+        """The name of a new upload marker LU for an image LU.
+
+        :param luname: The name of the image LU.
+        :param claimed: (Optional) The time the upload is claimed.  Defaults
+                        to now.
+        """
+        claimed = time.time() if claimed is None else claimed
+        return '%s_%d' % (cls._marker_key(luname), claimed)
+
+    @staticmethod
+    def _marker_time(name):
+        """The time an upload was claimed, from its marker LU name.
+
+        :return: The time, or None if the name is not that of a marker LU.
+        """
+        if not name.startswith(MARKER_PREFIX):
+            return None
+        try:
+            return int(name.rpartition('_')[2])
+        except ValueError:
+            return None
+
     def _get_or_upload_image_lu(self, context, img_meta):
         """Ensures our SSP has an LU containing the specified image.
 
@@ -222,29 +355,136 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
         already exists in our SSP, return it.  Otherwise, create it, prime it
         with the image contents from glance, and return it.
 
+        Only one host in the cluster uploads a given image.  The uploading
+        host first creates a marker LU.  Since the SSP update is conditional
+        on the etag, only one host can create the marker; the others wait for
+        the marker to be removed, then use the uploaded image LU.
+
+        The marker is named with the time the upload was claimed.  Once it is
+        older than ssp_image_lock_timeout, the upload is considered abandoned
+        (ex. the uploading host died): the marker is removed, and the upload
+        claimed again.
+
+        An image LU uploaded by an earlier release (see
+        _get_legacy_image_name) is used if there is none by the current name.
+
         :param context: nova context used to retrieve image from glance
         :param img_meta: image metadata dict:
                       { 'id': reference used to locate the image in glance,
-                        'size': size in bytes of the image. }
+                        'size': size in bytes of the image,
+                        'checksum': (Optional) checksum of the image data. }
         :return: A pypowervm LU ElementWrapper representing the image.
         """
         # Key off of the name to see whether we already have the image
         luname = self._get_image_name(img_meta)
-        ssp = self._ssp
-        for lu in ssp.logical_units:
-            if lu.lu_type == pvm_stg.LUType.IMAGE and lu.name == luname:
-                LOG.info(_LI('SSP: Using already-uploaded image LU %s.'),
-                         luname)
-                return lu
-
-        # We don't have it yet.  Create it and upload the glance image to it.
-        # Make the image LU only as big as the image.
-        stream = self._get_image_upload(context, img_meta)
-        LOG.info(_LI('SSP: Uploading new image LU %s.'), luname)
-        lu, f_wrap = tsk_stg.upload_new_lu(self._any_vios_uuid(), ssp, stream,
-                                           luname, img_meta['size'])
+        legacy_name = self._get_legacy_image_name(img_meta)
+        timeout = CONF.powervm.ssp_image_lock_timeout
+        deadline = time.time() + timeout
+
+        # Serialize the uploads of this image by this host.
+        with lockutils.lock('ssp_image_' + luname):
+            while True:
+                ssp = self._get_ssp(revalidate=True)
+                lu, marker = self._find_image_lu(ssp, luname)
+                if lu is not None and marker is None:
+                    LOG.info(_LI('SSP: Using already-uploaded image LU %s.'),
+                             luname)
+                    return lu
+                if lu is None and marker is None:
+                    legacy_lu = self._find_image_lu(ssp, legacy_name)[0]
+                    if legacy_lu is not None:
+                        LOG.info(_LI('SSP: Using already-uploaded image LU '
+                                     '%s.'), legacy_name)
+                        return legacy_lu
+
+                try:
+                    if marker is None:
+                        # Claim the upload by creating the marker.
+                        ssp, marker = tsk_stg.crt_lu(
+                            ssp, self._marker_name(luname), 0.001,
+                            typ=pvm_stg.LUType.DISK)
+                        self._set_ssp(ssp)
+                        return self._upload_image_lu(context, img_meta,
+                                                     luname, marker)
+                    if (self._marker_time(marker.name) + timeout <=
+                            time.time()):
+                        # Take over an abandoned upload.
+                        LOG.warn(_LW('SSP: The upload of image LU %(lu)s '
+                                     'claimed by marker LU %(marker)s has '
+                                     'expired.  Removing the marker.'),
+                                 {'lu': luname, 'marker': marker.name})
+                        self._set_ssp(tsk_stg.rm_ssp_storage(
+                            ssp, [marker], del_unused_images=False))
+                        continue
+                except pvm_exc.DuplicateLUNameError:
+                    LOG.info(_LI('SSP: Another host is uploading image LU '
+                                 '%s.'), luname)
+                except pvm_exc.HttpError as e:
+                    # If another host changed the SSP first, look again.
+                    if (e.response is None or e.response.status !=
+                            pvm_const.HTTPStatus.ETAG_MISMATCH):
+                        raise
+                    LOG.info(_LI('SSP: Shared Storage Pool changed while '
+                                 'claiming the upload of image LU %s.  '
+                                 'Retrying.'), luname)
+                    continue
+
+                if time.time() >= deadline:
+                    raise npvmex.ImageLUUploadTimeout(
+                        timeout=timeout, lu_name=luname, ssp_name=ssp.name,
+                        marker=(marker.name if marker is not None else
+                                self._marker_key(luname) + '_*'))
+                time.sleep(_IMAGE_WAIT_INTERVAL)
+
+    def _upload_image_lu(self, context, img_meta, luname, marker):
+        """Uploads a new image LU, then removes the upload marker.
+
+        :param context: nova context used to retrieve image from glance
+        :param img_meta: image metadata dict.  See _get_or_upload_image_lu.
+        :param luname: The name of the image LU.
+        :param marker: The marker LU wrapper that claims the upload.
+        :return: A pypowervm LU ElementWrapper representing the image.
+        """
+        # An earlier upload may have been interrupted.
+        stale_lu, _marker = self._find_image_lu(self._ssp_wrap, luname)
+        try:
+            if stale_lu is not None:
+                LOG.warn(_LW('SSP: Removing incomplete image LU %s.'), luname)
+                self._set_ssp(tsk_stg.rm_ssp_storage(
+                    self._ssp_wrap, [stale_lu], del_unused_images=False))
+
+            # Make the image LU only as big as the image.
+            LOG.info(_LI('SSP: Uploading new image LU %s.'), luname)
+            try:
+                with self._get_image_upload(context, img_meta) as stream:
+                    lu, f_wrap = tsk_stg.upload_new_lu(
+                        self._any_vios_uuid(), self._ssp_wrap, stream,
+                        luname, img_meta['size'])
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    self._rm_failed_image_lu(luname)
+            finally:
+                # The upload changed the SSP.
+                self._invalidate_ssp()
+        finally:
+            self._set_ssp(tsk_stg.rm_ssp_storage(
+                self._get_ssp(revalidate=True), [marker],
+                del_unused_images=False))
         return lu
 
+    def _rm_failed_image_lu(self, luname):
+        """Removes the image LU of a failed upload, if it was created."""
+        try:
+            ssp = self._get_ssp(revalidate=True)
+            lus = [lu for lu in ssp.logical_units if lu.name == luname and
+                   lu.lu_type == pvm_stg.LUType.IMAGE]
+            if lus:
+                self._set_ssp(tsk_stg.rm_ssp_storage(
+                    ssp, lus, del_unused_images=False))
+        except Exception as e:
+            LOG.warn(_LW('SSP: Unable to remove incomplete image LU '
+                         '%(lu)s: %(err)s'), {'lu': luname, 'err': e})
+
     def connect_disk(self, context, instance, disk_info, stg_ftsk=None):
         """Connects the disk image to the Virtual Machine.
 
@@ -403,20 +643,62 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
 
     @property
     def _ssp(self):
-        """Fetch or refresh the SSP corresponding to the Cluster.
+        """The SSP corresponding to the Cluster.
+
+        This must be invoked after a successful _fetch_cluster.  The SSP is
+        cached, and only revalidated once ssp_refresh_interval has passed.
+        Use _get_ssp(revalidate=True) when the SSP must be current.
+
+        :return: The cached or refreshed SSP EntryWrapper.
+        """
+        return self._get_ssp()
 
-        This must be invoked after a successful _fetch_cluster.
+    @lockutils.synchronized('ssp_refresh')
+    def _get_ssp(self, revalidate=False):
+        """Fetch or revalidate the SSP corresponding to the Cluster.
 
-        :return: The fetched or refreshed SSP EntryWrapper.
+        :param revalidate: If True, the cached SSP is revalidated against the
+                           REST API (with its etag) even if the refresh
+                           interval has not passed.
+        :return: The fetched, refreshed or cached SSP EntryWrapper.
         """
-        # TODO(IBM): Smarter refreshing (i.e. don't do it every time).
-        if getattr(self, '_ssp_wrap', None) is None:
+        if self._ssp_wrap is None:
             resp = self.adapter.read_by_href(self._cluster.ssp_uri)
             self._ssp_wrap = pvm_stg.SSP.wrap(resp)
+            self._ssp_refreshed = time.time()
+            self.ssp_cache_misses += 1
+            return self._ssp_wrap
+
+        if (revalidate or self._ssp_refreshed is None or
+                time.time() - self._ssp_refreshed >=
+                CONF.powervm.ssp_refresh_interval):
+            ssp_wrap = self._ssp_wrap.refresh()
+            self._ssp_refreshed = time.time()
+            if ssp_wrap is self._ssp_wrap:
+                # Not modified (304)
+                self.ssp_cache_hits += 1
+            else:
+                self._ssp_wrap = ssp_wrap
+                self.ssp_cache_misses += 1
         else:
-            self._ssp_wrap = self._ssp_wrap.refresh()
+            self.ssp_cache_hits += 1
         return self._ssp_wrap
 
+    def _set_ssp(self, ssp_wrap):
+        """Cache the SSP wrapper returned by an update made by this driver.
+
+        The next access revalidates it, in case another host also changed the
+        SSP.
+
+        :param ssp_wrap: The updated SSP EntryWrapper.
+        """
+        self._ssp_wrap = ssp_wrap
+        self._invalidate_ssp()
+
+    def _invalidate_ssp(self):
+        """Force the next access to revalidate the cached SSP."""
+        self._ssp_refreshed = None
+
     @property
     def vios_uuids(self):
         """List the UUIDs of our cluster's VIOSes on this host.
@@ -443,11 +725,12 @@ class SSPDiskAdapter(disk_drv.DiskAdapter):
         """Pick one of the Cluster's VIOSes and return its UUID.
 
         Use when it doesn't matter which VIOS an operation is invoked against.
-        Currently picks at random; may later be changed to use round-robin.
+        Picks the least loaded VIOS (see vios.LOAD_MONITOR); at random if
+        their load is not known.
 
         :return: A single VIOS UUID string.
         """
-        return random.choice(self.vios_uuids)
+        return vios.LOAD_MONITOR.least_loaded(self.vios_uuids)
 
     def disk_match_func(self, disk_type, instance):
         """Return a matching function to locate the disk for an instance.
@@ -15,6 +15,7 @@
 #    under the License.
 
 from nova import block_device
+from nova.compute import power_state
 from nova.compute import task_states
 from nova.compute import utils as compute_utils
 from nova.console import type as console_type
@@ -25,6 +26,7 @@ from nova.i18n import _LI, _LW, _LE, _
 from nova.objects import flavor as flavor_obj
 from nova import utils as n_utils
 from nova.virt import configdrive
+from nova.virt import diagnostics
 from nova.virt import driver
 import re
 import time
@@ -34,6 +36,7 @@ from oslo_log import log as logging
 from oslo_utils import importutils
 import six
 from taskflow import engines as tf_eng
+from taskflow.patterns import graph_flow as tf_gf
 from taskflow.patterns import linear_flow as tf_lf
 
 from pypowervm import adapter as pvm_apt
@@ -43,15 +46,19 @@ from pypowervm.helpers import vios_busy as vio_hlp
 from pypowervm.tasks import power as pvm_pwr
 from pypowervm.tasks import vterm as pvm_vterm
 from pypowervm.utils import retry as pvm_retry
+from pypowervm.utils import transaction as pvm_tx
 from pypowervm.wrappers import base_partition as pvm_bp
 from pypowervm.wrappers import managed_system as pvm_ms
 from pypowervm.wrappers import virtual_io_server as pvm_vios
 
+from nova_powervm.virt.powervm import cache
 from nova_powervm.virt.powervm.disk import driver as disk_dvr
+from nova_powervm.virt.powervm import event as pvm_event
 from nova_powervm.virt.powervm import host as pvm_host
 from nova_powervm.virt.powervm import image as img
 from nova_powervm.virt.powervm import live_migration as lpm
 from nova_powervm.virt.powervm import mgmt
+from nova_powervm.virt.powervm import rest_stats
 from nova_powervm.virt.powervm.tasks import image as tf_img
 from nova_powervm.virt.powervm.tasks import network as tf_net
 from nova_powervm.virt.powervm.tasks import storage as tf_stg
@@ -92,6 +99,9 @@ class PowerVMDriver(driver.ComputeDriver):
 
         # Live migrations
         self.live_migrations = {}
+        # The MAC addresses of the client network adapters of each VM, by
+        # slot.  PCM identifies the adapters by location code only.
+        self._cna_macs = {}
         # Get an adapter
         self._get_adapter()
         # First need to resolve the managed host UUID
@@ -106,14 +116,61 @@ class PowerVMDriver(driver.ComputeDriver):
         # Init Host CPU Statistics
         self.host_cpu_stats = pvm_host.HostCPUStats(self.adapter,
                                                     self.host_uuid)
+        self.host_cpu_stats.start()
+
+        # The host resources, for get_available_resource
+        self.resource_snapshot = pvm_host.ResourceSnapshot(
+            self.adapter, self.host_wrapper, self.disk_dvr,
+            host_cpu_stats=self.host_cpu_stats)
+        self.resource_snapshot.start()
+
+        # Init the LPAR state cache (used by get_info)
+        self.lpar_cache = cache.LPARStateCache(self.adapter, self.host_uuid)
+
+        # Keep the cache current from the REST event feed
+        self._subscribe_events()
+
+        # Combines the VIOS storage updates of concurrent spawns
+        self.stg_coalescer = vios.FeedTaskCoalescer(self.adapter,
+                                                    self.host_uuid)
 
         LOG.info(_LI("The compute driver has been initialized."))
 
+    def cleanup_host(self, host):
+        """Clean up anything that is necessary for the driver gracefully stop,
+        including ending remote sessions. This is optional.
+        """
+        if self.event_handler is not None:
+            self.adapter.session.get_event_listener().unsubscribe(
+                self.event_handler)
+            self.event_handler = None
+        self.lpar_cache.event_driven = False
+        self.host_cpu_stats.stop()
+        self.resource_snapshot.stop()
+
+    def _subscribe_events(self):
+        """Subscribes the LPAR event handler to the REST event feed."""
+        self.event_handler = None
+        if not (CONF.powervm.lpar_state_events and self.lpar_cache.enabled):
+            return
+        handler = pvm_event.PowerVMLPAREventHandler(self, self.lpar_cache)
+        try:
+            self.adapter.session.get_event_listener().subscribe(handler)
+        except Exception as e:
+            LOG.warn(_LW('Unable to listen for PowerVM events.  The LPAR '
+                         'state cache will be revalidated periodically '
+                         'instead.  Error: %s'), e)
+            return
+        self.event_handler = handler
+        self.lpar_cache.event_driven = True
+
     def _get_adapter(self):
         self.session = pvm_apt.Session()
-        self.adapter = pvm_apt.Adapter(
-            self.session, helpers=[log_hlp.log_helper,
-                                   vio_hlp.vios_busy_retry_helper])
+        helpers = [log_hlp.log_helper, vio_hlp.vios_busy_retry_helper]
+        if CONF.powervm.rest_stats:
+            # Last, so that each retry is recorded as its own call.
+            helpers.append(rest_stats.stats_helper)
+        self.adapter = pvm_apt.Adapter(self.session, helpers=helpers)
 
     def _get_disk_adapter(self):
         conn_info = {'adapter': self.adapter, 'host_uuid': self.host_uuid,
@@ -155,9 +212,22 @@ class PowerVMDriver(driver.ComputeDriver):
         :cpu_time:        (int) the CPU time used in nanoseconds
         """
         info = vm.InstanceInfo(self.adapter, instance.name,
-                               vm.get_pvm_uuid(instance))
+                               vm.get_pvm_uuid(instance),
+                               lpar_cache=self.lpar_cache)
         return info
 
+    def _invalidate_lpar_cache(self, instance):
+        """Drops the cached state of an instance after the driver changed it.
+
+        Not needed if the cache is event driven, as the event for the change
+        updates (or removes) the entry.
+
+        :param instance: The nova instance whose LPAR was modified.
+        """
+        if self.lpar_cache.event_driven:
+            return
+        self.lpar_cache.invalidate(vm.get_pvm_uuid(instance))
+
     def instance_exists(self, instance):
         """Checks existence of an instance on the host.
 
@@ -166,7 +236,8 @@ class PowerVMDriver(driver.ComputeDriver):
         Returns True if an instance with the supplied ID exists on
         the host, False otherwise.
         """
-        return vm.instance_exists(self.adapter, instance, self.host_uuid)
+        return vm.instance_exists(self.adapter, instance, self.host_uuid,
+                                  lpar_cache=self.lpar_cache)
 
     def list_instances(self):
         """Return the names of all the instances known to the virtualization
@@ -175,10 +246,125 @@ class PowerVMDriver(driver.ComputeDriver):
         lpar_list = vm.get_lpar_names(self.adapter)
         return lpar_list
 
+    def list_instance_uuids(self):
+        """Return the UUIDS of all the instances known to the virtualization
+        layer, as a list.
+
+        The PowerVM UUID of an LPAR is the instance UUID with its high bit
+        cleared (see vm.get_pvm_uuid), so the instance UUID can not be derived
+        from it.  Both candidates are returned for each LPAR.  The compute
+        manager only uses this list to filter its instances.
+        """
+        uuids = []
+        for pvm_uuid in vm.get_lpar_uuids(self.adapter):
+            pvm_uuid = pvm_uuid.lower()
+            uuids.append(pvm_uuid)
+            uuids.append('%x%s' % (int(pvm_uuid[0], 16) | 8, pvm_uuid[1:]))
+        return uuids
+
     def get_host_cpu_stats(self):
         """Return the current CPU state of the host."""
         return self.host_cpu_stats.get_host_cpu_stats()
 
+    def get_instance_diagnostics(self, instance):
+        """Return data about VM diagnostics.
+
+        The CPU, memory and network data come from the latest PCM sample of
+        the host.  No REST call is made for them.
+
+        :param instance: nova.objects.instance.Instance
+        :return: The nova.virt.diagnostics.Diagnostics.
+        """
+        state = self.get_info(instance).state
+        diags = diagnostics.Diagnostics(
+            state=power_state.STATE_MAP[state], driver='PowerVM',
+            hypervisor_os='PowerVM',
+            config_drive=configdrive.required_by(instance))
+
+        pvm_uuid = vm.get_pvm_uuid(instance)
+        metrics = self.host_cpu_stats.get_lpar_metrics(pvm_uuid).get(
+            pvm_uuid)
+        if metrics is None:
+            # Not in the PCM data (yet).  Ex. metrics are off, or a new VM.
+            return diags
+
+        counters = metrics['counters']
+        diags.add_cpu(time=metrics['cpu_time_ns'])
+        diags.memory_details.maximum = counters.logical_mem or 0
+        diags.memory_details.used = counters.backed_physical_mem or 0
+        for nic, mac in self._nic_macs(instance, counters.nics):
+            diags.add_nic(mac_address=mac, rx_octets=nic.rx_bytes,
+                          rx_packets=nic.rx_packets,
+                          rx_drop=nic.dropped_packets,
+                          tx_octets=nic.tx_bytes, tx_packets=nic.tx_packets)
+        return diags
+
+    def get_all_bw_counters(self, instances):
+        """Return bandwidth usage counters for each interface on each
+           running VM.
+
+        All of the counters come from the latest PCM sample of the host.  The
+        MAC addresses of the adapters are only read when a VM has an adapter
+        not seen before.
+
+        :param instances: nova.objects.instance.InstanceList
+        :return: List of dictionaries with the 'uuid' of the instance, the
+                 'mac_address' of the adapter, and its 'bw_in' and 'bw_out'
+                 byte counters.
+        """
+        metrics = self.host_cpu_stats.get_lpar_metrics()
+        counters = []
+        pvm_uuids = set()
+        for instance in instances:
+            pvm_uuid = vm.get_pvm_uuid(instance)
+            pvm_uuids.add(pvm_uuid)
+            lpar_metrics = metrics.get(pvm_uuid)
+            if lpar_metrics is None:
+                continue
+            for nic, mac in self._nic_macs(instance,
+                                           lpar_metrics['counters'].nics):
+                counters.append({'uuid': instance.uuid,
+                                 'mac_address': mac,
+                                 'bw_in': nic.rx_bytes,
+                                 'bw_out': nic.tx_bytes})
+        # Forget the adapters of the VMs that are gone.
+        for pvm_uuid in set(self._cna_macs) - pvm_uuids:
+            del self._cna_macs[pvm_uuid]
+        return counters
+
+    def _nic_macs(self, instance, nics):
+        """Pairs the PCM counters of a VM's adapters with their MAC address.
+
+        PCM identifies the adapters by location code (ex.
+        U8247.22L.2125D4A-V2-C3), which ends with the slot of the adapter.
+        The MAC addresses are cached by slot.  The client network adapters of
+        the VM are only read again if one of the slots has not been seen.
+
+        :param instance: nova.objects.instance.Instance
+        :param nics: The NicCounters of the adapters of the VM.
+        :return: List of (NicCounters, MAC address) tuples.  The adapters
+                 without a known MAC address are left out.
+        """
+        pvm_uuid = vm.get_pvm_uuid(instance)
+        slots = [(nic, _loc_code_slot(nic.location)) for nic in nics]
+        macs = self._cna_macs.get(pvm_uuid)
+        if macs is None or any(slot is not None and slot not in macs
+                               for _nic, slot in slots):
+            try:
+                cnas = vm.get_cnas(self.adapter, instance, self.host_uuid)
+            except pvm_exc.Error:
+                LOG.warn(_LW('Unable to read the network adapters of '
+                             'instance %s.'), instance.name, exc_info=True)
+                cnas = []
+            macs = {cna.slot: vm.norm_mac(cna.mac) for cna in cnas}
+            # Do not read them again for an adapter that has no CNA.
+            for _nic, slot in slots:
+                macs.setdefault(slot, None)
+            self._cna_macs[pvm_uuid] = macs
+        return [(nic, macs[slot]) for nic, slot in slots
+                if macs.get(slot) is not None]
+
+    @rest_stats.tracked
     def spawn(self, context, instance, image_meta, injected_files,
               admin_password, network_info=None, block_device_info=None,
               flavor=None):
@@ -215,75 +401,153 @@ class PowerVMDriver(driver.ComputeDriver):
         # Extract the block devices.
         bdms = self._extract_bdm(block_device_info)
 
-        # Define the flow
-        flow_spawn = tf_lf.Flow("spawn")
+        # Define the flow.  This is a graph flow; steps that do not depend on
+        # each other (ex. the image upload and the network plumbing) may run
+        # in parallel.
+        flow_spawn = tf_gf.Flow("spawn")
 
-        # Create the transaction manager (FeedTask) for Storage I/O.
+        # Create the transaction manager (FeedTask) for Storage I/O.  If
+        # coalescing, it shares its VIOS feed with concurrent spawns.
         xag = self._get_inst_xag(instance, bdms)
-        stg_ftsk = vios.build_tx_feed_task(self.adapter, self.host_uuid,
-                                           xag=xag)
+        if self.stg_coalescer.enabled:
+            stg_ftsk = self.stg_coalescer.build_feed_task(xag=xag)
+        else:
+            stg_ftsk = vios.build_tx_feed_task(self.adapter, self.host_uuid,
+                                               xag=xag)
+        self._prep_parallel_ftsk(stg_ftsk)
 
         # Create the LPAR
-        flow_spawn.add(tf_vm.Create(self.adapter, self.host_wrapper, instance,
-                                    flavor, stg_ftsk))
+        crt_task = tf_vm.Create(self.adapter, self.host_wrapper, instance,
+                                flavor, stg_ftsk)
+        flow_spawn.add(crt_task)
 
-        # Create a flow for the IO
+        # Create a flow for the IO.  These require the LPAR (lpar_wrap) and
+        # the client network adapters (vm_cnas) respectively.
         flow_spawn.add(tf_net.PlugVifs(self.virtapi, self.adapter, instance,
                                        network_info, self.host_uuid))
-        flow_spawn.add(tf_net.PlugMgmtVif(self.adapter, instance,
-                                          self.host_uuid))
+        mgmt_vif_task = tf_net.PlugMgmtVif(self.adapter, instance,
+                                           self.host_uuid)
+        flow_spawn.add(mgmt_vif_task)
+
+        # The tasks that add their storage updates to the FeedTask.  They all
+        # need to complete before the FeedTask is run.
+        stg_tasks = [crt_task]
 
         # Only add the image disk if this is from Glance.
         if not self._is_booted_from_volume(block_device_info):
-            # Creates the boot image.
+            # Creates the boot image.  Does not need the LPAR, so runs
+            # alongside the LPAR creation and network plumbing.
             flow_spawn.add(tf_stg.CreateDiskForImg(
                 self.disk_dvr, context, instance, image_meta,
                 disk_size=flavor.root_gb))
 
             # Connects up the disk to the LPAR
-            flow_spawn.add(tf_stg.ConnectDisk(self.disk_dvr, context, instance,
-                                              stg_ftsk=stg_ftsk))
-
-        # Determine if there are volumes to connect.  If so, add a connection
-        # for each type.
-        if bdms is not None:
+            connect_task = tf_stg.ConnectDisk(self.disk_dvr, context,
+                                              instance, stg_ftsk=stg_ftsk)
+            flow_spawn.add(connect_task)
+            flow_spawn.link(crt_task, connect_task)
+            stg_tasks.append(connect_task)
+
+        # Determine if there are volumes to connect.  If so, connect them
+        # all in one batch, so that they share the discovery work.
+        save_tasks = []
+        if bdms:
+            vol_drvs = [self._get_inst_vol_adpt(
+                context, instance, conn_info=bdm.get('connection_info'),
+                stg_ftsk=stg_ftsk) for bdm in bdms]
+
+            # First connect the volumes.  This will update the
+            # connection_info.  Volume connections may add adapters to the
+            # LPAR, so they follow the network plumbing.
+            vol_task = tf_stg.ConnectVolumes(vol_drvs)
+            flow_spawn.add(vol_task)
+            flow_spawn.link(mgmt_vif_task, vol_task)
+            stg_tasks.append(vol_task)
+
+            # Save the BDMs so that the updated connection info is persisted.
             for bdm in bdms:
-                conn_info = bdm.get('connection_info')
-                vol_drv = self._get_inst_vol_adpt(
-                    context, instance, conn_info=conn_info, stg_ftsk=stg_ftsk)
+                save_task = tf_stg.SaveBDM(bdm, instance)
+                flow_spawn.add(save_task)
+                flow_spawn.link(vol_task, save_task)
+                save_tasks.append(save_task)
 
-                # First connect the volume.  This will update the
-                # connection_info.
-                flow_spawn.add(tf_stg.ConnectVolume(vol_drv))
-
-                # Save the BDM so that the updated connection info is
-                # persisted.
-                flow_spawn.add(tf_stg.SaveBDM(bdm, instance))
-
-        # If the config drive is needed, add those steps.  Should be done
-        # after all the other I/O.
+        # If the config drive is needed, add those steps.  Requires the
+        # management CNA (mgmt_cna), so it follows the network plumbing.
         if configdrive.required_by(instance):
-            flow_spawn.add(tf_stg.CreateAndConnectCfgDrive(
+            cfg_task = tf_stg.CreateAndConnectCfgDrive(
                 self.adapter, self.host_uuid, instance, injected_files,
-                network_info, admin_password, stg_ftsk=stg_ftsk))
+                network_info, admin_password, stg_ftsk=stg_ftsk)
+            flow_spawn.add(cfg_task)
+            stg_tasks.append(cfg_task)
+
+        # Add the transaction manager flow after the 'I/O connection' tasks.
+        # This will run all the connections in parallel.  If coalescing, the
+        # VIOS updates are combined with those of any concurrent spawns.
+        if self.stg_coalescer.enabled:
+            stg_task = tf_stg.RunCoalescedFeedTask(self.stg_coalescer,
+                                                   stg_ftsk, xag=xag)
+        else:
+            stg_task = stg_ftsk
+        flow_spawn.add(stg_task)
+        for task in stg_tasks:
+            flow_spawn.link(task, stg_task)
 
-        # Add the transaction manager flow to the end of the 'I/O
-        # connection' tasks.  This will run all the connections in parallel.
-        flow_spawn.add(stg_ftsk)
+        # The power on is the last step.  It requires the LPAR (lpar_wrap),
+        # and needs all of the I/O to be in place.
+        pwr_task = tf_vm.PowerOn(self.adapter, self.host_uuid, instance)
+        pwr_deps = [stg_task, mgmt_vif_task] + save_tasks
 
         # Update load source of IBMi VM
         distro = instance.system_metadata.get('image_os_distro', '')
         if distro.lower() == img.OSDistro.OS400:
             boot_type = self._get_boot_connectivity_type(
                 context, bdms, block_device_info)
-            flow_spawn.add(tf_vm.UpdateIBMiSettings(
-                self.adapter, instance, self.host_uuid, boot_type))
+            ibmi_task = tf_vm.UpdateIBMiSettings(
+                self.adapter, instance, self.host_uuid, boot_type)
+            flow_spawn.add(ibmi_task)
+            flow_spawn.link(stg_task, ibmi_task)
+            pwr_deps.append(ibmi_task)
 
-        # Last step is to power on the system.
-        flow_spawn.add(tf_vm.PowerOn(self.adapter, self.host_uuid, instance))
+        flow_spawn.add(pwr_task)
+        for task in pwr_deps:
+            flow_spawn.link(task, pwr_task)
 
         # Run the flow.
-        tf_eng.run(flow_spawn)
+        try:
+            self._run_graph_flow(flow_spawn)
+        finally:
+            self._invalidate_lpar_cache(instance)
+
+    @staticmethod
+    def _prep_parallel_ftsk(stg_ftsk):
+        """Prepares a storage FeedTask for use by parallel flow tasks.
+
+        The FeedTask builds its per-VIOS WrapperTasks on first use, which is
+        not safe to do from several tasks at once.  Build them up front.  The
+        feed is already read, so this does not cost a REST call.
+
+        :param stg_ftsk: The pypowervm transaction FeedTask.
+        """
+        if stg_ftsk is not None and CONF.powervm.flow_max_workers > 1:
+            # Accessing the property is what builds the WrapperTasks; the
+            # result itself is not needed here.
+            _wrapper_tasks = stg_ftsk.wrapper_tasks  # noqa
+
+    @staticmethod
+    def _run_graph_flow(flow):
+        """Runs a (graph) flow.
+
+        Independent tasks are run in parallel, using up to flow_max_workers
+        threads.  If that is 1, the tasks are run serially.
+
+        :param flow: The taskflow flow to run.
+        """
+        workers = CONF.powervm.flow_max_workers
+        if workers > 1:
+            tf_eng.run(flow, engine='parallel',
+                       executor=pvm_tx.ContextThreadPoolExecutor(workers))
+        else:
+            tf_eng.run(flow)
 
     def _is_booted_from_volume(self, block_device_info):
         """Determine whether the root device is listed in block_device_info.
@@ -303,6 +567,7 @@ class PowerVMDriver(driver.ComputeDriver):
     def need_legacy_block_device_info(self):
         return False
 
+    @rest_stats.tracked
     def destroy(self, context, instance, network_info, block_device_info=None,
                 destroy_disks=True, migrate_data=None):
         """Destroy (shutdown and delete) the specified instance.
@@ -325,61 +590,80 @@ class PowerVMDriver(driver.ComputeDriver):
             # Extract the block devices.
             bdms = self._extract_bdm(block_device_info)
 
-            # Define the flow
-            flow = tf_lf.Flow("destroy")
+            # Define the flow.  This is a graph flow; the storage updates
+            # are gathered while the LPAR is being powered off.
+            flow = tf_gf.Flow("destroy")
 
             # Power Off the LPAR
-            flow.add(tf_vm.PowerOff(self.adapter, self.host_uuid,
-                                    pvm_inst_uuid, instance))
+            pwr_task = tf_vm.PowerOff(self.adapter, self.host_uuid,
+                                      pvm_inst_uuid, instance)
+            flow.add(pwr_task)
 
             # Create the transaction manager (FeedTask) for Storage I/O.
             xag = self._get_inst_xag(instance, bdms)
             stg_ftsk = vios.build_tx_feed_task(self.adapter, self.host_uuid,
                                                xag=xag)
+            self._prep_parallel_ftsk(stg_ftsk)
+
+            # The tasks that add their storage updates to the FeedTask.  The
+            # FeedTask runs once they are all done (and the LPAR is off).
+            stg_tasks = [pwr_task]
 
             # Add the disconnect/deletion of the vOpt to the transaction
             # manager.
-            flow.add(tf_stg.DeleteVOpt(self.adapter, self.host_uuid, instance,
-                                       pvm_inst_uuid, stg_ftsk=stg_ftsk))
+            vopt_task = tf_stg.DeleteVOpt(self.adapter, self.host_uuid,
+                                          instance, pvm_inst_uuid,
+                                          stg_ftsk=stg_ftsk)
+            flow.add(vopt_task)
+            stg_tasks.append(vopt_task)
 
             # Determine if there are volumes to disconnect.  If so, remove each
-            # volume (within the transaction manager)
+            # volume (within the transaction manager).  These may remove
+            # adapters from the LPAR, so only once it is powered off.
             if bdms is not None:
                 for bdm in bdms:
                     conn_info = bdm.get('connection_info')
                     vol_drv = self._get_inst_vol_adpt(
                         context, instance, conn_info=conn_info,
                         stg_ftsk=stg_ftsk)
-                    flow.add(tf_stg.DisconnectVolume(vol_drv))
+                    vol_task = tf_stg.DisconnectVolume(vol_drv)
+                    flow.add(vol_task)
+                    flow.link(pwr_task, vol_task)
+                    stg_tasks.append(vol_task)
 
             # Only attach the disk adapters if this is not a boot from volume.
             destroy_disk_task = None
             if not self._is_booted_from_volume(block_device_info):
                 # Detach the disk storage adapters (when the stg_ftsk runs)
-                flow.add(tf_stg.DetachDisk(
-                    self.disk_dvr, context, instance, stg_ftsk))
+                detach_task = tf_stg.DetachDisk(
+                    self.disk_dvr, context, instance, stg_ftsk)
+                flow.add(detach_task)
+                stg_tasks.append(detach_task)
 
                 # Delete the storage disks
                 if destroy_disks:
                     destroy_disk_task = tf_stg.DeleteDisk(
                         self.disk_dvr, context, instance)
 
-            # Add the transaction manager flow to the end of the 'storage
-            # connection' tasks.  This will run all the connections in parallel
+            # Add the transaction manager flow after the 'storage connection'
+            # tasks.  This will run all the connections in parallel.
             flow.add(stg_ftsk)
+            for task in stg_tasks:
+                flow.link(task, stg_ftsk)
 
             # The disks shouldn't be destroyed until the unmappings are done.
             if destroy_disk_task:
                 flow.add(destroy_disk_task)
+                flow.link(stg_ftsk, destroy_disk_task)
 
-            # Last step is to delete the LPAR from the system.
-            # Note: If moving to a Graph Flow, will need to change to depend on
-            # the prior step.
-            flow.add(tf_vm.Delete(self.adapter, pvm_inst_uuid, instance))
+            # Last step is to delete the LPAR from the system.  Depends on the
+            # unmappings, but not on the deletion of the disks.
+            dlt_task = tf_vm.Delete(self.adapter, pvm_inst_uuid, instance)
+            flow.add(dlt_task)
+            flow.link(stg_ftsk, dlt_task)
 
             # Build the engine & run!
-            engine = tf_eng.load(flow)
-            engine.run()
+            self._run_graph_flow(flow)
 
         self._log_operation('destroy', instance)
         if instance.task_state == task_states.RESIZE_REVERTING:
@@ -390,7 +674,10 @@ class PowerVMDriver(driver.ComputeDriver):
 
         try:
             pvm_inst_uuid = vm.get_pvm_uuid(instance)
-            _run_flow()
+            try:
+                _run_flow()
+            finally:
+                self._invalidate_lpar_cache(instance)
         except exception.InstanceNotFound:
             LOG.warn(_LW('VM was not found during destroy operation.'),
                      instance=instance)
@@ -408,6 +695,7 @@ class PowerVMDriver(driver.ComputeDriver):
             else:
                 raise
 
+    @rest_stats.tracked
     def attach_volume(self, context, connection_info, instance, mountpoint,
                       disk_bus=None, device_type=None, encryption=None):
         """Attach the volume to the instance at mountpoint using info."""
@@ -436,6 +724,7 @@ class PowerVMDriver(driver.ComputeDriver):
         # to revise in the future as volume connectors evolve.
         instance.save()
 
+    @rest_stats.tracked
     def detach_volume(self, connection_info, instance, mountpoint,
                       encryption=None):
         """Detach the volume attached to the instance."""
@@ -463,6 +752,7 @@ class PowerVMDriver(driver.ComputeDriver):
         engine = tf_eng.load(flow)
         engine.run()
 
+    @rest_stats.tracked
     def snapshot(self, context, instance, image_id, update_task_state):
         """Snapshots the specified instance.
 
@@ -511,6 +801,7 @@ class PowerVMDriver(driver.ComputeDriver):
         # Build the engine & run
         tf_eng.load(flow).run()
 
+    @rest_stats.tracked
     def rescue(self, context, instance, network_info, image_meta,
                rescue_password):
         """Rescue the specified instance.
@@ -549,8 +840,12 @@ class PowerVMDriver(driver.ComputeDriver):
 
         # Build the engine & run!
         engine = tf_eng.load(flow)
-        engine.run()
+        try:
+            engine.run()
+        finally:
+            self._invalidate_lpar_cache(instance)
 
+    @rest_stats.tracked
     def unrescue(self, instance, network_info):
         """Unrescue the specified instance.
 
@@ -583,8 +878,12 @@ class PowerVMDriver(driver.ComputeDriver):
 
         # Build the engine & run!
         engine = tf_eng.load(flow)
-        engine.run()
+        try:
+            engine.run()
+        finally:
+            self._invalidate_lpar_cache(instance)
 
+    @rest_stats.tracked
     def power_off(self, instance, timeout=0, retry_interval=0):
         """Power off the specified instance.
 
@@ -594,8 +893,12 @@ class PowerVMDriver(driver.ComputeDriver):
                                waiting for it to shutdown
         """
         self._log_operation('power_off', instance)
-        vm.power_off(self.adapter, instance, self.host_uuid)
+        try:
+            vm.power_off(self.adapter, instance, self.host_uuid)
+        finally:
+            self._invalidate_lpar_cache(instance)
 
+    @rest_stats.tracked
     def power_on(self, context, instance, network_info,
                  block_device_info=None):
         """Power on the specified instance.
@@ -603,8 +906,12 @@ class PowerVMDriver(driver.ComputeDriver):
         :param instance: nova.objects.instance.Instance
         """
         self._log_operation('power_on', instance)
-        vm.power_on(self.adapter, instance, self.host_uuid)
+        try:
+            vm.power_on(self.adapter, instance, self.host_uuid)
+        finally:
+            self._invalidate_lpar_cache(instance)
 
+    @rest_stats.tracked
     def reboot(self, context, instance, network_info, reboot_type,
                block_device_info=None, bad_volumes_callback=None):
         """Reboot the specified instance.
@@ -626,20 +933,24 @@ class PowerVMDriver(driver.ComputeDriver):
         self._log_operation(reboot_type + ' reboot', instance)
         force_immediate = reboot_type == 'HARD'
         entry = vm.get_instance_wrapper(self.adapter, instance, self.host_uuid)
-        if entry.state != pvm_bp.LPARState.NOT_ACTIVATED:
-            pvm_pwr.power_off(entry, self.host_uuid, restart=True,
-                              force_immediate=force_immediate)
-        else:
-            # pypowervm does NOT throw an exception if "already down".
-            # Any other exception from pypowervm is a legitimate failure;
-            # let it raise up.
-            # If we get here, pypowervm thinks the instance is down.
-            pvm_pwr.power_on(entry, self.host_uuid)
+        try:
+            if entry.state != pvm_bp.LPARState.NOT_ACTIVATED:
+                pvm_pwr.power_off(entry, self.host_uuid, restart=True,
+                                  force_immediate=force_immediate)
+            else:
+                # pypowervm does NOT throw an exception if "already down".
+                # Any other exception from pypowervm is a legitimate failure;
+                # let it raise up.
+                # If we get here, pypowervm thinks the instance is down.
+                pvm_pwr.power_on(entry, self.host_uuid)
+        finally:
+            self._invalidate_lpar_cache(instance)
 
         # Again, pypowervm exceptions are sufficient to indicate real failure.
         # Otherwise, pypowervm thinks the instance is up.
         return True
 
+    @rest_stats.tracked
     def get_available_resource(self, nodename):
         """Retrieve resource information.
 
@@ -651,18 +962,11 @@ class PowerVMDriver(driver.ComputeDriver):
             a driver that manages only one node can safely ignore this
         :return: Dictionary describing resources
         """
-
-        resp = self.adapter.read(pvm_ms.System.schema_type,
-                                 root_id=self.host_uuid)
-        if resp:
-            self.host_wrapper = pvm_ms.System.wrap(resp.entry)
-        # Get host information
-        data = pvm_host.build_host_resource_from_ms(self.host_wrapper)
-
-        # Add the disk information
-        data["local_gb"] = self.disk_dvr.capacity
-        data["local_gb_used"] = self.disk_dvr.capacity_used
-
+        # The host and disk resources are gathered in the background.
+        data = self.resource_snapshot.get()
+        self.host_wrapper = self.resource_snapshot.host_wrapper
+        LOG.debug('Host resource ages (seconds): %s',
+                  self.resource_snapshot.freshness())
         return data
 
     def get_host_uptime(self):
@@ -679,6 +983,7 @@ class PowerVMDriver(driver.ComputeDriver):
         """Detach an interface from the instance."""
         self.unplug_vifs(instance, [vif])
 
+    @rest_stats.tracked
     def plug_vifs(self, instance, network_info):
         """Plug VIFs into networks."""
         self._log_operation('plug_vifs', instance)
@@ -706,6 +1011,7 @@ class PowerVMDriver(driver.ComputeDriver):
             raise exception.VirtualInterfacePlugException(
                 _("Plug vif failed because of an unexpected error."))
 
+    @rest_stats.tracked
     def unplug_vifs(self, instance, network_info):
         """Unplug VIFs from networks."""
         self._log_operation('unplug_vifs', instance)
@@ -785,6 +1091,7 @@ class PowerVMDriver(driver.ComputeDriver):
                 connector["wwpns"] = wwpn_list
         return connector
 
+    @rest_stats.tracked
     def migrate_disk_and_power_off(self, context, instance, dest,
                                    flavor, network_info,
                                    block_device_info=None,
@@ -846,8 +1153,12 @@ class PowerVMDriver(driver.ComputeDriver):
                       instance, flav_obj, entry=entry)
 
         # Update the VM
-        _update_vm()
+        try:
+            _update_vm()
+        finally:
+            self._invalidate_lpar_cache(instance)
 
+    @rest_stats.tracked
     def finish_migration(self, context, migration, instance, disk_info,
                          network_info, image_meta, resize_instance,
                          block_device_info=None, power_on=True):
@@ -873,6 +1184,7 @@ class PowerVMDriver(driver.ComputeDriver):
         if power_on:
             vm.power_on(self.adapter, instance, self.host_uuid)
 
+    @rest_stats.tracked
     def confirm_migration(self, migration, instance, network_info):
         """Confirms a resize, destroying the source VM.
 
@@ -884,6 +1196,7 @@ class PowerVMDriver(driver.ComputeDriver):
         # TODO(IBM): Anything to do here?
         pass
 
+    @rest_stats.tracked
     def finish_revert_migration(self, context, instance, network_info,
                                 block_device_info=None, power_on=True):
         """Finish reverting a resize.
@@ -998,6 +1311,7 @@ class PowerVMDriver(driver.ComputeDriver):
 
         return mig.check_source(context, block_device_info, vol_drvs)
 
+    @rest_stats.tracked
     def pre_live_migration(self, context, instance, block_device_info,
                            network_info, disk_info, migrate_data=None):
         """Prepare an instance for live migration
@@ -1021,6 +1335,7 @@ class PowerVMDriver(driver.ComputeDriver):
         return mig.pre_live_migration(context, block_device_info, network_info,
                                       disk_info, migrate_data, vol_drvs)
 
+    @rest_stats.tracked
     def live_migration(self, context, instance, dest,
                        post_method, recover_method, block_migration=False,
                        migrate_data=None):
@@ -1100,6 +1415,7 @@ class PowerVMDriver(driver.ComputeDriver):
         raise lpm.LiveMigrationFailed(name=instance.name,
                                       reason=six.text_type(ex))
 
+    @rest_stats.tracked
     def rollback_live_migration_at_destination(self, context, instance,
                                                network_info,
                                                block_device_info,
@@ -1151,6 +1467,7 @@ class PowerVMDriver(driver.ComputeDriver):
         return self.disk_dvr.check_instance_shared_storage_cleanup(
             context, data)
 
+    @rest_stats.tracked
     def post_live_migration(self, context, instance, block_device_info,
                             migrate_data=None):
         """Post operation of live migration at source host.
@@ -1167,6 +1484,7 @@ class PowerVMDriver(driver.ComputeDriver):
         mig = self.live_migrations[instance.uuid]
         mig.post_live_migration(vol_drvs, migrate_data)
 
+    @rest_stats.tracked
     def post_live_migration_at_source(self, context, instance, network_info):
         """Unplug VIFs from networks at source.
 
@@ -1179,6 +1497,7 @@ class PowerVMDriver(driver.ComputeDriver):
         mig = self.live_migrations[instance.uuid]
         mig.post_live_migration_at_source(network_info)
 
+    @rest_stats.tracked
     def post_live_migration_at_destination(self, context, instance,
                                            network_info,
                                            block_migration=False,
@@ -1373,3 +1692,13 @@ def _inst_dict(input_dict):
         response[key] = class_inst()
 
     return response
+
+
+def _loc_code_slot(loc_code):
+    """The slot of a virtual adapter, from its location code.
+
+    :param loc_code: The location code.  Ex. U8247.22L.2125D4A-V2-C3
+    :return: The slot number (ex. 3), or None if the location code has none.
+    """
+    match = re.search(r'-C(\d+)(-|$)', loc_code or '')
+    return int(match.group(1)) if match else None
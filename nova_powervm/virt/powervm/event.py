@@ -0,0 +1,123 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import re
+
+from nova.compute import power_state
+from nova import context as ctx
+from nova.i18n import _LW
+from nova.virt import event
+from oslo_log import log as logging
+from pypowervm import adapter as pvm_apt
+from pypowervm import exceptions as pvm_exc
+from pypowervm.wrappers import logical_partition as pvm_lpar
+
+from nova_powervm.virt.powervm import cache
+from nova_powervm.virt.powervm import vm
+
+LOG = logging.getLogger(__name__)
+
+# Matches the URI of a LogicalPartition entry (but not its children, such as
+# a ClientNetworkAdapter of the LPAR).
+_LPAR_URI_RE = re.compile(r'/%s/([0-9a-fA-F-]{36})$' %
+                          pvm_lpar.LPAR.schema_type)
+
+# The nova power states that are reported as lifecycle events.  Transitional
+# states (NOSTATE) are not reported; the final state will follow.
+_LIFECYCLE_EVENTS = {
+    power_state.RUNNING: event.EVENT_LIFECYCLE_STARTED,
+    power_state.SHUTDOWN: event.EVENT_LIFECYCLE_STOPPED,
+}
+
+
+def _lpar_uuid_from_uri(uri):
+    """Returns the LPAR UUID for an event URI, or None if not an LPAR."""
+    match = _LPAR_URI_RE.search(uri.split('?', 1)[0])
+    return match.group(1).upper() if match else None
+
+
+class PowerVMLPAREventHandler(pvm_apt.EventHandler):
+    """Keeps the LPAR state cache current from the REST event feed.
+
+    Each LPAR event causes a single read of that LPAR, which replaces the
+    entry in the cache.  If the (nova) power state of the LPAR changed, a
+    lifecycle event is emitted to the compute manager so that the change is
+    seen right away, rather than at the next power state sync.
+    """
+
+    def __init__(self, driver, lpar_cache):
+        """Creates the event handler.
+
+        :param driver: The PowerVM compute driver (used to emit the events).
+        :param lpar_cache: The LPARStateCache to keep current.
+        """
+        self._driver = driver
+        self._lpar_cache = lpar_cache
+
+    def process(self, events):
+        """Process the events from the REST API.
+
+        :param events: Dictionary of event URI to the action ('add', 'delete'
+                       or 'invalidate').  The special 'general' key indicates
+                       the whole feed should be considered invalid.
+        """
+        if events.get('general') == 'invalidate':
+            # Events were missed.  Reload the whole feed on next use.
+            LOG.debug('LPAR events missed, invalidating LPAR state cache.')
+            self._lpar_cache.invalidate()
+
+        for uri, action in events.items():
+            lpar_uuid = _lpar_uuid_from_uri(uri)
+            if lpar_uuid is None:
+                continue
+
+            if action == 'delete':
+                self._lpar_cache.remove(lpar_uuid)
+            else:
+                self._refresh_lpar(lpar_uuid)
+
+    def _refresh_lpar(self, lpar_uuid):
+        """Reads a single LPAR and updates the cache with it."""
+        try:
+            old_qps, new_qps = self._lpar_cache.refresh_lpar(lpar_uuid)
+        except pvm_exc.Error as e:
+            # Let the next lookup reload the data instead.
+            LOG.warn(_LW('Unable to read LPAR %(uuid)s for event: %(err)s'),
+                     {'uuid': lpar_uuid, 'err': e})
+            self._lpar_cache.invalidate(lpar_uuid)
+            return
+        if new_qps is None:
+            # Removed before it could be read.
+            return
+
+        # Only report actual changes of the nova power state.
+        new_state = vm._translate_vm_state(new_qps[cache.QP_STATE])
+        if (old_qps is not None and
+                vm._translate_vm_state(old_qps[cache.QP_STATE]) == new_state):
+            return
+        transition = _LIFECYCLE_EVENTS.get(new_state)
+        if transition is not None:
+            self._emit_event(lpar_uuid, transition)
+
+    def _emit_event(self, lpar_uuid, transition):
+        """Emits a lifecycle event for the nova instance of an LPAR."""
+        inst = vm.get_instance(ctx.get_admin_context(), lpar_uuid)
+        if inst is None:
+            # Not a nova managed LPAR (ex. a VIOS)
+            return
+        LOG.debug('Emitting lifecycle event %(evt)s for instance %(inst)s.',
+                  {'evt': transition, 'inst': inst.name})
+        self._driver.emit_event(event.LifecycleEvent(inst.uuid, transition))
@@ -101,6 +101,13 @@ class NoConfigTooManyClusters(AbstractDiskException):
                 "%(clust_count)d Clusters found.")
 
 
+class ImageLUUploadTimeout(AbstractDiskException):
+    msg_fmt = _("Timed out after %(timeout)d seconds waiting for another host "
+                "to finish uploading image LU %(lu_name)s to Shared Storage "
+                "Pool %(ssp_name)s.  If no host is uploading the image, "
+                "remove the marker LU %(marker)s.")
+
+
 class VolumeAttachFailed(nex.NovaException):
     msg_fmt = _("Unable to attach storage (id: %(volume_id)s) to virtual "
                 "machine %(instance_name)s.  %(reason)s")
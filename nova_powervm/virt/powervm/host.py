@@ -14,20 +14,57 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import datetime
 import math
 from nova.compute import arch
 from nova.compute import hv_type
 from nova.compute import vm_mode
-from nova.i18n import _LW
+from nova.i18n import _LE, _LW
 import subprocess
+import time
 
 from oslo_concurrency import lockutils
+from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_serialization import jsonutils
+from oslo_service import loopingcall
+from oslo_utils import timeutils
 
+from pypowervm import const as pvm_const
 from pypowervm.tasks.monitor import util as pcm_util
+from pypowervm.wrappers import managed_system as pvm_ms
+
+from nova_powervm.virt.powervm import vios
+
+host_opts = [
+    cfg.IntOpt('host_cpu_stats_interval',
+               default=30,
+               help='The number of seconds between refreshes of the host CPU '
+                    'metrics in the background.  PowerVM gathers the '
+                    'metrics every 30 seconds.  Callers get the latest '
+                    'metrics without waiting on a refresh.  A value of 0 '
+                    'refreshes the metrics on the caller\'s thread instead, '
+                    'when they are older than 30 seconds.'),
+    cfg.IntOpt('resource_snapshot_interval',
+               default=60,
+               help='The number of seconds between the background gathers of '
+                    'the host and storage resources reported by '
+                    'get_available_resource.  A value of 0 gathers them on '
+                    'every get_available_resource call instead.'),
+    cfg.BoolOpt('vios_load_metrics',
+                default=True,
+                help='If True, the host metrics also gather the Virtual I/O '
+                     'Server metrics, so that the FC and network throughput '
+                     'of each VIOS is known.  The VIOS CPU utilization is '
+                     'always known.  The image uploads, virtual optical '
+                     'media and SSP operations go to the least loaded '
+                     'VIOS.')
+]
 
 LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+CONF.register_opts(host_opts, group='powervm')
 
 # Power VM hypervisor info
 # Normally, the hypervisor version is a string in the form of '8.0.0' and
@@ -51,6 +88,75 @@ POWERVM_SUPPORTED_INSTANCES = jsonutils.dumps([(arch.PPC64,
 # cpu_info that will be returned by build_host_stats_from_entry()
 HOST_STATS_CPU_INFO = jsonutils.dumps({'vendor': 'ibm', 'arch': 'ppc64'})
 
+# The number of seconds between the samples PowerVM takes.
+PCM_SAMPLE_SECS = 30
+
+# The number of PCM samples for which the per-LPAR counters are kept.
+LPAR_SAMPLE_HISTORY = 10
+
+# The counters of an LPAR in one PCM sample.  The processor cycles are the
+# capped and uncapped cycles used.  The memory is in megabytes.
+LparCounters = collections.namedtuple(
+    'LparCounters', ['proc_cycles', 'logical_mem', 'backed_physical_mem',
+                     'nics'])
+
+# The counters of a virtual ethernet adapter in one PCM sample.  PCM
+# identifies the adapters by their physical location code.
+NicCounters = collections.namedtuple(
+    'NicCounters', ['location', 'vlan_id', 'rx_bytes', 'tx_bytes',
+                    'rx_packets', 'tx_packets', 'dropped_packets'])
+
+# The per-LPAR counters of one PCM sample.  The date is the (UTC) time stamp
+# of the sample.  Dictionary of the (PowerVM) LPAR UUID to its LparCounters.
+_LparSample = collections.namedtuple(
+    '_LparSample', ['date', 'cycles_per_sec', 'lpars'])
+
+
+class _PeriodicRefresh(object):
+    """Runs a refresh function every N seconds, on a looping call.
+
+    The interval comes from a configuration option.  If it is 0, the looping
+    call is not started and the owner refreshes on demand instead.
+    """
+
+    def __init__(self, func, interval_opt, error_msg):
+        """Creates the (not yet started) periodic refresh.
+
+        :param func: The function to invoke on each interval.
+        :param interval_opt: The name of the 'powervm' configuration option
+                             with the number of seconds between refreshes.
+        :param error_msg: The (translated) message logged if func fails.
+        """
+        self._func = func
+        self._interval_opt = interval_opt
+        self._error_msg = error_msg
+        self._timer = None
+
+    @property
+    def interval(self):
+        return getattr(CONF.powervm, self._interval_opt)
+
+    def start(self):
+        """Starts the looping call, if enabled and not already running."""
+        interval = self.interval
+        if interval <= 0 or self._timer is not None:
+            return
+        self._timer = loopingcall.FixedIntervalLoopingCall(self._run)
+        self._timer.start(interval=interval, initial_delay=interval)
+
+    def stop(self):
+        """Stops the looping call."""
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+    def _run(self):
+        # An exception would end the looping call.
+        try:
+            self._func()
+        except Exception:
+            LOG.exception(self._error_msg)
+
 
 def build_host_resource_from_ms(ms_wrapper):
     """Build the host resource dict from an MS adapter wrapper
@@ -104,8 +210,18 @@ class HostCPUStats(pcm_util.MetricCache):
     This can result in multiple, quickly successive calls to the host stats
     returning the same data (because a new sample may not be available yet).
 
+    The samples are pulled by a looping call, every host_cpu_stats_interval
+    seconds, from the time the driver starts it (see start).  The callers get
+    the last computed data, without waiting on (or locking against) a
+    refresh.
+
     The class analyzes the data and collapses it down to the format needed by
-    the Nova manager.
+    the Nova manager.  The counters of each LPAR are also kept, for the last
+    LPAR_SAMPLE_HISTORY samples, so the metrics of every instance come from
+    the same sample (see get_lpar_metrics).
+
+    Each new sample also feeds the load of the Virtual I/O Servers
+    (vios.LOAD_MONITOR).
     """
 
     def __init__(self, adapter, host_uuid):
@@ -116,24 +232,49 @@ class HostCPUStats(pcm_util.MetricCache):
                           cache for.
         """
         # A dictionary to store the number of cycles spent.  This is defined
-        # in the _update_internal_metric method.
+        # in the _update_internal_metric method.  Each refresh builds a new
+        # dictionary, so readers never see a partial update.
         self.cur_data, self.prev_data = None, None
 
-        # Invoke the parent to seed the metrics.  Don't include VIO - will
-        # result in quicker calls.
-        super(HostCPUStats, self).__init__(adapter, host_uuid,
-                                           include_vio=False)
+        # The processor frequency does not change.  Read on first use.
+        self._cpu_freq = None
+
+        # The duration (in seconds) of the last refresh of the metrics.
+        self.refresh_duration = None
+
+        # The per-LPAR counters of the recent samples (_LparSample), oldest
+        # first.
+        self._lpar_history = collections.deque(maxlen=LPAR_SAMPLE_HISTORY)
+
+        # The background refresh.  Started by the driver.
+        self._refresher = _PeriodicRefresh(
+            self._periodic_refresh, 'host_cpu_stats_interval',
+            _LE("Unable to refresh the host CPU metrics."))
+
+        # When refreshed in the background, every tick pulls the metrics.
+        # The refresh delta is measured from the end of the previous pull, so
+        # a delta equal to the interval would skip every other tick.
+        refresh_delta = (0 if self._refresher.interval > 0
+                         else PCM_SAMPLE_SECS)
+
+        # Invoke the parent to seed the metrics.  The VIO metrics are only
+        # needed for the VIOS load - leaving them out results in quicker
+        # calls.
+        super(HostCPUStats, self).__init__(
+            adapter, host_uuid, refresh_delta=refresh_delta,
+            include_vio=CONF.powervm.vios_load_metrics)
 
-    @lockutils.synchronized('pvm_host_metrics_get')
     def get_host_cpu_stats(self):
         """Returns the currently known host CPU stats.
 
+        The metrics are refreshed in the background, so this does not wait on
+        the REST API (unless the host_cpu_stats_interval is 0).
+
         :return: The dictionary (as defined by the compute driver's
                  get_host_cpu_stats).  If insufficient data is available,
                  then 'None' will be returned.
         """
-        # Refresh if needed.  Will no-op if no refresh is required.
-        self._refresh_if_needed()
+        self._ensure_current()
 
         # The invoking code needs the total cycles for this to work properly.
         # Return the dictionary format of the cycles as derived by the
@@ -141,6 +282,111 @@ class HostCPUStats(pcm_util.MetricCache):
         # be the result.
         return self.cur_data
 
+    def get_lpar_metrics(self, lpar_uuid=None):
+        """Returns the metrics of the LPARs, from the latest sample.
+
+        No REST call is made.  The metrics of all the LPARs come from the same
+        PCM sample, so the cost does not depend on the number of LPARs asked
+        for.
+
+        :param lpar_uuid: (Optional) The (PowerVM) UUID of a single LPAR.
+        :return: Dictionary of the (PowerVM) LPAR UUID to its metrics.  Only
+                 the LPARs in the latest sample are included (only lpar_uuid,
+                 if specified).  The metrics are a dictionary of:
+                   'date': The (UTC) datetime of the sample.
+                   'counters': The LparCounters.
+                   'cpu_time_ns': The processor time used, in nanoseconds.
+                   'rates': None if the LPAR was not in the previous sample.
+                            Otherwise, a dictionary of the 'proc_units' used,
+                            and the 'rx_bytes_per_sec' and 'tx_bytes_per_sec'
+                            of all the adapters, since the previous sample.
+        """
+        self._ensure_current()
+        history = list(self._lpar_history)
+        if not history:
+            return {}
+        cur = history[-1]
+        prev = history[-2] if len(history) > 1 else None
+        if lpar_uuid is None:
+            uuids = cur.lpars.keys()
+        else:
+            lpar_uuid = lpar_uuid.upper()
+            uuids = [lpar_uuid] if lpar_uuid in cur.lpars else []
+        return {uuid: self._lpar_metrics(uuid, cur, prev) for uuid in uuids}
+
+    @staticmethod
+    def _lpar_metrics(lpar_uuid, cur, prev):
+        """Builds the metrics of an LPAR (see get_lpar_metrics).
+
+        :param lpar_uuid: The (PowerVM) UUID of the LPAR.
+        :param cur: The current _LparSample.  Must include the LPAR.
+        :param prev: The previous _LparSample.  May be None.
+        :return: The dictionary of metrics.
+        """
+        counters = cur.lpars[lpar_uuid]
+        metrics = {'date': cur.date, 'counters': counters, 'rates': None,
+                   'cpu_time_ns': int(counters.proc_cycles * 1e9 /
+                                      cur.cycles_per_sec)
+                   if cur.cycles_per_sec else 0}
+
+        prev_counters = None if prev is None else prev.lpars.get(lpar_uuid)
+        secs = 0 if prev is None else (cur.date - prev.date).total_seconds()
+        if prev_counters is None or secs <= 0:
+            return metrics
+
+        delta_cycles = counters.proc_cycles - prev_counters.proc_cycles
+        metrics['rates'] = {
+            'proc_units': (float(delta_cycles) / (cur.cycles_per_sec * secs)
+                           if cur.cycles_per_sec else 0.0),
+            'rx_bytes_per_sec': (sum(nic.rx_bytes for nic in counters.nics) -
+                                 sum(nic.rx_bytes
+                                     for nic in prev_counters.nics)) / secs,
+            'tx_bytes_per_sec': (sum(nic.tx_bytes for nic in counters.nics) -
+                                 sum(nic.tx_bytes
+                                     for nic in prev_counters.nics)) / secs}
+        return metrics
+
+    def _ensure_current(self):
+        """Refreshes the metrics, unless refreshed in the background."""
+        if self._refresher.interval <= 0:
+            # Refresh if needed.  Will no-op if no refresh is required.
+            self._refresh()
+
+    @property
+    def staleness(self):
+        """The age (in seconds) of the current metrics.  None if no data."""
+        cur_date = self.cur_date
+        if cur_date is None:
+            return None
+        return (datetime.datetime.now() - cur_date).total_seconds()
+
+    def start(self):
+        """Starts refreshing the metrics in the background."""
+        self._refresher.start()
+
+    def stop(self):
+        """Stops refreshing the metrics in the background."""
+        self._refresher.stop()
+
+    def _periodic_refresh(self):
+        self._refresh()
+        staleness = self.staleness
+        if (staleness is not None and staleness > 3 * max(
+                self._refresher.interval, PCM_SAMPLE_SECS)):
+            LOG.warn(_LW("The host CPU metrics have not been updated for "
+                         "%d seconds."), staleness)
+
+    @lockutils.synchronized('pvm_host_metrics_get')
+    def _refresh(self):
+        """Refreshes the metrics, if they are older than the refresh delta."""
+        start = time.time()
+        prev_date = self.cur_date
+        self._refresh_if_needed()
+        if self.cur_date is not prev_date:
+            self.refresh_duration = time.time() - start
+            LOG.debug('Refreshed the host CPU metrics in %.3f seconds.',
+                      self.refresh_duration)
+
     def _update_internal_metric(self):
         """Uses the latest stats from the cache, and parses to Nova format.
 
@@ -154,10 +400,77 @@ class HostCPUStats(pcm_util.MetricCache):
             return
 
         # Move the current data to the previous.  The previous data is used
-        # for some internal calculations.  Blank out the current data just
-        # in case of error.  Don't want to persist two copies of same.
-        self.prev_data, self.cur_data = self.cur_data, None
+        # for some internal calculations.  The current data is replaced as a
+        # whole once the new data is built.
+        self.prev_data = self.cur_data
+        try:
+            self.cur_data = self._build_data()
+        except Exception:
+            # Blank out the current data in case of error.  Don't want to
+            # persist two copies of same.
+            self.cur_data = None
+            raise
+
+        # The same sample is returned again if PCM has not taken a new one
+        # yet.  Its counters have not moved, so it must not be counted again.
+        sample_date = self._sample_date(self.cur_phyp.sample)
+        if (self._lpar_history and
+                self._lpar_history[-1].date == sample_date):
+            return
+
+        # Keep the counters of each LPAR, once per PCM sample.
+        self._lpar_history.append(_LparSample(
+            sample_date, self.cur_phyp.sample.time_based_cycles,
+            self._lpar_counters(self.cur_phyp.sample.lpars)))
+
+        # Track the load of the Virtual I/O Servers.
+        vios.LOAD_MONITOR.update(sample_date, self.cur_phyp.sample,
+                                 self.cur_vioses)
+
+    def _sample_date(self, sample):
+        """The (UTC) time at which PCM took a sample.
+
+        :param sample: The PhypSample.
+        :return: The naive datetime of the time stamp of the sample.  If it
+                 can not be parsed, the time the sample was retrieved.
+        """
+        try:
+            return timeutils.normalize_time(
+                timeutils.parse_isotime(sample.time_stamp))
+        except (TypeError, ValueError):
+            LOG.debug('Unable to parse the PCM sample time stamp %s.',
+                      sample.time_stamp)
+            return self.cur_date
+
+    @staticmethod
+    def _lpar_counters(samples):
+        """Extracts the counters of each LPAR from a PCM sample.
 
+        :param samples: The PhypVMSample samples of the LPARs.
+        :return: Dictionary of the (PowerVM) LPAR UUID to its LparCounters.
+        """
+        lpars = {}
+        for sample in samples:
+            if sample.uuid is None:
+                continue
+            proc, mem, net = sample.processor, sample.memory, sample.network
+            nics = () if net is None else tuple(
+                NicCounters(vea.physical_location, vea.vlan_id,
+                            vea.received_bytes or 0, vea.sent_bytes or 0,
+                            vea.received_packets or 0, vea.sent_packets or 0,
+                            vea.dropped_packets or 0) for vea in net.veas)
+            lpars[sample.uuid.upper()] = LparCounters(
+                0 if proc is None else ((proc.util_cap_proc_cycles or 0) +
+                                        (proc.util_uncap_proc_cycles or 0)),
+                None if mem is None else mem.logical_mem,
+                None if mem is None else mem.backed_physical_mem, nics)
+        return lpars
+
+    def _build_data(self):
+        """Builds the Nova format of the current sample.
+
+        :return: The dictionary of cycles (see get_host_cpu_stats).
+        """
         # Now we need the firmware cycles.
         fw_cycles = self.cur_phyp.sample.system_firmware.utilized_proc_cycles
 
@@ -180,12 +493,13 @@ class HostCPUStats(pcm_util.MetricCache):
         # Idle is the subtraction of all.
         idle_cycles = tot_cycles - user_cycles - fw_cycles
 
-        # Get the processor frequency.
-        freq = self._get_cpu_freq()
+        # Get the processor frequency.  Only read once.
+        if self._cpu_freq is None:
+            self._cpu_freq = self._get_cpu_freq()
 
-        # Now save these cycles to the internal data structure.
-        self.cur_data = {'idle': idle_cycles, 'kernel': fw_cycles,
-                         'user': user_cycles, 'iowait': 0, 'frequency': freq}
+        # Now return these cycles for the internal data structure.
+        return {'idle': idle_cycles, 'kernel': fw_cycles, 'user': user_cycles,
+                'iowait': 0, 'frequency': self._cpu_freq}
 
     def _gather_user_cycles(self):
         """The estimated total user cycles.
@@ -244,11 +558,21 @@ class HostCPUStats(pcm_util.MetricCache):
         :param prev_samples: The set of the previous samples.  May be None.
         :return: The cycles spent on workload across all of the samples.
         """
+        # Will occur if there are no previous samples.  No deltas then.
+        if prev_samples is None:
+            return 0
+
+        # Index the previous samples once, rather than searching through all
+        # of them for each of the current samples.
+        prev_index = self._index_samples(prev_samples)
+
         # Determine the user cycles spent between the last sample and the
-        # current.
+        # current.  A sample without a previous sample (a new or migrated VM)
+        # has no delta.  Previous samples without a current one (a deleted or
+        # migrated VM) are ignored.
         user_cycles = 0
         for lpar_sample in samples:
-            prev_sample = self._find_prev_sample(lpar_sample, prev_samples)
+            prev_sample = prev_index.get((lpar_sample.id, lpar_sample.name))
             user_cycles += self._delta_user_cycles(lpar_sample, prev_sample)
         return user_cycles
 
@@ -281,20 +605,16 @@ class HostCPUStats(pcm_util.MetricCache):
         return cur_amount - prev_amount
 
     @staticmethod
-    def _find_prev_sample(sample, prev_samples):
-        """Finds the previous VM Sample for a given current sample.
+    def _index_samples(samples):
+        """Indexes a set of VM/VIOS samples by their ID and name.
+
+        Both are needed to match up the samples of a VM.  An LPAR ID can be
+        reused by a new VM once the previous one is deleted.
 
-        :param sample: The current sample.
-        :param prev_samples: The previous samples to search through.
-        :return: The previous sample, if it exists.  None otherwise.
+        :param samples: A set of PhypVMSample or PhypViosSample samples.
+        :return: Dictionary of (id, name) to the sample.
         """
-        # Will occur if there are no previous samples.
-        if prev_samples is None:
-            return None
-        for prev_sample in prev_samples:
-            if prev_sample.id == sample.id and prev_sample.name == sample.name:
-                return prev_sample
-        return None
+        return {(sample.id, sample.name): sample for sample in samples}
 
     def _get_total_cycles(self):
         """Returns the 'total cycles' on the system.
@@ -309,3 +629,102 @@ class HostCPUStats(pcm_util.MetricCache):
         est_total_cycles_per_sec = total_procs * cycles_per_sec
 
         return est_total_cycles_per_sec
+
+
+class ResourceSnapshot(object):
+    """The latest resources of the host, as reported to the resource tracker.
+
+    get_available_resource is called by a periodic task, and needs the host
+    (ManagedSystem) and the storage (volume group or SSP) resources.  A
+    looping call (see start) gathers both every resource_snapshot_interval
+    seconds, and get_available_resource returns the latest snapshot without
+    any REST call.
+
+    The ManagedSystem read is conditional (with the etag of the previous
+    one), so it is only downloaded when it changed.  The storage resources
+    come from a single read (see the disk driver's capacity_info).
+
+    The time that each part of the snapshot was last gathered is kept, so
+    the freshness of the data is known.
+    """
+
+    def __init__(self, adapter, host_wrapper, disk_dvr, host_cpu_stats=None):
+        """Creates the snapshot.  Gathered on first use, or once started.
+
+        :param adapter: The pypowervm Adapter.
+        :param host_wrapper: The current ManagedSystem wrapper of the host.
+        :param disk_dvr: The disk driver, for the storage resources.
+        :param host_cpu_stats: (Optional) The HostCPUStats of the host.  Used
+                               for the freshness of the CPU metrics.
+        """
+        self.adapter = adapter
+        self.host_wrapper = host_wrapper
+        self.disk_dvr = disk_dvr
+        self.host_cpu_stats = host_cpu_stats
+
+        # The resource dictionary.  Replaced as a whole by each gather.
+        self.data = None
+        # Part of the snapshot ('host' or 'disk') to the time it was gathered
+        self._gathered = {}
+
+        self._refresher = _PeriodicRefresh(
+            self.refresh, 'resource_snapshot_interval',
+            _LE("Unable to gather the host resources."))
+
+    def get(self):
+        """Returns the latest resource dictionary.
+
+        :return: The dictionary of resources, as defined by the compute
+                 driver's get_available_resource.
+        """
+        if self.data is None or self._refresher.interval <= 0:
+            self.refresh()
+        return self.data
+
+    def freshness(self):
+        """The age of each part of the snapshot.
+
+        :return: Dictionary of 'host', 'disk' and 'cpu' to the age of that
+                 data, in seconds.  None if that data was never gathered.
+        """
+        now = time.time()
+        ages = {part: None if self._gathered.get(part) is None
+                else now - self._gathered[part] for part in ('host', 'disk')}
+        ages['cpu'] = (self.host_cpu_stats.staleness
+                       if self.host_cpu_stats is not None else None)
+        return ages
+
+    def start(self):
+        """Starts gathering the resources in the background."""
+        self._refresher.start()
+
+    def stop(self):
+        """Stops gathering the resources in the background."""
+        self._refresher.stop()
+
+    @lockutils.synchronized('pvm_resource_snapshot')
+    def refresh(self):
+        """Gathers the host and storage resources into a new snapshot."""
+        resp = self.adapter.read(pvm_ms.System.schema_type,
+                                 root_id=self.host_wrapper.uuid,
+                                 etag=self.host_wrapper.etag)
+        if resp and resp.status != pvm_const.HTTPStatus.NO_CHANGE:
+            self.host_wrapper = pvm_ms.System.wrap(resp.entry)
+        self._gathered['host'] = time.time()
+        data = build_host_resource_from_ms(self.host_wrapper)
+
+        # Add the disk information.  If it can't be read, keep reporting the
+        # previous values rather than failing the whole snapshot.
+        try:
+            data['local_gb'], data['local_gb_used'] = (
+                self.disk_dvr.capacity_info)
+            self._gathered['disk'] = time.time()
+        except Exception:
+            if self.data is None:
+                raise
+            LOG.warn(_LW("Unable to gather the storage resources.  The "
+                         "previous values are reported."), exc_info=True)
+            data['local_gb'] = self.data['local_gb']
+            data['local_gb_used'] = self.data['local_gb_used']
+
+        self.data = data
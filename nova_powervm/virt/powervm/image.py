@@ -16,7 +16,71 @@
 
 """Utilities related to glance image management for the PowerVM driver."""
 
+import collections
+import struct
+import tempfile
+import threading
+import zlib
+
+import eventlet
+from eventlet import tpool
 from nova import utils
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import units
+from six.moves import queue
+
+from nova_powervm.virt.powervm.disk import driver as disk_drv
+
+image_opts = [
+    cfg.StrOpt('snapshot_disk_format',
+               default='raw',
+               choices=['raw', 'qcow2'],
+               help='The disk format of instance snapshots.  raw uploads '
+                    'every byte of the disk.  qcow2 leaves the all-zero '
+                    'regions of the disk out of the upload, so that the '
+                    'upload scales with the data actually on the disk.  The '
+                    'disk is then read twice (once to find the zero '
+                    'regions), but only locally.'),
+    cfg.IntOpt('snapshot_read_chunk_mb',
+               default=4,
+               help='The size, in megabytes, of the reads from the disk '
+                    'during a snapshot.'),
+    cfg.IntOpt('snapshot_read_ahead',
+               default=8,
+               help='The number of chunks of the disk that may be read ahead '
+                    'of the upload during a snapshot.'),
+    cfg.BoolOpt('snapshot_compression',
+                default=False,
+                help='If True, instance snapshots are uploaded as compressed '
+                     'qcow2 images (regardless of snapshot_disk_format).  '
+                     'This reduces the amount of data sent to glance, at the '
+                     'cost of CPU on the management partition.  The '
+                     'compressed data is spooled to a temporary file before '
+                     'it is uploaded.'),
+    cfg.StrOpt('snapshot_spool_dir',
+               help='The directory in which compressed snapshots are '
+                    'spooled.  Defaults to the system temporary directory.')
+]
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+CONF.register_opts(image_opts, group='powervm')
+
+# qcow2 (version 2) format constants.  64 KB clusters and 16 bit refcounts.
+_QCOW2_MAGIC = b'QFI\xfb'
+_QCOW2_CLUSTER_BITS = 16
+_QCOW2_CLUSTER_SIZE = 1 << _QCOW2_CLUSTER_BITS
+_QCOW2_HEADER = struct.Struct('>4sIQIIQIIQQIIQ')
+# Entries (offsets) in the L1 and L2 tables, flagged as not shared.
+_QCOW2_OFLAG_COPIED = 1 << 63
+# L2 entry flag of a compressed cluster.  The bits above the host offset hold
+# the number of additional 512 byte sectors of compressed data.
+_QCOW2_OFLAG_COMPRESSED = 1 << 62
+_QCOW2_CSIZE_SHIFT = 62 - (_QCOW2_CLUSTER_BITS - 8)
+# qcow2 compressed clusters are raw deflate streams with a 4 KB window.
+_QCOW2_WBITS = -12
+_QCOW2_L2_ENTRIES = _QCOW2_CLUSTER_SIZE // 8
 
 
 class OSDistro(object):
@@ -33,6 +97,11 @@ class OSDistro(object):
 def stream_blockdev_to_glance(context, image_api, image_id, metadata, devpath):
     """Stream the entire contents of a block device to a glance image.
 
+    The device is read in chunks on a separate thread, ahead of the upload.
+    If the disk_format in the metadata is qcow2, the all-zero clusters of the
+    device are left out of the upload.  If snapshot_compression is also set,
+    the other clusters are compressed.
+
     :param context: Nova security context
     :param image_api: Handle to the glance image API.
     :param image_id: UUID of the prepared glance image.
@@ -40,11 +109,367 @@ def stream_blockdev_to_glance(context, image_api, image_id, metadata, devpath):
     :param devpath: String path to device file of block device to be uploaded,
                     e.g. "/dev/sde".
     """
+    chunk_size = CONF.powervm.snapshot_read_chunk_mb * units.Mi
+    depth = CONF.powervm.snapshot_read_ahead
     # Make the device file owned by the current user for the duration of the
     # operation.
-    with utils.temporary_chown(devpath), open(devpath, 'rb') as stream:
-        # Stream it.  This is synchronous.
-        image_api.update(context, image_id, metadata, stream)
+    with utils.temporary_chown(devpath), open(devpath, 'rb') as dev:
+        # Works for block devices, where stat reports a size of 0.
+        dev_size = dev.seek(0, 2) or dev.tell()
+        if (metadata.get('disk_format') == 'qcow2' and
+                CONF.powervm.snapshot_compression):
+            chunks = _compressed_qcow2_chunks(dev, dev_size, chunk_size,
+                                              depth)
+        elif metadata.get('disk_format') == 'qcow2':
+            chunks = _qcow2_chunks(dev, dev_size, chunk_size, depth)
+        else:
+            chunks = (data for _offset, data in _ReadAhead(
+                dev, _extents(0, dev_size, chunk_size), depth))
+        # Stream it.  This is synchronous.  The adapter logs the amount of
+        # data sent and the throughput.
+        with disk_drv.IterableToFileAdapter(
+                chunks, name='device %s' % devpath) as stream:
+            image_api.update(context, image_id, metadata, stream)
+
+
+def _extents(offset, length, chunk_size):
+    """Splits a region into aligned extents of (at most) chunk_size bytes.
+
+    :param offset: The offset of the start of the region.
+    :param length: The length of the region.
+    :param chunk_size: The maximum length of each extent.
+    :return: Generator of (offset, length) tuples.
+    """
+    end = offset + length
+    while offset < end:
+        next_off = min((offset // chunk_size + 1) * chunk_size, end)
+        yield offset, next_off - offset
+        offset = next_off
+
+
+class _ReadAhead(object):
+    """Reads extents of a file on a separate thread, ahead of the consumer.
+
+    Iterating yields (offset, data) for each extent, in order.  At most depth
+    extents are read ahead.  Errors reading the file are raised to the
+    consumer.
+    """
+
+    _DONE = object()
+
+    def __init__(self, fileobj, extents, depth):
+        """Creates the reader.  The reads start when iteration does.
+
+        :param fileobj: The file to read.
+        :param extents: Iterable of (offset, length) extents to read.
+        :param depth: The maximum number of extents read ahead.
+        """
+        self._file = fileobj
+        self._extents = extents
+        self._queue = queue.Queue(maxsize=max(depth, 1))
+        self._stop = threading.Event()
+
+    def _put(self, item):
+        # Give up if the consumer stopped iterating.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read(self):
+        try:
+            for offset, length in self._extents:
+                self._file.seek(offset)
+                data = self._file.read(length)
+                # Zero fill a short read (past the end of the file)
+                data += b'\0' * (length - len(data))
+                if not self._put((offset, data)):
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._DONE)
+
+    def __iter__(self):
+        reader = threading.Thread(target=self._read)
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is self._DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self._stop.set()
+
+
+def _qcow2_scan(dev, dev_size, chunk_size, depth):
+    """Reads a device, finding the clusters that contain data.
+
+    :param dev: The open device file.
+    :param dev_size: The size of the device, in bytes.
+    :param chunk_size: The size of the reads from the device.  A multiple of
+                       the cluster size.
+    :param depth: The number of chunks that may be read ahead.
+    :return: Generator of (offset, data, clusters) for each chunk.  clusters
+             is the list of the offsets (within data) of the clusters that
+             contain data.
+    """
+    csize = _QCOW2_CLUSTER_SIZE
+    # The comparison against a block of zeros is done in C, and is cheap for
+    # a whole chunk.
+    zero_chunk = b'\0' * chunk_size
+    zero_cluster = zero_chunk[:csize]
+    for offset, data in _ReadAhead(dev, _extents(0, dev_size, chunk_size),
+                                   depth):
+        if data == zero_chunk[:len(data)]:
+            continue
+        yield offset, data, [idx for idx in range(0, len(data), csize)
+                             if data[idx:idx + csize] != zero_cluster]
+
+
+def _qcow2_chunk_size(chunk_size):
+    """Rounds a read size up to a multiple of the qcow2 cluster size."""
+    csize = _QCOW2_CLUSTER_SIZE
+    return max((chunk_size + csize - 1) // csize * csize, csize)
+
+
+def _qcow2_chunks(dev, dev_size, chunk_size, depth):
+    """Generates a qcow2 image of a device, leaving out the zero clusters.
+
+    The device is read twice.  The first pass finds the clusters with data.
+    The image metadata (header, L1/L2 and refcount tables) is then generated,
+    followed by those clusters, read from the device again.
+
+    :param dev: The open device file.
+    :param dev_size: The size of the device, in bytes.
+    :param chunk_size: The size of the reads from the device.  Rounded up to
+                       a multiple of the cluster size.
+    :param depth: The number of chunks that may be read ahead.
+    :return: Generator of the chunks of the qcow2 image.
+    """
+    csize = _QCOW2_CLUSTER_SIZE
+    chunk_size = _qcow2_chunk_size(chunk_size)
+
+    # First pass - the clusters that contain data.
+    data_clusters = []
+    for offset, _data, clusters in _qcow2_scan(dev, dev_size, chunk_size,
+                                               depth):
+        data_clusters.extend((offset + idx) // csize for idx in clusters)
+
+    header, tables = _qcow2_metadata(dev_size, data_clusters)
+    yield header
+    for table in tables:
+        yield table
+
+    # Second pass - the clusters with data, in runs of adjacent clusters.
+    def _runs():
+        start = prev = None
+        for idx in data_clusters:
+            if prev is not None and idx == prev + 1 and (
+                    (idx - start + 1) * csize <= chunk_size):
+                prev = idx
+                continue
+            if start is not None:
+                yield start * csize, (prev - start + 1) * csize
+            start = prev = idx
+        if start is not None:
+            yield start * csize, (prev - start + 1) * csize
+    for _offset, data in _ReadAhead(dev, _runs(), depth):
+        yield data
+
+
+def _compress_clusters(offset, data, clusters):
+    """Compresses clusters of a chunk of a device, as qcow2 expects.
+
+    :param offset: The offset of the chunk on the device.
+    :param data: The data of the chunk.
+    :param clusters: The offsets (within data) of the clusters to compress.
+    :return: List of (cluster index, compressed data) tuples.
+    """
+    csize = _QCOW2_CLUSTER_SIZE
+    blobs = []
+    for idx in clusters:
+        cluster = data[idx:idx + csize]
+        # A partial cluster at the end of the device must still decompress
+        # to a whole cluster.
+        cluster += b'\0' * (csize - len(cluster))
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, _QCOW2_WBITS)
+        blobs.append(((offset + idx) // csize,
+                      compressor.compress(cluster) + compressor.flush()))
+    return blobs
+
+
+def _compressed_qcow2_chunks(dev, dev_size, chunk_size, depth):
+    """Generates a compressed qcow2 image of a device.
+
+    The zero clusters are left out.  The other clusters are compressed, a
+    chunk at a time.  The compression is CPU bound, so it is run on an OS
+    thread (eventlet's tpool) rather than a green thread, which would block
+    the hub (and with it the service heartbeat and RPC) for its duration.
+    zlib releases the GIL, so up to depth chunks are compressed at once; their
+    results are spooled in order.
+    The qcow2 metadata must precede the data and depends on the compressed
+    size of every cluster, so the compressed data is spooled to a temporary
+    file until the whole device has been read.
+
+    :param dev: The open device file.
+    :param dev_size: The size of the device, in bytes.
+    :param chunk_size: The size of the reads from the device.  Rounded up to
+                       a multiple of the cluster size.
+    :param depth: The number of chunks that may be read ahead, and that may
+                  be compressed at once.
+    :return: Generator of the chunks of the qcow2 image.
+    """
+    chunk_size = _qcow2_chunk_size(chunk_size)
+    data_clusters, sizes = [], []
+    # The compressions in flight, oldest first.
+    pending = collections.deque()
+
+    def _spool_oldest():
+        for cluster, blob in pending.popleft().wait():
+            data_clusters.append(cluster)
+            sizes.append(len(blob))
+            spool.write(blob)
+
+    with tempfile.TemporaryFile(
+            dir=CONF.powervm.snapshot_spool_dir) as spool:
+        # The next chunks are read ahead while others are compressed.
+        try:
+            for offset, data, clusters in _qcow2_scan(
+                    dev, dev_size, chunk_size, depth):
+                pending.append(eventlet.spawn(
+                    tpool.execute, _compress_clusters, offset, data,
+                    clusters))
+                if len(pending) >= max(depth, 1):
+                    _spool_oldest()
+            while pending:
+                _spool_oldest()
+        finally:
+            # Do not leave compressions running if the read failed.
+            for gthread in pending:
+                gthread.kill()
+
+        header, tables = _qcow2_metadata(dev_size, data_clusters,
+                                         compressed_sizes=sizes)
+        yield header
+        for table in tables:
+            yield table
+
+        spool.seek(0)
+        spooled = 0
+        while True:
+            data = spool.read(chunk_size)
+            if not data:
+                break
+            spooled += len(data)
+            yield data
+        # The image ends on a cluster boundary.
+        if spooled % _QCOW2_CLUSTER_SIZE:
+            yield b'\0' * (_QCOW2_CLUSTER_SIZE -
+                           spooled % _QCOW2_CLUSTER_SIZE)
+
+
+def _qcow2_metadata(dev_size, data_clusters, compressed_sizes=None):
+    """Builds the metadata of a qcow2 image.
+
+    The image layout is: header, L1 table, refcount table, refcount blocks,
+    L2 tables, then the data clusters in order.
+
+    :param dev_size: The virtual size of the image, in bytes.
+    :param data_clusters: Sorted list of the indexes of the (virtual)
+                          clusters that contain data.
+    :param compressed_sizes: (Optional) If the data clusters are compressed,
+                             the list of their compressed sizes (in the same
+                             order as data_clusters).  The compressed data is
+                             packed, without gaps.
+    :return: The header cluster.
+    :return: List of the clusters of the tables, which follow the header.
+    """
+    csize = _QCOW2_CLUSTER_SIZE
+
+    def _clusters(nbytes):
+        return (nbytes + csize - 1) // csize
+
+    def _pad(buf):
+        return bytes(buf) + b'\0' * (_clusters(len(buf)) * csize - len(buf))
+
+    l1_size = max(_clusters(dev_size) // _QCOW2_L2_ENTRIES + (
+        1 if _clusters(dev_size) % _QCOW2_L2_ENTRIES else 0), 1)
+    l1_clusters = _clusters(l1_size * 8)
+    l2_indexes = sorted(set(idx // _QCOW2_L2_ENTRIES
+                            for idx in data_clusters))
+    if compressed_sizes is None:
+        n_data = len(data_clusters)
+    else:
+        n_data = _clusters(sum(compressed_sizes))
+
+    # The refcount blocks have to count themselves, so iterate until the
+    # number of clusters is stable.
+    n_rblocks, rt_clusters = 1, 1
+    while True:
+        total = (1 + l1_clusters + rt_clusters + n_rblocks + len(l2_indexes) +
+                 n_data)
+        need_rblocks = _clusters(total * 2)
+        need_rt = _clusters(need_rblocks * 8)
+        if (need_rblocks, need_rt) == (n_rblocks, rt_clusters):
+            break
+        n_rblocks, rt_clusters = need_rblocks, need_rt
+
+    l1_off = csize
+    rt_off = l1_off + l1_clusters * csize
+    rb_off = rt_off + rt_clusters * csize
+    l2_off = rb_off + n_rblocks * csize
+    data_off = l2_off + len(l2_indexes) * csize
+
+    l1 = [0] * l1_size
+    l2_tables = {}
+    for pos, l1_idx in enumerate(l2_indexes):
+        l1[l1_idx] = (l2_off + pos * csize) | _QCOW2_OFLAG_COPIED
+        l2_tables[l1_idx] = [0] * _QCOW2_L2_ENTRIES
+    # Every metadata cluster is referenced once.
+    refcounts = [1] * (data_off // csize)
+    if compressed_sizes is None:
+        entries = ((data_off + pos * csize) | _QCOW2_OFLAG_COPIED
+                   for pos in range(len(data_clusters)))
+        refcounts.extend([1] * n_data)
+    else:
+        entries = []
+        # A data cluster is referenced by each compressed cluster that has
+        # data in it.
+        data_refs = [0] * n_data
+        coff = data_off
+        for size in compressed_sizes:
+            first, last = coff // csize, (coff + size - 1) // csize
+            for host_idx in range(first, last + 1):
+                data_refs[host_idx - data_off // csize] += 1
+            sectors = ((coff + size - 1) >> 9) - (coff >> 9)
+            entries.append(coff | (sectors << _QCOW2_CSIZE_SHIFT) |
+                           _QCOW2_OFLAG_COMPRESSED)
+            coff += size
+        refcounts.extend(data_refs)
+    for idx, entry in zip(data_clusters, entries):
+        l2_tables[idx // _QCOW2_L2_ENTRIES][idx % _QCOW2_L2_ENTRIES] = entry
+
+    rtable = [rb_off + pos * csize for pos in range(n_rblocks)]
+    refcounts = struct.pack('>%dH' % total, *refcounts)
+
+    header = _QCOW2_HEADER.pack(
+        _QCOW2_MAGIC, 2, 0, 0, _QCOW2_CLUSTER_BITS, dev_size, 0, l1_size,
+        l1_off, rt_off, rt_clusters, 0, 0)
+    tables = [_pad(struct.pack('>%dQ' % l1_size, *l1)),
+              _pad(struct.pack('>%dQ' % n_rblocks, *rtable)),
+              _pad(refcounts)]
+    tables.extend(struct.pack('>%dQ' % _QCOW2_L2_ENTRIES, *l2_tables[idx])
+                  for idx in l2_indexes)
+    return _pad(header), tables
 
 
 def snapshot_metadata(context, image_api, image_id, instance):
@@ -61,7 +486,8 @@ def snapshot_metadata(context, image_api, image_id, instance):
         'name': image['name'],
         'is_public': False,
         'status': 'active',
-        'disk_format': 'raw',
+        'disk_format': ('qcow2' if CONF.powervm.snapshot_compression else
+                        CONF.powervm.snapshot_disk_format),
         'container_format': 'bare',
         'properties': {
             'image_location': 'snapshot',
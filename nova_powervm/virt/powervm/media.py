@@ -15,15 +15,23 @@
 #    under the License.
 
 import copy
+import fnmatch
 from nova.api.metadata import base as instance_metadata
-from nova.i18n import _LI, _LW
+from nova.i18n import _LE, _LI, _LW
 from nova.network import model as network_model
 from nova.virt import configdrive
 import os
+import shutil
+import six
+import tempfile
+import threading
+import time
 from taskflow import task
 
+from oslo_concurrency import lockutils
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import excutils
 
 from pypowervm import const as pvm_const
 from pypowervm.tasks import scsi_mapper as tsk_map
@@ -36,6 +44,7 @@ from pypowervm.wrappers import storage as pvm_stg
 from pypowervm.wrappers import virtual_io_server as pvm_vios
 
 from nova_powervm.virt.powervm import exception as npvmex
+from nova_powervm.virt.powervm import vios
 from nova_powervm.virt.powervm import vm
 
 LOG = logging.getLogger(__name__)
@@ -44,12 +53,213 @@ CONF = cfg.CONF
 
 _LLA_SUBNET = "fe80::/64"
 
+# Limits the number of config drive ISOs built at once.  Created on first use,
+# from the cfg_drive_build_workers option.
+_build_semaphore = None
+_build_semaphore_lock = threading.Lock()
+
+
+# The file name pattern of the config drive media.
+_CFG_DRV_PATTERN = 'cfg_*.iso'
+# Config drive media must be unmapped for this many seconds before the
+# background sweep removes it.  Allows for spawns that have uploaded their
+# media, but not yet mapped it.
+_SWEEP_GRACE = 900
+
+# The VOptReaper of the host.  Created on first use.
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def _get_reaper(adapter):
+    """Returns the VOptReaper (singleton) of the host."""
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = VOptReaper(adapter)
+    return _reaper
+
+
+def _build_slot():
+    """Returns the semaphore (or None) that limits concurrent ISO builds."""
+    global _build_semaphore
+    if CONF.powervm.cfg_drive_build_workers <= 0:
+        return None
+    with _build_semaphore_lock:
+        if _build_semaphore is None:
+            _build_semaphore = threading.BoundedSemaphore(
+                CONF.powervm.cfg_drive_build_workers)
+    return _build_semaphore
+
+
+class VOptReaper(object):
+    """Removes the virtual optical media that is no longer needed.
+
+    A destroy only removes the mapping of its config drive media (with the
+    rest of its storage updates) and queues the media here.  A background
+    thread removes the queued media every vopt_cleanup_interval seconds, all
+    of it with one update of the volume group.  That keeps the volume group
+    read and update out of the destroy, and does one update for many
+    destroys.
+
+    The thread also sweeps the media repository for config drive media that
+    has not been mapped to any VM for a while (ex. left behind by a failed
+    spawn or destroy), and removes it.
+    """
+
+    def __init__(self, adapter):
+        """Creates the reaper.  The thread starts when media is queued.
+
+        :param adapter: The pypowervm adapter.
+        """
+        self.adapter = adapter
+        # (VIOS UUID, VG UUID) of the media repository -> set of media names
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        # The names of the media being removed by the current flush
+        self._removing = set()
+        # Media name -> time it was first seen unmapped by the sweep
+        self._unmapped = {}
+        self._thread = None
+
+    def queue(self, vios_uuid, vg_uuid, media_names):
+        """Queues media for removal.
+
+        :param vios_uuid: The UUID of the VIOS of the media repository.
+        :param vg_uuid: The UUID of the volume group of the media repository.
+        :param media_names: The names of the media to remove.
+        """
+        if not media_names:
+            return
+        with self._pending_lock:
+            self._pending.setdefault((vios_uuid, vg_uuid), set()).update(
+                media_names)
+        if CONF.powervm.vopt_cleanup_interval <= 0:
+            self.flush()
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def ensure_removed(self, media_name):
+        """Removes the media now, if it is queued for removal.
+
+        Used before media is created, in case the media with the same name
+        (ex. of a previous VM with the same name) is still queued, or being
+        removed by a flush.  Returns once it is gone, so that the flush can
+        not remove the new media.
+
+        :param media_name: The name of the media.
+        """
+        with self._pending_lock:
+            queued = (media_name in self._removing or
+                      any(media_name in names
+                          for names in self._pending.values()))
+        if queued:
+            # Waits for the flush in progress (if any) to finish.
+            self.flush()
+
+    def _run(self):
+        while True:
+            time.sleep(max(CONF.powervm.vopt_cleanup_interval, 1))
+            try:
+                self.flush(sweep=True)
+            except Exception:
+                LOG.exception(_LE("Unable to remove unused virtual optical "
+                                  "media."))
+
+    @lockutils.synchronized('pvm_vopt_reaper')
+    def flush(self, sweep=False):
+        """Removes the queued media.
+
+        :param sweep: If True, also sweep the media repository for config
+                      drive media that is no longer mapped.
+        """
+        # The queued media is claimed, and tracked as being removed, at once.
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            self._removing = set().union(*pending.values())
+        if sweep:
+            repo = (ConfigDrivePowerVM._cur_vios_uuid,
+                    ConfigDrivePowerVM._cur_vg_uuid)
+            if repo[1] is not None:
+                pending.setdefault(repo, set())
+
+        try:
+            for (vios_uuid, vg_uuid), names in pending.items():
+                try:
+                    self._remove(vios_uuid, vg_uuid, names, sweep)
+                except Exception:
+                    # Try again next time.
+                    with excutils.save_and_reraise_exception():
+                        with self._pending_lock:
+                            self._pending.setdefault(
+                                (vios_uuid, vg_uuid), set()).update(names)
+        finally:
+            with self._pending_lock:
+                self._removing = set()
+
+    def _remove(self, vios_uuid, vg_uuid, names, sweep):
+        """Removes media from a media repository, with one VG update.
+
+        :param vios_uuid: The UUID of the VIOS of the media repository.
+        :param vg_uuid: The UUID of the volume group of the media repository.
+        :param names: The names of the media to remove.
+        :param sweep: If True, also remove the config drive media that has
+                      not been mapped for _SWEEP_GRACE seconds.
+        """
+        if not (names or sweep):
+            return
+        vg_rsp = self.adapter.read(pvm_vios.VIOS.schema_type,
+                                   root_id=vios_uuid,
+                                   child_type=pvm_stg.VG.schema_type,
+                                   child_id=vg_uuid)
+        vg_w = pvm_stg.VG.wrap(vg_rsp)
+        if not vg_w.vmedia_repos:
+            return
+        media = vg_w.vmedia_repos[0].optical_media
+        if sweep:
+            names = names | self._unmapped_media(
+                vios_uuid, [vopt.media_name for vopt in media])
+        vopts = [vopt for vopt in media if vopt.media_name in names]
+        for vopt in vopts:
+            self._unmapped.pop(vopt.media_name, None)
+        if vopts:
+            LOG.info(_LI("Removing %d virtual optical media."), len(vopts))
+            tsk_stg.rm_vg_storage(vg_w, vopts=vopts)
+
+    def _unmapped_media(self, vios_uuid, media_names):
+        """Finds the config drive media that has been unmapped for a while.
+
+        :param vios_uuid: The UUID of the VIOS of the media repository.
+        :param media_names: The names of the media in the media repository.
+        :return: The set of the names of the media to remove.
+        """
+        vios_w = pvm_vios.VIOS.wrap(self.adapter.read(
+            pvm_vios.VIOS.schema_type, root_id=vios_uuid,
+            xag=[pvm_vios.VIOS.xags.SCSI_MAPPING]))
+        mapped = set(smap.backing_storage.media_name
+                     for smap in vios_w.scsi_mappings
+                     if isinstance(smap.backing_storage, pvm_stg.VOptMedia))
+        now = time.time()
+        unmapped = {}
+        for name in media_names:
+            if fnmatch.fnmatch(name, _CFG_DRV_PATTERN) and name not in mapped:
+                unmapped[name] = self._unmapped.get(name, now)
+        self._unmapped = unmapped
+        return set(name for name, since in unmapped.items()
+                   if now - since >= _SWEEP_GRACE)
+
 
 class ConfigDrivePowerVM(object):
 
+    # The media repository, shared by all instances of the class.
     _cur_vios_uuid = None
     _cur_vios_name = None
     _cur_vg_uuid = None
+    # Incremented each time the media repository is (re)validated.
+    _cur_generation = 0
 
     def __init__(self, adapter, host_uuid):
         """Creates the config drive manager for PowerVM.
@@ -63,13 +273,42 @@ class ConfigDrivePowerVM(object):
         # The validate will use the cached static variables for the VIOS info.
         # Once validate is done, set the class variables to the updated cache.
         self._validate_vopt_vg()
+        self._set_repo()
 
+    def _set_repo(self):
+        """Sets the media repository to use from the shared cache."""
         self.vios_uuid = ConfigDrivePowerVM._cur_vios_uuid
         self.vios_name = ConfigDrivePowerVM._cur_vios_name
         self.vg_uuid = ConfigDrivePowerVM._cur_vg_uuid
+        self.repo_generation = ConfigDrivePowerVM._cur_generation
+
+    def _revalidate_on_failure(self, operation):
+        """Runs an operation against the media repository.
+
+        If the operation fails, the media repository is revalidated.  If
+        another repository is found, the operation is retried (once) against
+        it.  Otherwise the failure is raised.
+
+        :param operation: Method taking no arguments that uses the media
+                          repository.
+        :return: The result of the operation.
+        """
+        try:
+            return operation()
+        except Exception:
+            with excutils.save_and_reraise_exception() as ctxt:
+                used = (self.vios_uuid, self.vg_uuid)
+                self._validate_vopt_vg(generation=self.repo_generation)
+                self._set_repo()
+                if (self.vios_uuid, self.vg_uuid) != used:
+                    LOG.warn(_LW("Retrying with the virtual optical media "
+                                 "repository on Virtual I/O Server %s."),
+                             self.vios_name)
+                    ctxt.reraise = False
+        return operation()
 
     def _create_cfg_dr_iso(self, instance, injected_files, network_info,
-                           admin_pass=None):
+                           admin_pass=None, iso_dir=None):
         """Creates an ISO file that contains the injected files.  Used for
         config drive.
 
@@ -78,6 +317,8 @@ class ConfigDrivePowerVM(object):
                                the ISO.
         :param network_info: The network_info from the nova spawn method.
         :param admin_pass: Optional password to inject for the VM.
+        :param iso_dir: (Optional) The directory in which to build the ISO.
+                        Defaults to the image_meta_local_path option.
         :return iso_path: The path to the ISO
         :return file_name: The file name for the ISO
         """
@@ -92,7 +333,7 @@ class ConfigDrivePowerVM(object):
                                                      network_info=network_info)
 
         # Make sure the path exists.
-        im_path = CONF.powervm.image_meta_local_path
+        im_path = iso_dir or CONF.powervm.image_meta_local_path
         if not os.path.exists(im_path):
             os.mkdir(im_path)
 
@@ -104,9 +345,45 @@ class ConfigDrivePowerVM(object):
             LOG.info(_LI("Config drive ISO being built for instance %(inst)s "
                          "building to path %(iso_path)s."),
                      {'inst': instance.name, 'iso_path': iso_path})
-            cdb.make_drive(iso_path)
+            slot = _build_slot()
+            if slot is None:
+                cdb.make_drive(iso_path)
+            else:
+                with slot:
+                    cdb.make_drive(iso_path)
             return iso_path, file_name
 
+    def _create_cfg_dr_iso_in_memory(self, instance, injected_files,
+                                     network_info, admin_pass=None):
+        """Creates the config drive ISO in memory.
+
+        The ISO is built in a temporary directory on tmpfs (see the
+        cfg_drive_tmpfs_path option), then read into memory.  The directory
+        is removed before returning.
+
+        :param instance: The VM instance from OpenStack.
+        :param injected_files: A list of file paths that will be injected into
+                               the ISO.
+        :param network_info: The network_info from the nova spawn method.
+        :param admin_pass: Optional password to inject for the VM.
+        :return: A file-like object with the contents of the ISO.
+        :return: The file name for the ISO
+        :return: The size of the ISO, in bytes.
+        """
+        tmpfs_path = CONF.powervm.cfg_drive_tmpfs_path
+        build_dir = tempfile.mkdtemp(
+            prefix='cfgdrv', dir=tmpfs_path if os.path.isdir(tmpfs_path)
+            else None)
+        try:
+            iso_path, file_name = self._create_cfg_dr_iso(
+                instance, injected_files, network_info, admin_pass=admin_pass,
+                iso_dir=build_dir)
+            with open(iso_path, 'rb') as iso:
+                iso_data = iso.read()
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+        return six.BytesIO(iso_data), file_name, len(iso_data)
+
     def create_cfg_drv_vopt(self, instance, injected_files, network_info,
                             lpar_uuid, admin_pass=None, mgmt_cna=None,
                             stg_ftsk=None):
@@ -131,15 +408,33 @@ class ConfigDrivePowerVM(object):
             network_info = copy.deepcopy(network_info)
             network_info.append(self._mgmt_cna_to_vif(mgmt_cna))
 
-        iso_path, file_name = self._create_cfg_dr_iso(instance, injected_files,
-                                                      network_info, admin_pass)
-
-        # Upload the media
-        file_size = os.path.getsize(iso_path)
-        vopt, f_uuid = self._upload_vopt(iso_path, file_name, file_size)
+        if CONF.powervm.cfg_drive_in_memory:
+            # Build in memory and upload from there.
+            iso_stream, file_name, file_size = (
+                self._create_cfg_dr_iso_in_memory(
+                    instance, injected_files, network_info, admin_pass))
+            # Media of a destroyed VM by the same name may be pending removal
+            _get_reaper(self.adapter).ensure_removed(file_name)
+
+            def upload():
+                iso_stream.seek(0)
+                return tsk_stg.upload_vopt(
+                    self.adapter, self.vios_uuid, iso_stream, file_name,
+                    file_size)
+            vopt, f_uuid = self._revalidate_on_failure(upload)
+        else:
+            iso_path, file_name = self._create_cfg_dr_iso(
+                instance, injected_files, network_info, admin_pass)
 
-        # Delete the media
-        os.remove(iso_path)
+            # Upload the media
+            file_size = os.path.getsize(iso_path)
+            try:
+                _get_reaper(self.adapter).ensure_removed(file_name)
+                vopt, f_uuid = self._revalidate_on_failure(
+                    lambda: self._upload_vopt(iso_path, file_name, file_size))
+            finally:
+                # Delete the media
+                os.remove(iso_path)
 
         # Run the attach of the virtual optical
         self._attach_vopt(instance, lpar_uuid, vopt, stg_ftsk)
@@ -223,27 +518,52 @@ class ConfigDrivePowerVM(object):
             return tsk_stg.upload_vopt(self.adapter, self.vios_uuid, d_stream,
                                        file_name, file_size)
 
-    def _validate_vopt_vg(self):
+    def _validate_vopt_vg(self, generation=None):
         """Will ensure that the virtual optical media repository exists.
 
         This method will connect to one of the Virtual I/O Servers on the
         system and ensure that there is a root_vg that the optical media (which
         is temporary) exists.
 
+        The repository found is cached for all instances of the class.  Once
+        found, it is only validated again when an operation against it fails
+        (see _revalidate_on_failure), so this is normally free.
+
         If the volume group on an I/O Server goes down (perhaps due to
         maintenance), the system will rescan to determine if there is another
         I/O Server that can host the request.
 
         The very first invocation may be expensive.  It may also be expensive
-        to call if a Virtual I/O Server unexpectantly goes down.
+        to call if a Virtual I/O Server unexpectantly goes down.  Only one
+        thread does the (re)discovery; concurrent callers wait for, and use,
+        its result.
 
         If there are no Virtual I/O Servers that can support the media, then
         an exception will be thrown.
-        """
-
-        # TODO(IBM) Add thread safety here in case two calls into this are
-        # done at once.
 
+        :param generation: (Optional) Set if an operation against the cached
+                           repository failed.  The repo_generation of the
+                           repository used.  The repository is revalidated,
+                           unless that was already done since.
+        """
+        if generation is None and ConfigDrivePowerVM._cur_vg_uuid is not None:
+            return
+
+        with lockutils.lock('pvm_vopt_media_repo'):
+            # Another thread may have found (or revalidated) the repository
+            # while this one waited for the lock.
+            if (ConfigDrivePowerVM._cur_vg_uuid is not None and
+                    generation != ConfigDrivePowerVM._cur_generation):
+                return
+            self._locate_vopt_vg()
+            ConfigDrivePowerVM._cur_generation += 1
+
+    def _locate_vopt_vg(self):
+        """Validates, or finds, the virtual optical media repository.
+
+        Must be called under the media repository lock.  See
+        _validate_vopt_vg.
+        """
         # If our static variables were set, then we should validate that the
         # repo is still running.  Otherwise, we need to reset the variables
         # (as it could be down for maintenance).
@@ -275,9 +595,9 @@ class ConfigDrivePowerVM(object):
                                       child_type=pvm_vios.VIOS.schema_type)
         vio_wraps = pvm_vios.VIOS.wrap(vios_resp)
 
-        # First loop through the VIOSes to see if any have the right VG
-        found_vg = None
-        found_vios = None
+        # First loop through the VIOSes to find the ones with the right VG.
+        # Dictionary of the VIOS UUID to its (VIOS, VG) wrappers.
+        candidates = {}
 
         for vio_wrap in vio_wraps:
             # If the RMC state is not active, skip over to ensure we don't
@@ -292,14 +612,24 @@ class ConfigDrivePowerVM(object):
                 vg_wraps = pvm_stg.VG.wrap(vg_resp)
                 for vg_wrap in vg_wraps:
                     if vg_wrap.name == CONF.powervm.vopt_media_volume_group:
-                        found_vg = vg_wrap
-                        found_vios = vio_wrap
+                        candidates[vio_wrap.uuid] = (vio_wrap, vg_wrap)
                         break
             except Exception:
                 LOG.warn(_LW('Unable to read volume groups for Virtual '
                              'I/O Server %s'), vio_wrap.name)
                 pass
 
+        # Use a VG that already has a media repository if there is one, and
+        # the least loaded VIOS of those.
+        found_vg = None
+        found_vios = None
+        with_repos = [uuid for uuid, (vio_wrap, vg_wrap) in candidates.items()
+                      if vg_wrap.vmedia_repos]
+        if candidates:
+            vio_uuid = vios.LOAD_MONITOR.least_loaded(
+                sorted(with_repos or candidates))
+            found_vios, found_vg = candidates[vio_uuid]
+
         # If we didn't find a volume group...raise the exception.  It should
         # default to being the rootvg, which all VIOSes will have.  Otherwise,
         # this is user specified, and if it was not found is a proper
@@ -372,20 +702,25 @@ class ConfigDrivePowerVM(object):
             rm_vopt_mapping)
 
         # Find the vOpt device (before the remove is done) so that it can be
-        # removed.
-        partition_id = vm.get_vm_id(self.adapter, lpar_uuid)
-        media_mappings = tsk_map.find_maps(
-            stg_ftsk.get_wrapper(self.vios_uuid).scsi_mappings,
-            client_lpar_id=partition_id, match_func=match_func)
-        media_elems = [x.backing_storage for x in media_mappings]
+        # removed.  Match the mappings on the LPAR UUID.  Only if a mapping
+        # lacks the link to its LPAR is the (short) LPAR ID looked up.
+        scsi_mappings = stg_ftsk.get_wrapper(self.vios_uuid).scsi_mappings
+        media_mappings = tsk_map.find_maps(scsi_mappings,
+                                           client_lpar_id=lpar_uuid,
+                                           match_func=match_func)
+        if any(smap.client_lpar_href is None for smap in tsk_map.find_maps(
+                scsi_mappings, match_func=match_func)):
+            partition_id = vm.get_vm_id(self.adapter, lpar_uuid)
+            media_mappings = tsk_map.find_maps(
+                scsi_mappings, client_lpar_id=partition_id,
+                match_func=match_func)
+        media_names = [x.backing_storage.media_name for x in media_mappings]
 
         def rm_vopt():
             LOG.info(_LI("Removing virtual optical for VM with UUID %s."),
                      lpar_uuid)
-            vg_rsp = self.adapter.read(pvm_vios.VIOS.schema_type,
-                                       root_id=self.vios_uuid,
-                                       child_type=pvm_stg.VG.schema_type,
-                                       child_id=self.vg_uuid)
-            tsk_stg.rm_vg_storage(pvm_stg.VG.wrap(vg_rsp), vopts=media_elems)
+            # The media is removed in the background, with that of other VMs.
+            _get_reaper(self.adapter).queue(self.vios_uuid, self.vg_uuid,
+                                            media_names)
 
         stg_ftsk.add_post_execute(task.FunctorTask(rm_vopt))
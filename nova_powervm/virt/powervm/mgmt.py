@@ -22,27 +22,155 @@ aixlinux, but with the is_mgmt_partition property set to True.
 
 The PowerVM Nova Compute service runs on the management partition.
 """
+import ctypes
+from ctypes import util as ctypes_util
 import glob
 from nova import exception
 from nova import utils
 import os
 from os import path
 from pypowervm.wrappers import logical_partition as pvm_lpar
+import select
+import time
 
 from nova_powervm.virt.powervm import exception as npvmex
 
 from oslo_log import log as logging
-import retrying
 
 LOG = logging.getLogger(__name__)
 
+# inotify event masks (see linux/inotify.h)
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_CLOEXEC = 0o2000000
 
-def _tee_as_root(fpath, payload):
-    """Executes 'echo $payload | sudo tee -a $fpath'.
+# Seconds between polls when inotify is not available.
+_POLL_INTERVAL = 0.25
+# Even with inotify, check at least this often (seconds) in case an event is
+# missed.
+_WATCH_INTERVAL = 1
 
-    :param fpath: The file system path to which to tee.
-    :param payload: The string to pipe to the file.
+# The C library, for inotify.  Loaded on first use; False if not available.
+_libc = None
+
+
+def _get_libc():
+    """Returns the C library if it supports inotify, else None."""
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes_util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            # Raises AttributeError if not supported
+            libc.inotify_init1
+            libc.inotify_add_watch
+            _libc = libc
+        except (OSError, AttributeError):
+            LOG.debug('inotify is not available.  Device discovery will '
+                      'poll.')
+            _libc = False
+    return _libc or None
+
+
+class _DirWatch(object):
+    """Watches a directory for entries being added or removed.
+
+    Uses inotify when it is available.  Otherwise (or if the directory can not
+    be watched) wait simply sleeps, and callers fall back to polling.
+    """
+
+    def __init__(self, dirpath, mask):
+        """Starts watching the directory.
+
+        :param dirpath: The directory to watch.
+        :param mask: The inotify events to watch for.  See the _IN_* values.
+        """
+        self._fd = None
+        libc = _get_libc()
+        if libc is None:
+            return
+        fd = libc.inotify_init1(_IN_CLOEXEC)
+        if fd < 0:
+            return
+        if libc.inotify_add_watch(fd, dirpath.encode('utf-8'), mask) < 0:
+            os.close(fd)
+            return
+        self._fd = fd
+
+    @property
+    def active(self):
+        """True if the directory is being watched with inotify."""
+        return self._fd is not None
+
+    def wait(self, timeout):
+        """Waits until the directory changes, or the timeout passes.
+
+        :param timeout: The maximum number of seconds to wait.
+        """
+        if self._fd is None:
+            time.sleep(timeout)
+            return
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if ready:
+            # Discard the events; the caller rechecks what it is waiting for.
+            os.read(self._fd, 4096)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def _wait_for(check, dirpath, mask, timeout):
+    """Waits for a check to succeed, rechecking when a directory changes.
+
+    The directory watch is set up before the first check, so a change between
+    the check and the wait is not missed.
+
+    :param check: Method taking no arguments.  Its result is returned as soon
+                  as it is truthy.
+    :param dirpath: The directory whose changes might make the check succeed.
+    :param mask: The inotify events to watch for.  See the _IN_* values.
+    :param timeout: The maximum number of seconds to wait.
+    :return: The last result of the check.
+    :return: The number of times the check was run.
     """
+    deadline = time.time() + timeout
+    checks = 0
+    with _DirWatch(dirpath, mask) as watch:
+        interval = _WATCH_INTERVAL if watch.active else _POLL_INTERVAL
+        while True:
+            result = check()
+            checks += 1
+            remaining = deadline - time.time()
+            if result or remaining <= 0:
+                return result, checks
+            watch.wait(min(remaining, interval))
+
+
+def _write_sysfs(fpath, payload):
+    """Writes to a (sysfs) special file, as root if needed.
+
+    Writes directly when this process may, which avoids spawning a process.
+    Otherwise runs 'echo $payload | sudo tee -a $fpath'.  nova's
+    use_rootwrap_daemon option makes that use a long-running root helper
+    rather than a new sudo process for each write.
+
+    :param fpath: The file system path to write to.
+    :param payload: The string to write to the file.
+    """
+    if os.access(fpath, os.W_OK):
+        with open(fpath, 'a') as sysfs_file:
+            sysfs_file.write(payload)
+        return
     utils.execute('tee', '-a', fpath, process_input=payload, run_as_root=True)
 
 
@@ -96,25 +224,21 @@ def discover_vscsi_disk(mapping, scan_timeout=10):
     for scanpath in glob.glob(
             '/sys/bus/vio/devices/%x/host*/scsi_host/host*/scan' % lslot):
         # echo '- - -' | sudo tee -a /path/to/scan
-        _tee_as_root(scanpath, '- - -')
+        _write_sysfs(scanpath, '- - -')
 
     # Now see if our device showed up.  If so, we can reliably match it based
     # on its Linux ID, which ends with the disk's UDID.
     dpathpat = '/dev/disk/by-id/*%s' % udid
 
-    # The bus scan is asynchronous.  Need to poll, waiting for the device to
-    # spring into existence.  Stop when glob finds at least one device, or
-    # after the specified timeout.  Sleep 1/4 second between polls.
-    @retrying.retry(retry_on_result=lambda result: not result, wait_fixed=250,
-                    stop_max_delay=scan_timeout * 1000)
-    def _poll_for_dev(globpat):
-        return glob.glob(globpat)
-    try:
-        disks = _poll_for_dev(dpathpat)
-    except retrying.RetryError as re:
+    # The bus scan is asynchronous.  Need to wait for the device to spring
+    # into existence.  Stop when glob finds at least one device, or after the
+    # specified timeout.  udev creates the by-id link, so watch for it to
+    # appear (or poll every 1/4 second, if it can not be watched).
+    disks, polls = _wait_for(lambda: glob.glob(dpathpat), '/dev/disk/by-id',
+                             _IN_CREATE | _IN_MOVED_TO, scan_timeout)
+    if not disks:
         raise npvmex.NoDiskDiscoveryException(
-            bus=lslot, udid=udid, polls=re.last_attempt.attempt_number,
-            timeout=scan_timeout)
+            bus=lslot, udid=udid, polls=polls, timeout=scan_timeout)
     # If we get here, _poll_for_dev returned a nonempty list.  If not exactly
     # one entry, this is an error.
     if len(disks) != 1:
@@ -160,26 +284,23 @@ def remove_block_dev(devpath, scan_timeout=10):
     LOG.debug("Deleting block device %(devpath)s from the management "
               "partition via special file %(delpath)s.",
               {'devpath': devpath, 'delpath': delpath})
-    _tee_as_root(delpath, '1')
+    _write_sysfs(delpath, '1')
 
-    # The bus scan is asynchronous.  Need to poll, waiting for the device to
+    # The deletion is asynchronous.  Need to wait for the device to
     # disappear.  Stop when stat raises OSError (dev file not found) - which is
-    # success - or after the specified timeout (which is failure).  Sleep 1/4
-    # second between polls.
-    @retrying.retry(retry_on_result=lambda result: result, wait_fixed=250,
-                    stop_max_delay=scan_timeout * 1000)
-    def _poll_for_del(statpath):
+    # success - or after the specified timeout (which is failure).  Watch the
+    # device directory for the removal (or poll every 1/4 second, if it can
+    # not be watched).
+    def _dev_gone():
         try:
-            os.stat(statpath)
-            return True
+            os.stat(devpath)
+            return False
         except OSError:
             # Device special file is absent, as expected
-            return False
-    try:
-        _poll_for_del(devpath)
-    except retrying.RetryError as re:
+            return True
+    gone, polls = _wait_for(_dev_gone, path.dirname(devpath),
+                            _IN_DELETE | _IN_MOVED_FROM, scan_timeout)
+    if not gone:
         # stat just kept returning (dev file continued to exist).
         raise npvmex.DeviceDeletionException(
-            devpath=devpath, polls=re.last_attempt.attempt_number,
-            timeout=scan_timeout)
-    # Else stat raised - the device disappeared - all done.
+            devpath=devpath, polls=polls, timeout=scan_timeout)
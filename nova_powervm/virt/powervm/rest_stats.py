@@ -0,0 +1,323 @@
+# Copyright 2015 IBM Corp.
+#
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Accounting of the PowerVM REST API calls made by the driver operations.
+
+The stats_helper is installed as a pypowervm Adapter helper.  Every request
+that passes through it is tagged with the driver operation (and instance)
+that is currently running on the thread, and recorded by method and URI
+pattern: count, errors, bytes and a latency histogram.
+
+Driver operations are marked with the tracked decorator.  The operation is
+kept on the oslo request context, which pypowervm's ContextThreadPoolExecutor
+carries into the worker threads of the parallel flows and FeedTasks, so their
+requests are counted against it too.  Requests made outside of a tracked
+operation are recorded under the 'untracked' operation.
+"""
+
+import collections
+import contextlib
+import functools
+import inspect
+import re
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_context import context as ctx
+from oslo_log import log as logging
+
+stats_opts = [
+    cfg.BoolOpt('rest_stats',
+                default=True,
+                help='If True, the number, size and latency of the PowerVM '
+                     'REST API calls are recorded for each driver '
+                     'operation.')
+]
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+CONF.register_opts(stats_opts, group='powervm')
+
+UNTRACKED = 'untracked'
+
+# The number of recently completed operation runs that are kept.
+RECENT_OPS = 100
+
+# Upper bounds (in milliseconds) of the latency histogram buckets.  The last
+# bucket holds everything slower.
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+                      30000)
+
+_UUID_RE = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+                      r'[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+_NUM_RE = re.compile(r'/\d+(?=/|$)')
+
+# The attribute of the request context that holds the operation run.
+_RUN_ATTR = 'pvm_rest_stats_run'
+
+_context = threading.local()
+
+
+def uri_pattern(path):
+    """Reduces a request path to its pattern.
+
+    The query string is dropped and the UUIDs and numeric IDs in the path are
+    replaced by placeholders, so that ex. the reads of every LPAR are recorded
+    together.
+
+    :param path: The request path (or full URI).
+    :return: The path pattern.
+    """
+    path = path.split('?', 1)[0]
+    path = _UUID_RE.sub('{uuid}', path)
+    return _NUM_RE.sub('/{id}', path)
+
+
+def _body_len(body):
+    """Returns the size of a request or response body (0 if not known)."""
+    try:
+        return len(body) if body else 0
+    except TypeError:
+        # Ex. a file handle of an upload.
+        return 0
+
+
+class _CallStats(object):
+    """Totals of the REST calls with one operation, method and URI pattern."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.req_bytes = 0
+        self.resp_bytes = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, elapsed_ms, req_bytes, resp_bytes, error):
+        self.count += 1
+        self.errors += 1 if error else 0
+        self.req_bytes += req_bytes
+        self.resp_bytes += resp_bytes
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        for idx, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                break
+        else:
+            idx = len(LATENCY_BUCKETS_MS)
+        self.histogram[idx] += 1
+
+    def to_dict(self):
+        return {'count': self.count, 'errors': self.errors,
+                'req_bytes': self.req_bytes, 'resp_bytes': self.resp_bytes,
+                'total_ms': round(self.total_ms, 3),
+                'avg_ms': round(self.total_ms / self.count, 3),
+                'max_ms': round(self.max_ms, 3),
+                'histogram': list(self.histogram)}
+
+
+class _OperationRun(object):
+    """The REST calls made by a single run of a driver operation."""
+
+    def __init__(self, operation, instance_uuid):
+        self.operation = operation
+        self.instance_uuid = instance_uuid
+        self.calls = 0
+        self.bytes = 0
+        self.rest_ms = 0.0
+        self.start = time.time()
+
+    def to_dict(self):
+        return {'operation': self.operation, 'instance': self.instance_uuid,
+                'calls': self.calls, 'bytes': self.bytes,
+                'rest_ms': round(self.rest_ms, 3),
+                'elapsed_ms': round((time.time() - self.start) * 1000, 3)}
+
+
+class RESTStats(object):
+    """The REST call accounting of the process."""
+
+    def __init__(self, recent_ops=RECENT_OPS):
+        self._lock = threading.Lock()
+        self._recent_ops = recent_ops
+        self.reset()
+
+    def reset(self):
+        """Drops everything recorded so far."""
+        with self._lock:
+            # Dictionary of (operation, method, URI pattern) to _CallStats
+            self._calls = {}
+            # Dictionary of operation to [runs, calls]
+            self._ops = {}
+            self._recent = collections.deque(maxlen=self._recent_ops)
+
+    def record(self, method, path, elapsed_ms, req_bytes=0, resp_bytes=0,
+               error=False):
+        """Records a single REST call against the current operation.
+
+        :param method: The HTTP method.
+        :param path: The request path.
+        :param elapsed_ms: The latency of the call, in milliseconds.
+        :param req_bytes: The size of the request body.
+        :param resp_bytes: The size of the response body.
+        :param error: True if the call failed.
+        """
+        run = _current_run()
+        operation = run.operation if run is not None else UNTRACKED
+        key = (operation, method, uri_pattern(path))
+        with self._lock:
+            stats = self._calls.get(key)
+            if stats is None:
+                stats = self._calls[key] = _CallStats()
+            stats.add(elapsed_ms, req_bytes, resp_bytes, error)
+            # The run may be recorded against from several threads at once.
+            if run is not None:
+                run.calls += 1
+                run.bytes += req_bytes + resp_bytes
+                run.rest_ms += elapsed_ms
+
+    def operation_done(self, run):
+        """Records a completed run of a driver operation."""
+        summary = run.to_dict()
+        with self._lock:
+            totals = self._ops.setdefault(run.operation, [0, 0])
+            totals[0] += 1
+            totals[1] += run.calls
+            self._recent.append(summary)
+        LOG.debug('Operation %(operation)s on instance %(instance)s made '
+                  '%(calls)d REST calls (%(rest_ms).1f ms of '
+                  '%(elapsed_ms).1f ms).', summary)
+
+    def dump(self):
+        """Returns everything recorded so far.
+
+        :return: A dictionary with:
+                 'calls': list of the call totals (dictionaries) by
+                          operation, method and URI pattern.  Each has a
+                          'histogram' of the latencies, with one count for
+                          each of the LATENCY_BUCKETS_MS (plus one for the
+                          slower calls).
+                 'operations': dictionary of operation to the number of
+                               'runs' and the average REST 'calls_per_run'.
+                 'recent': list of the most recent operation runs.
+                 'buckets_ms': the LATENCY_BUCKETS_MS.
+        """
+        with self._lock:
+            calls = []
+            for (operation, method, pattern), stats in sorted(
+                    self._calls.items()):
+                entry = stats.to_dict()
+                entry.update(operation=operation, method=method,
+                             uri=pattern)
+                calls.append(entry)
+            ops = {op: {'runs': runs, 'calls_per_run': float(ncalls) / runs}
+                   for op, (runs, ncalls) in self._ops.items()}
+            return {'calls': calls, 'operations': ops,
+                    'recent': list(self._recent),
+                    'buckets_ms': list(LATENCY_BUCKETS_MS)}
+
+
+# The REST call accounting of the process.
+STATS = RESTStats()
+
+
+def stats_helper(func):
+    """Adapter helper that records each request in the REST stats.
+
+    Should be the last helper in the list, so that each retry (ex. of the
+    vios_busy_retry_helper) is recorded as its own call.
+
+    :param func: The Adapter request method to call.
+    """
+    def wrapper(method, path, **kwds):
+        start = time.time()
+        resp, error = None, False
+        try:
+            resp = func(method, path, **kwds)
+            return resp
+        except Exception as e:
+            error = True
+            resp = getattr(e, 'response', None)
+            raise
+        finally:
+            elapsed_ms = (time.time() - start) * 1000
+            STATS.record(method, path, elapsed_ms,
+                         req_bytes=_body_len(kwds.get('body')),
+                         resp_bytes=_body_len(getattr(resp, 'body', None)),
+                         error=error)
+    return wrapper
+
+
+def _current_run():
+    """Returns the operation run of the current thread (None if none).
+
+    The run is found on the thread that started the operation, or on the
+    request context that was carried into a worker thread.
+    """
+    run = getattr(_context, 'run', None)
+    if run is None:
+        run = getattr(ctx.get_current(), _RUN_ATTR, None)
+    return run
+
+
+@contextlib.contextmanager
+def operation(name, instance=None):
+    """Tags the REST calls made for an operation.
+
+    The calls of the current thread are tagged.  So are those of the worker
+    threads that get the current request context, if there is one.
+
+    If an operation is already running, its calls stay with the outer
+    operation.
+
+    :param name: The name of the driver operation.
+    :param instance: (Optional) The nova instance the operation acts on.
+    """
+    if _current_run() is not None:
+        yield
+        return
+    run = _OperationRun(name, getattr(instance, 'uuid', None))
+    context = ctx.get_current()
+    _context.run = run
+    if context is not None:
+        setattr(context, _RUN_ATTR, run)
+    try:
+        yield
+    finally:
+        _context.run = None
+        if context is not None:
+            setattr(context, _RUN_ATTR, None)
+        STATS.operation_done(run)
+
+
+def tracked(func):
+    """Decorator marking a driver method as a tracked operation.
+
+    The operation is named after the method.  The instance is taken from its
+    'instance' argument, if it has one.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            instance = inspect.getcallargs(func, *args, **kwargs).get(
+                'instance')
+        except TypeError:
+            instance = None
+        with operation(func.__name__, instance=instance):
+            return func(*args, **kwargs)
+    return wrapper
@@ -14,6 +14,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+
 from nova.i18n import _LI, _LW
 from pypowervm.tasks import scsi_mapper as pvm_smap
 
@@ -73,6 +75,50 @@ class ConnectVolume(task.Task):
                      {'inst': self.vol_drv.instance.name, 'error': e.message})
 
 
+class ConnectVolumes(task.Task):
+    """The task to connect several volumes to an instance."""
+
+    def __init__(self, vol_drvs):
+        """Create the task.
+
+        :param vol_drvs: The volume drivers (see volume folder).  The volumes
+                         of each connection type are connected together, so
+                         that the discovery work can be shared.
+        """
+        self.vol_drvs = vol_drvs
+        self.vol_ids = [vol_drv.connection_info['data']['volume_id']
+                        for vol_drv in vol_drvs]
+        super(ConnectVolumes, self).__init__(name='connect_vols')
+
+    def execute(self):
+        LOG.info(_LI('Connecting volumes %(vols)s to instance %(inst)s'),
+                 {'vols': self.vol_ids,
+                  'inst': self.vol_drvs[0].instance.name})
+        # Group the volume drivers by connection type, keeping their order.
+        by_type = collections.OrderedDict()
+        for vol_drv in self.vol_drvs:
+            by_type.setdefault(type(vol_drv), []).append(vol_drv)
+        for vol_drvs in by_type.values():
+            vol_drvs[0].connect_volumes(vol_drvs)
+
+    def revert(self, result, flow_failures):
+        # The parameters have to match the execute method, plus the response +
+        # failures even if only a subset are used.
+        for vol_drv, vol_id in zip(self.vol_drvs, self.vol_ids):
+            LOG.warn(_LW('Volume %(vol)s for instance %(inst)s to be '
+                         'disconnected'),
+                     {'vol': vol_id, 'inst': vol_drv.instance.name})
+
+            # See ConnectVolume.revert
+            vol_drv.reset_stg_ftsk()
+            try:
+                vol_drv.disconnect_volume()
+            except npvmex.VolumeDetachFailed as e:
+                LOG.warn(_LW("Unable to disconnect volume for %(inst)s during "
+                             "rollback.  Error was: %(error)s"),
+                         {'inst': vol_drv.instance.name, 'error': e.message})
+
+
 class DisconnectVolume(task.Task):
     """The task to disconnect a volume from an instance."""
 
@@ -503,3 +549,24 @@ class SaveBDM(task.Task):
                      'on instance %(inst)s.'),
                  {'vol_id': self.bdm.volume_id, 'inst': self.instance.name})
         self.bdm.save()
+
+
+class RunCoalescedFeedTask(task.Task):
+    """Task to run a storage FeedTask through a FeedTaskCoalescer."""
+
+    def __init__(self, coalescer, stg_ftsk, xag=None):
+        """Creates the Task to run the FeedTask with those of other operations.
+
+        :param coalescer: The vios.FeedTaskCoalescer to run the FeedTask with.
+        :param stg_ftsk: The pypowervm transaction FeedTask for the I/O
+                         Operations.
+        :param xag: (Optional) The extended attributes the FeedTask requires.
+        """
+        self.coalescer = coalescer
+        self.stg_ftsk = stg_ftsk
+        self.xag = xag
+        super(RunCoalescedFeedTask, self).__init__(
+            name='coalesced_%s' % stg_ftsk.name)
+
+    def execute(self):
+        self.coalescer.run(self.stg_ftsk, xag=self.xag)
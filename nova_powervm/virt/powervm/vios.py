@@ -14,6 +14,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import copy
+import random
+import threading
+import time
+import weakref
+
+from nova.i18n import _LW
 from oslo_config import cfg
 from oslo_log import log as logging
 
@@ -21,7 +29,10 @@ from pypowervm.utils import transaction as pvm_tx
 from pypowervm.wrappers import base_partition as pvm_bp
 from pypowervm.wrappers import managed_system as pvm_ms
 from pypowervm.wrappers import virtual_io_server as pvm_vios
+from taskflow import engines as tf_eng
+from taskflow.patterns import linear_flow as tf_lf
 
+from nova_powervm.virt.powervm import cache
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
@@ -34,6 +45,26 @@ VALID_RMC_STATES = [pvm_bp.RMCState.ACTIVE, pvm_bp.RMCState.BUSY]
 # Only a running state is OK for now.
 VALID_VM_STATES = [pvm_bp.LPARState.RUNNING]
 
+# The load of a VIOS over the interval between two PCM samples.  The CPU
+# utilization is the fraction of its entitled processor cycles that it used.
+# The throughputs are in bytes per second.
+VIOSLoad = collections.namedtuple('VIOSLoad', ['cpu_util', 'fc_bytes_per_sec',
+                                               'net_bytes_per_sec'])
+
+# The cumulative counters of a VIOS in a single PCM sample.
+_VIOSCounters = collections.namedtuple(
+    '_VIOSCounters', ['date', 'used_cycles', 'entitled_cycles', 'fc_bytes',
+                      'net_bytes'])
+
+
+def _read_vioses(adapter, host_uuid, xag=None):
+    """Reads the VIOS feed of a host, through the cache if it is enabled."""
+    if CONF.powervm.vios_feed_cache:
+        return cache.VIOS_FEED_CACHE.get(adapter, host_uuid, xag=xag)
+    return pvm_vios.VIOS.wrap(adapter.read(
+        pvm_ms.System.schema_type, root_id=host_uuid,
+        child_type=pvm_vios.VIOS.schema_type, xag=xag))
+
 
 def get_active_vioses(adapter, host_uuid, xag=None):
     """Returns a list of active Virtual I/O Server Wrappers for a host.
@@ -46,10 +77,7 @@ def get_active_vioses(adapter, host_uuid, xag=None):
                 in defaults to None.
     :return: List of VIOS wrappers.
     """
-    vio_feed_resp = adapter.read(pvm_ms.System.schema_type, root_id=host_uuid,
-                                 child_type=pvm_vios.VIOS.schema_type,
-                                 xag=xag)
-    wrappers = pvm_vios.VIOS.wrap(vio_feed_resp)
+    wrappers = _read_vioses(adapter, host_uuid, xag=xag)
     return [vio for vio in wrappers if is_vios_active(vio)]
 
 
@@ -66,10 +94,8 @@ def is_vios_active(vios):
 
 def get_physical_wwpns(adapter, ms_uuid):
     """Returns the active WWPNs of the FC ports across all VIOSes on system."""
-    resp = adapter.read(pvm_ms.System.schema_type, root_id=ms_uuid,
-                        child_type=pvm_vios.VIOS.schema_type,
-                        xag=[pvm_vios.VIOS.xags.STORAGE])
-    vios_feed = pvm_vios.VIOS.wrap(resp)
+    vios_feed = _read_vioses(adapter, ms_uuid,
+                             xag=[pvm_vios.VIOS.xags.STORAGE])
     wwpn_list = []
     for vios in vios_feed:
         wwpn_list.extend(vios.get_active_pfc_wwpns())
@@ -100,3 +126,377 @@ def build_tx_feed_task(adapter, host_uuid, name='vio_feed_mgr',
     """
     return pvm_tx.FeedTask(name,
                            get_active_vioses(adapter, host_uuid, xag=xag))
+
+
+class _CoalescedBatch(object):
+    """The FeedTasks collected during a single coalescing window."""
+
+    def __init__(self):
+        # List of (FeedTask, xag) tuples
+        self.members = []
+        # Dictionary of id(FeedTask) to the exception it raised
+        self.errors = {}
+        # Set once every FeedTask built by the coalescer has joined
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class _CoalescedFeedTask(pvm_tx.FeedTask):
+    """A FeedTask built by the FeedTaskCoalescer.
+
+    Keeps its own list of the post-execute tasks, so that the coalescer can
+    run them after a combined update.
+    """
+
+    def __init__(self, name, feed):
+        super(_CoalescedFeedTask, self).__init__(name, feed)
+        self.post_execs = []
+
+    def add_post_execute(self, *tasks):
+        super(_CoalescedFeedTask, self).add_post_execute(*tasks)
+        self.post_execs.extend(tasks)
+
+
+class FeedTaskCoalescer(object):
+    """Runs the storage FeedTasks of concurrent operations as one FeedTask.
+
+    Each spawn collects its VIOS mapping changes in its own FeedTask.  Run on
+    their own, N concurrent spawns cost N GETs and N POSTs per VIOS, and the
+    POSTs collide on the VIOS etag (forcing a refresh and retry).
+
+    Instead, the first FeedTask to arrive opens a window, if other FeedTasks
+    built by the coalescer have yet to arrive.  All FeedTasks that arrive
+    within that window have their subtasks copied on to a single FeedTask
+    (built from one fresh read of the VIOS feed), which then does a single
+    update per VIOS.  Their post-execute tasks are run after it, each with the
+    results of the combined update.  If that combined update fails, each
+    FeedTask is redriven on its own so that the failure is reported only to
+    the operation that caused it.
+    """
+
+    def __init__(self, adapter, host_uuid, window=None):
+        """Creates the coalescer.
+
+        :param adapter: The pypowervm adapter.
+        :param host_uuid: The host server's UUID.
+        :param window: (Optional) The number of seconds to collect FeedTasks
+                       before they are run.  Defaults to the
+                       spawn_coalesce_window configuration option.
+        """
+        self.adapter = adapter
+        self.host_uuid = host_uuid
+        self.window = (CONF.powervm.spawn_coalesce_window if window is None
+                       else window)
+        self._lock = threading.Lock()
+        self._pending = None
+        # The FeedTasks built, but not yet run, by id.  Weak, as an operation
+        # that fails before it runs its FeedTask simply drops it.
+        self._unjoined = weakref.WeakValueDictionary()
+        # Dictionary of frozenset(xag) to (time read, active VIOS wrappers)
+        self._feed_lock = threading.Lock()
+        self._feeds = {}
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def build_feed_task(self, name='vio_feed_mgr', xag=None):
+        """Builds a FeedTask whose subtasks are to be run by this coalescer.
+
+        The VIOS feed is read once for all of the FeedTasks built within one
+        window.  Each FeedTask gets its own copy of the wrappers, as a
+        FeedTask updates its wrappers when it is run on its own.
+
+        :param name: (Optional) The name of the FeedTask.
+        :param xag: (Optional) List of extended attributes to use.  Defaults
+                    to the storage options (see build_tx_feed_task).
+        :return: The pypowervm FeedTask.
+        """
+        xag = _default_xag() if xag is None else xag
+        key = frozenset(xag)
+        with self._feed_lock:
+            read_time, feed = self._feeds.get(key, (0, None))
+            if feed is None or time.time() - read_time >= self.window:
+                feed = get_active_vioses(self.adapter, self.host_uuid,
+                                         xag=xag)
+                self._feeds[key] = (time.time(), feed)
+        ftsk = _CoalescedFeedTask(name, copy.deepcopy(feed))
+        with self._lock:
+            self._unjoined[id(ftsk)] = ftsk
+        return ftsk
+
+    def run(self, ftsk, xag=None):
+        """Runs the FeedTask along with any others in the current window.
+
+        Blocks until the FeedTask has been run.
+
+        :param ftsk: The FeedTask to run.
+        :param xag: (Optional) The extended attributes the FeedTask requires.
+        :raise: Any exception raised when the FeedTask is run on its own.
+        """
+        xag = _default_xag() if xag is None else xag
+        with self._lock:
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = _CoalescedBatch()
+            batch.members.append((ftsk, xag))
+            self._unjoined.pop(id(ftsk), None)
+            if not self._unjoined:
+                batch.full.set()
+
+        if leader:
+            # Only hold the FeedTask back while other operations are on their
+            # way to join it.
+            batch.full.wait(self.window)
+            with self._lock:
+                self._pending = None
+            try:
+                self._flush(batch)
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if id(ftsk) in batch.errors:
+            raise batch.errors[id(ftsk)]
+
+    def _flush(self, batch):
+        """Runs all of the FeedTasks in the batch."""
+        if len(batch.members) == 1:
+            # Nothing to combine with.  The FeedTask's own feed is as current
+            # as it would be without the coalescer.
+            self._run_alone(batch, batch.members[0][0])
+            return
+
+        xag = sorted(set(x for member in batch.members for x in member[1]))
+        try:
+            merged = build_tx_feed_task(self.adapter, self.host_uuid,
+                                        name='coalesced_vio_feed_mgr',
+                                        xag=xag)
+        except Exception as e:
+            LOG.warn(_LW('Unable to read the VIOS feed for a combined update '
+                         '(%s).  Running each operation on its own.'), e)
+            merged = None
+
+        combined, alone = [], []
+        for ftsk, _xag in batch.members:
+            if merged is not None and _merge_feed_task(merged, ftsk):
+                combined.append(ftsk)
+            else:
+                alone.append(ftsk)
+
+        if combined:
+            LOG.debug('Running the VIOS updates of %d operations as one '
+                      'FeedTask.', len(combined))
+            try:
+                rets = merged.execute() or {}
+            except Exception as e:
+                LOG.warn(_LW('Combined VIOS update failed (%s).  Running '
+                             'each operation on its own.'), e)
+                # Ex. the retries of an etag mismatch (412) ran out.  Do not
+                # trust the cached feed.
+                cache.VIOS_FEED_CACHE.invalidate(self.host_uuid)
+                alone.extend(combined)
+            else:
+                for ftsk in combined:
+                    self._run_post_execs(batch, ftsk, rets)
+
+        for ftsk in alone:
+            self._run_alone(batch, ftsk)
+
+    @staticmethod
+    def _run_post_execs(batch, ftsk, rets):
+        """Runs the post-execute tasks of a FeedTask after a combined update.
+
+        As pypowervm would, the tasks are run in order, with the results of
+        the WrapperTasks (those of the combined update).
+        """
+        if not ftsk.post_execs:
+            return
+        flow = tf_lf.Flow('%s_post_execs' % ftsk.name)
+        flow.add(*ftsk.post_execs)
+        try:
+            tf_eng.run(flow, store={'wrapper_task_rets':
+                                    rets.get('wrapper_task_rets', {})})
+        except Exception as e:
+            batch.errors[id(ftsk)] = e
+
+    def _run_alone(self, batch, ftsk):
+        """Runs a single FeedTask as is, recording any failure."""
+        try:
+            ftsk.execute()
+        except Exception as e:
+            cache.VIOS_FEED_CACHE.invalidate(self.host_uuid)
+            batch.errors[id(ftsk)] = e
+
+
+def _default_xag():
+    return [pvm_vios.VIOS.xags.STORAGE, pvm_vios.VIOS.xags.SCSI_MAPPING,
+            pvm_vios.VIOS.xags.FC_MAPPING]
+
+
+def _merge_feed_task(tgt_ftsk, src_ftsk):
+    """Copies the subtasks of one FeedTask on to another.
+
+    :param tgt_ftsk: The FeedTask to add the subtasks to.
+    :param src_ftsk: The FeedTask whose subtasks are copied.
+    :return: True if the subtasks were copied.  False if the FeedTask can not
+             be merged (it was not built by the coalescer, targets a VIOS that
+             is not in the target feed, or has a 'provides' name already used
+             in the target).  Nothing is copied in that case.
+    """
+    # Only the coalescer's FeedTasks track their post-execute tasks, which
+    # are run after the combined update (see _run_post_execs).
+    if not isinstance(src_ftsk, _CoalescedFeedTask):
+        return False
+
+    plan = []
+    for uuid, src_wtsk in src_ftsk.wrapper_tasks.items():
+        if not src_wtsk.subtasks:
+            continue
+        tgt_wtsk = tgt_ftsk.wrapper_tasks.get(uuid)
+        if tgt_wtsk is None:
+            return False
+        provides = [st.provides for st in src_wtsk.subtasks
+                    if st.provides is not None]
+        if set(provides) & tgt_wtsk.provided_keys:
+            return False
+        plan.append((tgt_wtsk, src_wtsk.subtasks))
+
+    for tgt_wtsk, subtasks in plan:
+        for subtask in subtasks:
+            tgt_wtsk.add_subtask(subtask)
+    return True
+
+
+class VIOSLoadMonitor(object):
+    """Tracks the load of the Virtual I/O Servers, from the PCM samples.
+
+    Fed by the HostCPUStats on each new sample.  The hypervisor sample has
+    the processor cycles of each VIOS.  The (optional) VIOS samples add the
+    bytes moved through its physical FC and network adapters.  The load of a
+    VIOS is computed from the deltas of two successive samples.
+
+    Used to send the I/O heavy operations (ex. image uploads, virtual optical
+    media, SSP operations) to the least loaded VIOS.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Dictionary of the (upper case) VIOS UUID to its _VIOSCounters in
+        # the last sample.
+        self._counters = {}
+        # Dictionary of the (upper case) VIOS UUID to its VIOSLoad.
+        self._loads = {}
+
+    def update(self, date, phyp_sample, vios_infos=None):
+        """Computes the load of the VIOSes from a new PCM sample.
+
+        :param date: The datetime of the sample.
+        :param phyp_sample: The PhypSample of the hypervisor metrics.
+        :param vios_infos: (Optional) The list of ViosInfo metrics of the
+                           VIOSes.  If not provided, only the CPU utilization
+                           is known.
+        """
+        # The VIOS metrics only carry the partition ID.
+        io_bytes = {}
+        for vios_info in vios_infos or []:
+            sample = vios_info.sample
+            io_bytes[sample.id] = (self._fc_bytes(sample),
+                                   self._net_bytes(sample))
+
+        counters = {}
+        for vsample in phyp_sample.vioses:
+            proc = vsample.processor
+            if vsample.uuid is None or proc is None:
+                continue
+            fc_bytes, net_bytes = io_bytes.get(vsample.id, (None, None))
+            counters[vsample.uuid.upper()] = _VIOSCounters(
+                date, ((proc.util_cap_proc_cycles or 0) +
+                       (proc.util_uncap_proc_cycles or 0)),
+                proc.entitled_proc_cycles or 0, fc_bytes, net_bytes)
+
+        with self._lock:
+            loads = {}
+            for uuid, cur in counters.items():
+                prev = self._counters.get(uuid)
+                if prev is not None:
+                    load = self._load(prev, cur)
+                    if load is not None:
+                        loads[uuid] = load
+            self._counters, self._loads = counters, loads
+
+    @staticmethod
+    def _fc_bytes(sample):
+        """Total bytes read and written through the physical FC ports."""
+        if sample.storage is None:
+            return 0
+        return sum((adpt.read_bytes or 0) + (adpt.write_bytes or 0)
+                   for adpt in sample.storage.fc_adpts)
+
+    @staticmethod
+    def _net_bytes(sample):
+        """Total bytes received and sent through the physical ports.
+
+        The traffic of a SEA is also reported on its physical and trunk
+        adapters, so only the physical adapters are counted.
+        """
+        if sample.network is None:
+            return 0
+        return sum((adpt.received_bytes or 0) + (adpt.sent_bytes or 0)
+                   for adpt in sample.network.adpts
+                   if adpt.type == 'physical')
+
+    @staticmethod
+    def _load(prev, cur):
+        """The VIOSLoad between two _VIOSCounters (None if not known)."""
+        secs = (cur.date - prev.date).total_seconds()
+        if secs <= 0:
+            return None
+        entitled = cur.entitled_cycles - prev.entitled_cycles
+        cpu_util = (float(cur.used_cycles - prev.used_cycles) / entitled
+                    if entitled > 0 else 0.0)
+
+        def rate(cur_bytes, prev_bytes):
+            if cur_bytes is None or prev_bytes is None:
+                return 0.0
+            # The counters restart with the VIOS (or the adapter).
+            return max(cur_bytes - prev_bytes, 0) / secs
+        return VIOSLoad(max(cpu_util, 0.0),
+                        rate(cur.fc_bytes, prev.fc_bytes),
+                        rate(cur.net_bytes, prev.net_bytes))
+
+    def load(self, vios_uuid):
+        """Returns the VIOSLoad of a VIOS, or None if it is not known."""
+        with self._lock:
+            return self._loads.get(vios_uuid.upper())
+
+    def least_loaded(self, vios_uuids):
+        """Returns the least loaded of a list of VIOSes.
+
+        The VIOSes are ranked by their CPU utilization (in steps of 10%),
+        then by their FC and network throughput.  The VIOSes without a known
+        load rank after the others.  If none has a known load, or several
+        rank first, one of them is picked at random, to spread the work.
+
+        :param vios_uuids: The (non empty) list of the VIOS UUIDs to pick
+                           from.
+        :return: The UUID of the least loaded VIOS (as it was passed in).
+        """
+        with self._lock:
+            loads = self._loads
+        known = [uuid for uuid in vios_uuids if uuid.upper() in loads]
+        if not known:
+            return random.choice(vios_uuids)
+
+        def rank(uuid):
+            load = loads[uuid.upper()]
+            return (round(load.cpu_util, 1),
+                    load.fc_bytes_per_sec + load.net_bytes_per_sec)
+        best = min(rank(uuid) for uuid in known)
+        return random.choice([uuid for uuid in known if rank(uuid) == best])
+
+
+# The load of the Virtual I/O Servers of the host.  Fed by the HostCPUStats.
+LOAD_MONITOR = VIOSLoadMonitor()
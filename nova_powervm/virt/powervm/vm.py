@@ -23,6 +23,7 @@ from oslo_log import log as logging
 from nova.compute import power_state
 from nova import exception
 from nova.i18n import _LI, _LE, _
+from nova import objects
 from nova.virt import hardware
 from pypowervm import exceptions as pvm_exc
 from pypowervm.helpers import log_helper as pvm_log
@@ -103,11 +104,15 @@ class InstanceInfo(hardware.InstanceInfo):
     :param adapter: pypowervm adapter
     :param name: instance name
     :param uuid: powervm uuid
+    :param lpar_cache: (Optional) The LPARStateCache to read the properties
+                       from.  If not provided (or disabled), each property is
+                       read through its own quick property REST call.
     """
-    def __init__(self, adapter, name, uuid):
+    def __init__(self, adapter, name, uuid, lpar_cache=None):
         self._adapter = adapter
         self._name = name
         self._uuid = uuid
+        self._lpar_cache = lpar_cache
         self._state = None
         self._mem_kb = None
         self._max_mem_kb = None
@@ -118,6 +123,8 @@ class InstanceInfo(hardware.InstanceInfo):
         self.id = uuid
 
     def _get_property(self, q_prop):
+        if self._lpar_cache is not None and self._lpar_cache.enabled:
+            return self._lpar_cache.get_qp(self._uuid, q_prop)
         return get_vm_qp(self._adapter, self._uuid, q_prop)
 
     @property
@@ -386,9 +393,42 @@ def get_lpars(adapter):
     return pvm_lpar.LPAR.search(adapter, is_mgmt_partition=False)
 
 
+def _get_lpar_qps(adapter):
+    """Get the name and UUID of each LPAR, through the quick properties.
+
+    The quick properties of all the LPARs are a single, compact JSON response,
+    rather than the full XML of every LPAR.  If the REST API does not support
+    it, the LPAR wrappers are read instead.
+
+    :param adapter: The pypowervm adapter.
+    :return: List of (name, PowerVM UUID) tuples.  The management partition is
+             not included.
+    """
+    try:
+        resp = adapter.read(pvm_lpar.LPAR.schema_type, suffix_type='quick',
+                            suffix_parm='All')
+        lpars = []
+        for qps in json.loads(resp.body):
+            if str(qps.get('IsManagementPartition')).lower() == 'true':
+                continue
+            lpars.append((qps['PartitionName'],
+                          qps.get('PartitionUUID') or qps['UUID']))
+        return lpars
+    except (pvm_exc.HttpError, ValueError, KeyError, TypeError,
+            AttributeError) as e:
+        LOG.debug('Unable to list the LPARs through their quick properties '
+                  '(%s).  Reading the LPAR feed instead.', e)
+    return [(lpar.name, lpar.uuid) for lpar in get_lpars(adapter)]
+
+
 def get_lpar_names(adapter):
     """Get a list of the LPAR names."""
-    return [x.name for x in get_lpars(adapter)]
+    return [name for name, uuid in _get_lpar_qps(adapter)]
+
+
+def get_lpar_uuids(adapter):
+    """Get a list of the (PowerVM) LPAR UUIDs."""
+    return [uuid for name, uuid in _get_lpar_qps(adapter)]
 
 
 def get_instance_wrapper(adapter, instance, host_uuid):
@@ -406,18 +446,24 @@ def get_instance_wrapper(adapter, instance, host_uuid):
     return pvm_lpar.LPAR.wrap(resp)
 
 
-def instance_exists(adapter, instance, host_uuid, log_errors=False):
+def instance_exists(adapter, instance, host_uuid, log_errors=False,
+                    lpar_cache=None):
     """Determine if an instance exists on the host.
 
     :param adapter: The adapter for the pypowervm API
     :param instance: The nova instance.
     :param host_uuid: The host UUID
     :param log_errors: Indicator whether to log REST data after an exception
+    :param lpar_cache: (Optional) The LPARStateCache to check.  If not
+                       provided (or disabled), the REST API is queried.
     :return: boolean, whether the instance exists.
     """
     try:
         # If we're able to get the property, then it exists.
-        get_vm_id(adapter, get_pvm_uuid(instance), log_errors=log_errors)
+        if lpar_cache is not None and lpar_cache.enabled:
+            lpar_cache.get_qp(get_pvm_uuid(instance), 'PartitionID')
+        else:
+            get_vm_id(adapter, get_pvm_uuid(instance), log_errors=log_errors)
         return True
     except exception.InstanceNotFound:
         return False
@@ -572,6 +618,26 @@ def get_pvm_uuid(instance):
     return pvm_uuid.convert_uuid_to_pvm(instance.uuid).upper()
 
 
+def get_instance(context, pvm_uuid):
+    """Get the nova instance of a PowerVM VM uuid.
+
+    The conversion done by get_pvm_uuid clears the high bit of the UUID, so
+    the nova instance may have either value for that bit.
+
+    :param context: The security context.
+    :param pvm_uuid: The PowerVM UUID of the VM.
+    :return: nova.objects.instance.Instance, or None if the VM is not a nova
+             instance.
+    """
+    uuid = pvm_uuid.lower()
+    for cand in (uuid, '%x%s' % (int(uuid[0], 16) | 8, uuid[1:])):
+        try:
+            return objects.Instance.get_by_uuid(context, cand)
+        except exception.InstanceNotFound:
+            pass
+    return None
+
+
 def get_cnas(adapter, instance, host_uuid):
     """Returns the current CNAs on the instance.
 
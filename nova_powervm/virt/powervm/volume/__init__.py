@@ -38,7 +38,16 @@ vol_adapter_opts = [
     cfg.IntOpt('vscsi_vios_connections_required', default=1,
                help='Indicates a minimum number of Virtual I/O Servers that '
                     'are required to support a Cinder volume attach with the '
-                    'vSCSI volume connector.')
+                    'vSCSI volume connector.'),
+    cfg.IntOpt('vscsi_discovery_workers', default=8,
+               help='The maximum number of Virtual I/O Servers on which the '
+                    'vSCSI volume connector discovers a volume\'s hdisk '
+                    'concurrently.'),
+    cfg.IntOpt('vscsi_discovery_timeout', default=900,
+               help='The number of seconds to wait for the hdisk discovery on '
+                    'a single Virtual I/O Server.  If the discovery takes '
+                    'longer, the volume is treated as not found on that '
+                    'Virtual I/O Server.')
 ]
 CONF.register_opts(vol_adapter_opts, group='powervm')
 
@@ -175,20 +175,39 @@ class PowerVMVolumeAdapter(object):
 
     def connect_volume(self):
         """Connects the volume."""
+        self.connect_volumes([self])
+
+    @classmethod
+    def connect_volumes(cls, vol_drvs):
+        """Connects several volumes to the same VM.
+
+        Allows the adapter to share the discovery work (ex. the Virtual I/O
+        Server feed) across the volumes.  The mappings of all of the volumes
+        are added to the FeedTask of the first adapter, which the others are
+        reset to share.
+
+        :param vol_drvs: The volume adapters (of this class) to connect.  All
+                         must be for the same instance.
+        """
+        lead = vol_drvs[0]
         # Check if the VM is in a state where the attach is acceptable.
-        lpar_w = vm.get_instance_wrapper(self.adapter, self.instance,
-                                         self.host_uuid)
+        lpar_w = vm.get_instance_wrapper(lead.adapter, lead.instance,
+                                         lead.host_uuid)
         capable, reason = lpar_w.can_modify_io()
         if not capable:
             raise exc.VolumeAttachFailed(
-                volume_id=self.volume_id, instance_name=self.instance.name,
-                reason=reason)
+                volume_id=', '.join(vol_drv.volume_id
+                                    for vol_drv in vol_drvs),
+                instance_name=lead.instance.name, reason=reason)
+
+        for vol_drv in vol_drvs[1:]:
+            vol_drv.reset_stg_ftsk(stg_ftsk=lead.stg_ftsk)
 
         # Run the connect
-        self._connect_volume()
+        cls._connect_volumes(vol_drvs)
 
-        if self.stg_ftsk.name == LOCAL_FEED_TASK:
-            self.stg_ftsk.execute()
+        if lead.stg_ftsk.name == LOCAL_FEED_TASK:
+            lead.stg_ftsk.execute()
 
     def disconnect_volume(self):
         """Disconnect the volume."""
@@ -215,6 +234,18 @@ class PowerVMVolumeAdapter(object):
         """
         raise NotImplementedError()
 
+    @classmethod
+    def _connect_volumes(cls, vol_drvs):
+        """Connects several volumes.
+
+        By default, each volume is connected in turn.  Subclasses that can
+        share work across the volumes should override this method.
+
+        :param vol_drvs: The volume adapters (of this class) to connect.
+        """
+        for vol_drv in vol_drvs:
+            vol_drv._connect_volume()
+
     def _disconnect_volume(self):
         """Disconnect the volume.
 
@@ -14,6 +14,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+from concurrent import futures
+import time
+
 from nova.i18n import _, _LI, _LW, _LE
 
 from oslo_concurrency import lockutils
@@ -39,6 +43,9 @@ LOG = logging.getLogger(__name__)
 
 UDID_KEY = 'target_UDID'
 
+# Seconds between checks for hdisk discoveries that have timed out.
+_DISCOVERY_POLL_INTERVAL = 5
+
 # A global variable that will cache the physical WWPNs on the system.
 _vscsi_pfc_wwpns = None
 
@@ -96,7 +103,7 @@ class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
                               should be added to this dictionary.
         """
         volume_id = self.volume_id
-        found = False
+        found, udid = False, None
 
         # See the connect_volume for why this is a direct call instead of
         # using the tx_mgr.feed
@@ -104,12 +111,12 @@ class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
                                       xag=[pvm_vios.VIOS.xags.STORAGE])
         vios_wraps = pvm_vios.VIOS.wrap(vios_feed)
 
-        # Iterate through host vios list to find valid hdisks.
-        for vios_w in vios_wraps:
-            status, device_name, udid = self._discover_volume_on_vios(
-                vios_w, volume_id)
-            # If we found one, no need to check the others.
-            found = found or hdisk.good_discovery(status, device_name)
+        # Discover the hdisks on every VIOS of the host, so that each of them
+        # is ready to host the volume.
+        for vol_drv, vios_w, status, device_name, disc_udid in (
+                self._discover_volumes([self], vios_wraps)):
+            if hdisk.good_discovery(status, device_name):
+                found, udid = True, disc_udid
 
         if not found:
             ex_args = dict(volume_id=volume_id,
@@ -193,36 +200,86 @@ class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
 
         return status, device_name, udid
 
-    def _connect_volume(self):
-        """Connects the volume."""
+    @staticmethod
+    def _discover_volumes(vol_drvs, vios_wraps):
+        """Discovers the hdisks for volumes on several VIOSes concurrently.
 
-        def connect_volume_to_vio(vios_w):
-            """Attempts to connect a volume to a given VIO.
+        Discovery (LUA recovery) can take tens of seconds per VIOS, and is one
+        job per volume.  Up to vscsi_discovery_workers discoveries are run at
+        once.  A discovery that fails, or does not finish within
+        vscsi_discovery_timeout seconds, is logged and skipped.
 
-            :param vios_w: The Virtual I/O Server wrapper to connect to.
-            :return: True if the volume was connected.  False if the volume was
-                     not (could be the Virtual I/O Server does not have
-                     connectivity to the hdisk).
-            """
-            status, device_name, udid = self._discover_volume_on_vios(
-                vios_w, self.volume_id)
+        :param vol_drvs: The vSCSI volume adapters whose volumes to discover.
+        :param vios_wraps: The VIOS wrappers (with the STORAGE xag) to process.
+        :return: Iterator of (vol_drv, vios_w, status, device_name, udid)
+                 tuples, in the order in which the discoveries complete.  See
+                 _discover_volume_on_vios.
+        """
+        jobs = [(vol_drv, vios_w) for vol_drv in vol_drvs
+                for vios_w in vios_wraps]
+        if not jobs:
+            return
+        timeout = CONF.powervm.vscsi_discovery_timeout
+        starts = {}
 
-            if hdisk.good_discovery(status, device_name):
-                # Found a hdisk on this Virtual I/O Server.  Add the action to
-                # map it to the VM when the stg_ftsk is executed.
-                with lockutils.lock(hash(self)):
-                    self._add_append_mapping(vios_w.uuid, device_name)
+        def discover(job_id, vol_drv, vios_w):
+            starts[job_id] = time.time()
+            return vol_drv._discover_volume_on_vios(vios_w, vol_drv.volume_id)
+
+        executor = tx.ContextThreadPoolExecutor(
+            min(CONF.powervm.vscsi_discovery_workers, len(jobs)))
+        try:
+            pending = {executor.submit(discover, job_id, vol_drv, vios_w):
+                       (job_id, vol_drv, vios_w)
+                       for job_id, (vol_drv, vios_w) in enumerate(jobs)}
+            while pending:
+                done, not_done = futures.wait(
+                    pending, timeout=_DISCOVERY_POLL_INTERVAL,
+                    return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    job_id, vol_drv, vios_w = pending.pop(future)
+                    try:
+                        status, device_name, udid = future.result()
+                    except Exception as e:
+                        LOG.warn(_LW('Failed to discover the hdisk for volume '
+                                     '%(volume_id)s on Virtual I/O Server '
+                                     '%(vios)s: %(err)s'),
+                                 {'volume_id': vol_drv.volume_id,
+                                  'vios': vios_w.name, 'err': e})
+                        continue
+                    yield vol_drv, vios_w, status, device_name, udid
+
+                # A running discovery can not be interrupted; it is simply
+                # no longer waited on.
+                now = time.time()
+                for future in not_done:
+                    job_id, vol_drv, vios_w = pending[future]
+                    started = starts.get(job_id)
+                    if started is not None and now - started >= timeout:
+                        LOG.warn(_LW('Timed out after %(timeout)d seconds '
+                                     'discovering the hdisk for volume '
+                                     '%(volume_id)s on Virtual I/O Server '
+                                     '%(vios)s.'),
+                                 {'timeout': timeout,
+                                  'volume_id': vol_drv.volume_id,
+                                  'vios': vios_w.name})
+                        del pending[future]
+        finally:
+            executor.shutdown(wait=False)
 
-                # Save the UDID for the disk in the connection info.  It is
-                # used for the detach.
-                self._set_udid(udid)
-                LOG.debug('Device attached: %s', device_name)
+    def _connect_volume(self):
+        """Connects the volume."""
+        self._connect_volumes([self])
 
-                # Valid attachment
-                return True
+    @classmethod
+    def _connect_volumes(cls, vol_drvs):
+        """Connects several volumes.
 
-            return False
+        The VIOS feed is read once for all of the volumes, and the volumes are
+        discovered on the VIOSes concurrently.
 
+        :param vol_drvs: The vSCSI volume adapters to connect.
+        """
         # Its about to get weird.  The transaction manager has a list of
         # VIOSes.  We could use those, but they only have SCSI mappings (by
         # design).  They do not have storage (super expensive).
@@ -233,20 +290,32 @@ class VscsiVolumeAdapter(v_driver.FibreChannelVolumeAdapter):
         #
         # So we get the VIOSes with the storage xag here, separately, to save
         # the stg_ftsk from potentially having to run it multiple times.
-        connect_ftsk = tx.FeedTask(
-            'connect_volume_to_vio', pvm_vios.VIOS.getter(
-                self.adapter, xag=[pvm_vios.VIOS.xags.STORAGE]))
+        vios_wraps = pvm_vios.VIOS.getter(
+            vol_drvs[0].adapter, xag=[pvm_vios.VIOS.xags.STORAGE]).get()
+
         # Find valid hdisks and map to VM.
-        connect_ftsk.add_functor_subtask(
-            connect_volume_to_vio, provides='vio_modified', flag_update=False)
-        ret = connect_ftsk.execute()
+        vioses_modified = collections.Counter()
+        for vol_drv, vios_w, status, device_name, udid in (
+                cls._discover_volumes(vol_drvs, vios_wraps)):
+            if not hdisk.good_discovery(status, device_name):
+                # The Virtual I/O Server does not have connectivity to the
+                # hdisk.
+                continue
+
+            # Found a hdisk on this Virtual I/O Server.  Add the action to map
+            # it to the VM when the stg_ftsk is executed.
+            vol_drv._add_append_mapping(vios_w.uuid, device_name)
+
+            # Save the UDID for the disk in the connection info.  It is used
+            # for the detach.
+            vol_drv._set_udid(udid)
+            LOG.debug('Device attached: %s', device_name)
+            vioses_modified[vol_drv.volume_id] += 1
 
         # Check the number of VIOSes
-        vioses_modified = 0
-        for result in ret['wrapper_task_rets'].values():
-            if result['vio_modified']:
-                vioses_modified += 1
-        self._validate_vios_on_connection(vioses_modified)
+        for vol_drv in vol_drvs:
+            vol_drv._validate_vios_on_connection(
+                vioses_modified[vol_drv.volume_id])
 
     def _validate_vios_on_connection(self, num_vioses_found):
         """Validates that the correct number of VIOSes were discovered.